@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+"""
+Measures the peak memory of reading and chunking the diffs of a changelog range, streamed from
+the git process as the changelog does now, against capturing the whole output first as it did
+before. The output of `git log -p` is replaced by a synthetic one of the requested size, sent
+through a git alias so the real pipe is used. Every mode runs in its own process, the model
+requests are left out.
+"""
+import argparse
+import os
+import random
+import resource
+import subprocess
+import sys
+import time
+from itertools import groupby
+from operator import itemgetter
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "cactus"))
+
+from loguru import logger
+
+import api
+import git_utils
+import tokenizer
+from run import WordEncoding
+from synthetic import WORDS
+
+
+def emit(size_mb, commit_mb, seed=0):
+    """
+    Writes `size_mb` of `git log -p --format=%x00%H` output, in commits of about `commit_mb`.
+    """
+    rng = random.Random(seed)
+    out = sys.stdout.buffer
+    written, commit = 0, 0
+    while written < size_mb * 1024 * 1024:
+        commit += 1
+        text = [f"\0{commit:040x}", ""]
+        commit_size = 0
+        while commit_size < commit_mb * 1024 * 1024:
+            path = f"pkg/module_{commit}_{len(text)}.py"
+            text += [f"diff --git a/{path} b/{path}", "index 1234567..89abcde 100644", f"--- a/{path}", f"+++ b/{path}"]
+            for hunk in range(rng.randint(1, 8)):
+                text.append(f"@@ -{hunk * 100},20 +{hunk * 100},21 @@ def {rng.choice(WORDS)}():")
+                # every line is unique, like in a real history, so nothing is shared between commits
+                text += [f"{rng.choice(' +-')}    {rng.choice(WORDS)}_{commit}_{hunk}_{i} = {rng.choice(WORDS)}({rng.choice(WORDS)}, {len(text)})"
+                         for i in range(20)]
+            data = ("\n".join(text) + "\n").encode()
+            out.write(data)
+            commit_size += len(data)
+            text = []
+        out.write(b"\n")
+        written += commit_size
+
+
+def run_mode(mode, args):
+    session = git_utils.GitSession()
+    command = ["-c", f"alias.synthetic-log=!{sys.executable} {os.path.realpath(__file__)} --emit --size-mb {args.size_mb} --commit-mb {args.commit_mb}",
+               "synthetic-log"]
+    commits, chunks = 0, 0
+    if mode == "captured":
+        # the previous reader: the whole output in memory, decoded, then split by commit
+        text = session.run(*command, check=True).stdout.decode('utf-8', errors='replace')
+        for entry in text.split("\0")[1:]:
+            commits += 1
+            for _ in api.split_into_chunks(entry.partition("\n")[2].strip("\n"), args.model):
+                chunks += 1
+    else:
+        for _, records in groupby(git_utils.read_file_diffs(session.stream(*command)), key=itemgetter(0)):
+            commits += 1
+            for _ in api.iter_chunks((record for _, record in records), args.model):
+                chunks += 1
+    return commits, chunks
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--size-mb", type=int, default=1024, help="Size of the synthetic diff")
+    parser.add_argument("--commit-mb", type=float, default=2, help="Size of every commit of the synthetic diff")
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--modes", default="streamed,captured", help="Comma-separated modes to run (streamed, captured)")
+    parser.add_argument("--word-tokens", action="store_true", help="Count words instead of tokens (no tiktoken encodings needed)")
+    parser.add_argument("--emit", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--mode", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.emit:
+        return emit(args.size_mb, args.commit_mb)
+
+    logger.remove()
+    if args.word_tokens:
+        tokenizer.get_encoding = lambda model: WordEncoding()
+    if args.mode:
+        start = time.perf_counter()
+        commits, chunks = run_mode(args.mode, args)
+        peak_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+        print(f"{args.mode:>9}: {commits:>5} commits, {chunks:>6} chunks, peak RSS {peak_mb:8.1f} MB, {time.perf_counter() - start:6.1f} s")
+        return
+
+    print(f"diff: {args.size_mb} MB in commits of {args.commit_mb} MB")
+    for mode in args.modes.split(","):
+        child = [sys.executable, os.path.realpath(__file__), "--mode", mode, "--size-mb", str(args.size_mb), "--commit-mb", str(args.commit_mb),
+                 "--model", args.model] + (["--word-tokens"] if args.word_tokens else [])
+        result = subprocess.run(child, capture_output=True, text=True)
+        print(result.stdout.strip() if result.returncode == 0 else f"{mode:>9}: failed ({result.returncode}) {result.stderr.strip()[-200:]}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Compares the changelog chunker, which bin-packs whole files and hunks, with the previous one,
+which cut the diff every time the next line didn't fit, on the staged diff of a synthetic repo.
+Both get the same budget, the model context window minus the headroom.
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "cactus"))
+
+from loguru import logger
+
+import api
+import git_utils
+import tokenizer
+from constants import MODEL_TOKEN_LIMITS
+from run import WordEncoding
+from synthetic import create_repo
+
+
+def split_by_lines(text, model, max_tokens):
+    """
+    The previous chunker, kept as the reference of the measurements.
+    """
+    lines = text.split('\n')
+    chunks, current_chunk, current_length = [], [], 0
+    for line, line_length in zip(lines, tokenizer.count_tokens_batch(lines, model)):
+        line_length += 1
+        if current_length + line_length > max_tokens:
+            chunks.append('\n'.join(current_chunk))
+            current_chunk, current_length = [], 0
+        current_chunk.append(line)
+        current_length += line_length
+    if current_chunk:
+        chunks.append('\n'.join(current_chunk))
+    return chunks
+
+
+def describe(chunks, model, max_tokens):
+    sizes = [sum(length + 1 for length in tokenizer.count_tokens_batch(chunk.split('\n'), model)) for chunk in chunks]
+    headless = sum(1 for chunk in chunks if not chunk.startswith("diff --git "))
+    return (f"{len(chunks):>5} chunks, {sum(sizes) / len(sizes) / max_tokens:6.1%} full on average, "
+            f"{headless:>4} starting without a file header")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--hunks", type=int, default=8, help="Hunks per file")
+    parser.add_argument("--lines", type=int, default=400, help="Lines per file")
+    parser.add_argument("--context-size", type=int, default=10, help="Context lines of the diff hunks")
+    parser.add_argument("--model", default="gpt-4")
+    parser.add_argument("--headroom", type=int, default=api.CHUNK_HEADROOM)
+    parser.add_argument("--word-tokens", action="store_true", help="Count words instead of tokens (no tiktoken encodings needed)")
+    args = parser.parse_args()
+
+    logger.remove()
+    if args.word_tokens:
+        tokenizer.get_encoding = lambda model: WordEncoding()
+    os.chdir(create_repo(files=args.files, hunks=args.hunks, lines=args.lines))
+    text = git_utils.get_git_diff(args.context_size).decode('utf-8')
+    max_tokens = MODEL_TOKEN_LIMITS[args.model] - args.headroom
+    total = sum(length + 1 for length in tokenizer.count_tokens_batch(text.split('\n'), args.model))
+    print(f"diff: {total} tokens, {max_tokens} tokens per chunk, at least {-(-total // max_tokens)} chunks")
+
+    for name, split in (("by lines", lambda: split_by_lines(text, args.model, max_tokens)),
+                        ("bin-packed", lambda: api.split_into_chunks(text, args.model, headroom=args.headroom))):
+        start = time.perf_counter()
+        chunks = split()
+        elapsed = (time.perf_counter() - start) * 1000
+        print(f"{name:>10}: {describe(chunks, args.model, max_tokens)}, {elapsed:7.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Compares the local pipeline before the LLM call (patch extraction, prompt building and token
+accounting) when the staged diff is parsed once into a DiffModel versus once per stage.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "cactus"))
+
+from loguru import logger
+from unidiff import PatchSet
+
+import cactus
+from diff_model import DiffModel
+from synthetic import create_repo
+
+
+def legacy_pipeline(diff_data, count_tokens):
+    """
+    The pipeline as it was before the DiffModel: every stage decodes and parses the diff again.
+    """
+    for stage in ("extract_patches", "get_file_token_counts", "prepare_prompt_data"):
+        patch_set = PatchSet.from_string(diff_data.decode('latin-1'))
+        for patched_file in patch_set:
+            for hunk in patched_file:
+                [line.encode('latin-1').decode('utf-8', errors='replace') for line in str(hunk).splitlines()]
+        if stage == "get_file_token_counts":
+            for patched_file in patch_set:
+                count_tokens('\n'.join(str(hunk) for hunk in patched_file))
+        elif stage == "prepare_prompt_data":
+            for patched_file in patch_set:
+                with open(patched_file.path, 'r', encoding='utf-8') as f:
+                    f.readlines()
+
+
+def model_pipeline(diff_data, model):
+    diff_model = DiffModel.from_bytes(diff_data)
+    cactus.extract_patches(diff_model)
+    cactus.get_file_token_counts(diff_model, model)
+    cactus.prepare_prompt_data(diff_model)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=400)
+    parser.add_argument("--hunks", type=int, default=10)
+    parser.add_argument("--lines", type=int, default=400)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--skip-tokens", action="store_true", help="Count whitespace-separated words instead of tokens")
+    args = parser.parse_args()
+
+    logger.remove()
+    if args.skip_tokens:
+        cactus.num_tokens_from_string = lambda text, model: len(text.split())
+    count_tokens = lambda text: cactus.num_tokens_from_string(text, args.model)
+
+    os.chdir(create_repo(files=args.files, hunks=args.hunks, lines=args.lines))
+    diff_data = subprocess.run(["git", "diff", "--unified=1", "--minimal", "-p", "--staged", "--binary"],
+                               stdout=subprocess.PIPE,
+                               check=True).stdout
+    print(f"diff: {len(diff_data.splitlines())} lines, {len(diff_data)} bytes")
+
+    for name, func in (("legacy", lambda: legacy_pipeline(diff_data, count_tokens)),
+                       ("diff model", lambda: model_pipeline(diff_data, args.model))):
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            func()
+            timings.append(time.perf_counter() - start)
+        print(f"{name:>10}: {min(timings) * 1000:8.1f} ms (best of {args.repeat})")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+Compares reading the staged content of the touched files one by one (a `git show :path` per file,
+or a working tree open() that may not match the index) with the persistent IndexReader.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "cactus"))
+
+from loguru import logger
+
+from git_utils import GitSession
+from synthetic import create_repo
+
+
+def read_with_open(paths):
+    for path in paths:
+        with open(path, 'r', encoding='utf-8') as f:
+            f.readlines()
+
+
+def read_with_git_show(paths):
+    for path in paths:
+        subprocess.run(["git", "show", f":{path}"], capture_output=True, check=True)
+
+
+def read_with_index_reader(paths):
+    session = GitSession()
+    session.index_reader.read_files(paths)
+    session.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=500)
+    parser.add_argument("--lines", type=int, default=400)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+
+    logger.remove()
+    os.chdir(create_repo(files=args.files, hunks=1, lines=args.lines))
+    paths = subprocess.run(["git", "diff", "--staged", "--name-only"], capture_output=True, text=True, check=True).stdout.split()
+    print(f"{len(paths)} staged files")
+
+    for name, func, processes in (("open()", read_with_open, 0),
+                                  ("git show", read_with_git_show, len(paths)),
+                                  ("index reader", read_with_index_reader, 3)):
+        timings = []
+        for _ in range(args.repeat):
+            start = time.perf_counter()
+            func(paths)
+            timings.append(time.perf_counter() - start)
+        print(f"{name:>12}: {min(timings) * 1000:8.1f} ms (best of {args.repeat}), {processes} git processes")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Times the grouper similarity backends on synthetic hunks and reports how closely the MinHash/LSH
+estimates follow the exact Jaccard similarity.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "cactus"))
+
+import numpy as np
+
+import grouper
+from synthetic import WORDS
+
+
+def synthetic_hunks(count, seed=0):
+    """
+    Hunks drawn from a few templates, so that there are groups of near-duplicates like in a codemod.
+    """
+    rng = random.Random(seed)
+    templates = [[f"{rng.choice(WORDS)}_{rng.randint(0, 500)}" for _ in range(40)] for _ in range(max(count // 50, 1))]
+    hunks = []
+    for _ in range(count):
+        words = list(rng.choice(templates))
+        for _ in range(rng.randint(0, 8)):
+            words[rng.randrange(len(words))] = f"{rng.choice(WORDS)}_{rng.randint(0, 500)}"
+        hunks.append(" ".join(words))
+    return hunks
+
+
+def timed(func):
+    start = time.perf_counter()
+    result = func()
+    return result, (time.perf_counter() - start) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--hunks", type=int, default=10000, help="Number of hunks for the MinHash backend")
+    parser.add_argument("--exact-hunks", type=int, default=1000, help="Number of hunks for the exact comparison")
+    args = parser.parse_args()
+
+    hunks = synthetic_hunks(args.exact_hunks)
+    exact, exact_ms = timed(lambda: grouper.similarity_matrix(hunks, type='jaccard'))
+    approximate, minhash_ms = timed(lambda: grouper.similarity_matrix(hunks, type='minhash'))
+    rows, cols = approximate.nonzero()
+    error = np.abs(np.asarray(approximate[rows, cols]).ravel() - exact[rows, cols])
+    recall = np.mean(approximate.toarray()[exact >= 0.5] > 0)
+    print(f"{args.exact_hunks} hunks: jaccard {exact_ms:.0f} ms, minhash {minhash_ms:.0f} ms")
+    print(f"  mean abs error {error.mean():.3f}, recall of pairs with jaccard >= 0.5: {recall:.3f}")
+
+    hunks = synthetic_hunks(args.hunks)
+    matrix, minhash_ms = timed(lambda: grouper.similarity_matrix(hunks, type='minhash'))
+    print(f"{args.hunks} hunks: minhash {minhash_ms:.0f} ms, {matrix.nnz} non-zero entries")
+
+
+if __name__ == "__main__":
+    main()
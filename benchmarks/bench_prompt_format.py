@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+"""
+Measures the size of the grouping prompt in the current format against the previous one (every
+line prefixed with FILE: or HUNK:, hunks repeated in full, and JSON-quoted for Gemini), with
+whole files and with the planned context windows.
+
+With --validity, also sends the prompts of both formats to a model, each with the system prompt
+describing its layout, and reports how many answers use every hunk exactly once as they come
+(check_clusters) and after the follow-up repairs. The answers of a real model can be recorded
+with --record and measured again offline with --replay.
+"""
+import argparse
+import json
+import os
+import re
+import sys
+from contextlib import contextmanager, nullcontext
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "cactus"))
+
+from loguru import logger
+
+import api
+import cactus
+import git_utils
+import providers
+import tokenizer
+from constants import PROMPT_CLASSIFICATOR_SYSTEM, PROMPT_FORMAT_VERSION
+from context import FileContext, plan_context, read_files
+from diff_model import DiffModel
+from providers import configure_limits, get_provider
+from run import WordEncoding
+from synthetic import create_repo
+
+
+# The input structure section of the system prompt of format 1, for the layout of render_v1
+INPUT_STRUCTURE_V1 = """## Input Structure:
+
+You will receive the contents of every changed file, followed by the hunks:
+
+```
+# FILE: path/to/file1.py
+FILE: <line 1 of file1.py>
+FILE: [... N lines ...]
+FILE: <line N+2 of file1.py>
+
+## HUNK 1 (path/to/file1.py)
+HUNK: <diff line>
+```
+
+*   **FILE**: The path of a changed file, followed by its lines before the changes, each prefixed with `FILE: `. Parts of the file far from the changes may be left out and replaced with a `[... N lines ...]` marker. Deleted and binary files have a placeholder instead.
+*   **HUNK**: One change, with its unique index and its file, followed by its unified diff lines, each prefixed with `HUNK: `.
+
+"""
+
+
+@contextmanager
+def system_prompt_v1():
+    """
+    Sends the grouping requests made in the block with the system prompt of format 1.
+    """
+    system = re.sub(r"## Input Structure:.*?(?=## Core Task)", lambda match: INPUT_STRUCTURE_V1, PROMPT_CLASSIFICATOR_SYSTEM, flags=re.S)
+    api.PROMPT_CLASSIFICATOR_SYSTEM = providers.PROMPT_CLASSIFICATOR_SYSTEM = system
+    try:
+        yield
+    finally:
+        api.PROMPT_CLASSIFICATOR_SYSTEM = providers.PROMPT_CLASSIFICATOR_SYSTEM = PROMPT_CLASSIFICATOR_SYSTEM
+
+
+def render_v1(diff_model, context_plan=None):
+    """
+    The prompt data of format 1, kept as the reference of the measurements.
+    """
+    file_data, hunk_data = [], []
+    files = read_files([diff_file.path for diff_file in diff_model.files]) if not context_plan else {}
+    for diff_file in diff_model.files:
+        file_data.append(f"\n# FILE: {diff_file.path}")
+        file_context = context_plan[diff_file.path] if context_plan else FileContext(*files.get(diff_file.path, ([], False)))
+        if not file_context.is_text:
+            # format 1 had a placeholder instead of the lines of deleted and binary files
+            file_data.append(f"FILE: {'### File Not Found' if diff_file.is_removed else '### [BINARY FILE]'}")
+        elif file_context.windows is None:
+            file_data.extend(f"FILE: {line}" for line in file_context.lines)
+        else:
+            last = 0
+            for start, end in file_context.windows:
+                if start > last + 1:
+                    file_data.append(f"FILE: [... {start - last - 1} lines ...]")
+                file_data.extend(f"FILE: {line}" for line in file_context.lines[start - 1:end])
+                last = end
+            if file_context.lines and last < len(file_context.lines):
+                file_data.append(f"FILE: [... {len(file_context.lines) - last} lines ...]")
+        for hunk in diff_file.hunks:
+            hunk_data.append(f"\n## HUNK {hunk.index} ({diff_file.path})")
+            if hunk.is_header_only:
+                hunk_data.append(f"HUNK: {'[BINARY FILE]' if diff_file.is_binary else '[NO CONTENT CHANGES]'}")
+            hunk_data.extend(f"HUNK: {line}" for line in hunk.lines)
+    return "\n".join(file_data + hunk_data)
+
+
+def measure_validity(provider, prompt_data, hunks_n, samples):
+    """
+    Returns the answers that were valid as they came and the ones valid after the repairs.
+    """
+    valid, repaired = 0, 0
+    for _ in range(samples):
+        _, missing, duplicated, invalid = api.check_clusters(provider.cluster(prompt_data, None, hunks_n), hunks_n)
+        valid += not (missing or duplicated or invalid)
+        try:
+            api.get_clusters(provider, prompt_data, None, hunks_n)
+            repaired += 1
+        except Exception as e:
+            logger.debug(f"Grouping failed: {e}")
+    return valid, repaired
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--files", type=int, default=100)
+    parser.add_argument("--hunks", type=int, default=5, help="Hunks per file")
+    parser.add_argument("--lines", type=int, default=300, help="Lines per file")
+    parser.add_argument("--binaries", type=int, default=5)
+    parser.add_argument("--renames", type=int, default=5)
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--word-tokens", action="store_true", help="Count words instead of tokens (no tiktoken encodings needed)")
+    parser.add_argument("--validity", type=int, default=0, metavar="SAMPLES", help="Grouping requests sent per prompt to measure validity")
+    parser.add_argument("--api-base", help="Base URL of an OpenAI-compatible server for --validity (e.g. the stub server)")
+    parser.add_argument("--record", metavar="CASSETTE", help="Record the answers of --validity to a cassette")
+    parser.add_argument("--replay", metavar="CASSETTE", help="Replay the answers of --validity from a cassette")
+    args = parser.parse_args()
+
+    logger.remove()
+    if args.word_tokens:
+        tokenizer.get_encoding = lambda model: WordEncoding()
+    os.chdir(create_repo(files=args.files, hunks=args.hunks, lines=args.lines, binaries=args.binaries, renames=args.renames))
+    diff_model = DiffModel.from_bytes(git_utils.get_git_diff(1))
+    context_plan = plan_context(diff_model, args.model)
+    print(f"diff: {len(diff_model.files)} files, {len(diff_model.hunks)} hunks")
+
+    for name, plan in (("whole files", None), ("context windows", context_plan)):
+        before, after = render_v1(diff_model, plan), cactus.prepare_prompt_data(diff_model, plan)
+        for label, old, new in (("OpenAI", before, after), ("Gemini", json.dumps(before), after)):
+            old_tokens, new_tokens = tokenizer.count_tokens(old, args.model), tokenizer.count_tokens(new, args.model)
+            print(f"  {name:>15} {label:>6}: format 1 {old_tokens:>8} tokens, format {PROMPT_FORMAT_VERSION} {new_tokens:>8} tokens "
+                  f"({new_tokens / old_tokens - 1:+.1%})")
+
+    if args.validity:
+        api_type = "Gemini" if "gemini" in args.model and not args.api_base else "OpenAI"
+        api.configure_api_key(api_type, api.load_api_key(api_type) or "unused")
+        configure_limits(jobs=1)
+        for name, plan in (("whole files", None), ("context windows", context_plan)):
+            for version, prompt_data, system in ((1, render_v1(diff_model, plan), system_prompt_v1()),
+                                                 (PROMPT_FORMAT_VERSION, cactus.prepare_prompt_data(diff_model, plan), nullcontext())):
+                # a provider per format, since Gemini keeps the system prompt in its model
+                provider = get_provider(args.model, record=args.record, replay=args.replay, api_base=args.api_base)
+                with system:
+                    valid, repaired = measure_validity(provider, prompt_data, len(diff_model.hunks), args.validity)
+                print(f"  {name:>15} format {version} validity: {valid}/{args.validity} answers valid as they came, "
+                      f"{repaired}/{args.validity} after repairs")
+
+
+if __name__ == "__main__":
+    main()
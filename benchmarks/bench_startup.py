@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Import-time regression check for the CLI.
+
+Runs `cactus --help` in fresh interpreters and fails if the best startup time goes over the budget
+or if any heavy module (provider SDKs, tokenizer, ML libraries) is loaded just by importing cactus.
+"""
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+CACTUS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "cactus")
+
+HEAVY_MODULES = [
+    "openai",
+    "google.generativeai",
+    "tiktoken",
+    "unidiff",
+    "prompt_toolkit",
+    "numpy",
+    "sklearn",
+    "thefuzz",
+]
+
+
+def loaded_heavy_modules():
+    code = f"import sys, cactus; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=CACTUS_DIR, capture_output=True, text=True, check=True)
+    return [m for m in result.stdout.strip().split(",") if m]
+
+
+def startup_time(repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.join(CACTUS_DIR, "cactus.py"), "--help"],
+                       stdout=subprocess.DEVNULL,
+                       check=True)
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--budget", type=float, default=500, help="Maximum startup time in milliseconds")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    failed = False
+
+    heavy = loaded_heavy_modules()
+    if heavy:
+        print(f"FAIL: importing cactus loads {', '.join(heavy)}")
+        failed = True
+
+    elapsed = startup_time(args.repeat)
+    print(f"cactus --help: {elapsed:.1f} ms (best of {args.repeat}, budget {args.budget:.0f} ms)")
+    if elapsed > args.budget:
+        print("FAIL: startup time over budget")
+        failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()
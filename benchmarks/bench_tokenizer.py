@@ -0,0 +1,81 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmark of the cached, batched tokenizer against per-call tiktoken lookups, on a
+synthetic changelog-sized diff.
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "cactus"))
+
+import tiktoken
+
+from api import split_into_chunks
+from synthetic import WORDS
+
+
+def legacy_num_tokens_from_string(text, model):
+    try:
+        encoding = tiktoken.encoding_for_model(model)
+    except KeyError:
+        encoding = tiktoken.encoding_for_model("gpt-4-0613")
+    return len(encoding.encode(text)) + 8
+
+
+def legacy_split_into_chunks(text, model, max_tokens):
+    chunks, current_chunk, current_length = [], [], 0
+    for line in text.split('\n'):
+        line_length = legacy_num_tokens_from_string(line, model)
+        if current_length + line_length > max_tokens:
+            chunks.append('\n'.join(current_chunk))
+            current_chunk, current_length = [], 0
+        current_chunk.append(line)
+        current_length += line_length
+    if current_chunk:
+        chunks.append('\n'.join(current_chunk))
+    return chunks
+
+
+def synthetic_diff(lines, seed=0):
+    rng = random.Random(seed)
+    diff = []
+    for i in range(lines):
+        if i % 500 == 0:
+            diff.append(f"diff --git a/pkg/module_{i}.py b/pkg/module_{i}.py")
+        elif i % 25 == 0:
+            diff.append(f"@@ -{i},7 +{i},7 @@ def {rng.choice(WORDS)}():")
+        else:
+            diff.append(f"{rng.choice(' +-')}    {rng.choice(WORDS)}_{i % 97} = {rng.choice(WORDS)}({rng.choice(WORDS)})")
+    return '\n'.join(diff)
+
+
+def best_of(repeat, func):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings) * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--lines", type=int, default=200000)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--model", default="gpt-4o")
+    args = parser.parse_args()
+
+    text = synthetic_diff(args.lines)
+    print(f"diff: {args.lines} lines, {len(text)} bytes")
+
+    cold = best_of(1, lambda: split_into_chunks(text, args.model))
+    print(f"{'legacy':>16}: {best_of(args.repeat, lambda: legacy_split_into_chunks(text, args.model, 127450)):8.1f} ms")
+    print(f"{'batched (cold)':>16}: {cold:8.1f} ms")
+    print(f"{'batched (warm)':>16}: {best_of(args.repeat, lambda: split_into_chunks(text, args.model)):8.1f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+#!/usr/bin/env python3
+"""
+Benchmark suite of cactus's local overhead on a synthetic repository.
+
+Times every local stage of a run (diff parsing, token accounting, prompt building, changelog
+chunking, staging and commit creation) and a full `generate` run against a stubbed provider.
+Caches are cleared between repetitions, so every run is cold. Results can be written as JSON
+and compared against a previous run with --baseline, failing when a stage got slower than the
+threshold.
+"""
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+from argparse import Namespace
+
+sys.path.append(os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "cactus"))
+
+from loguru import logger
+
+import api
+import cactus
+import git_utils
+import prompt
+import tokenizer
+from context import plan_context
+from diff_model import DiffModel
+from providers import Provider
+from synthetic import create_repo
+
+
+class WordEncoding:
+    """
+    Counts whitespace-separated words instead of tokens, for machines without the tiktoken encodings.
+    """
+    name = "words"
+
+    def encode_batch(self, texts, num_threads=1, disallowed_special=()):
+        return [text.split() for text in texts]
+
+
+def stub_clusters(clusters_n, hunks_n):
+    """
+    Groups consecutive hunks into `clusters_n` commits, or one commit per 10 hunks.
+    """
+    clusters_n = clusters_n or max(hunks_n // 10, 1)
+    size = -(-hunks_n // clusters_n)
+    return [{
+        "message": f"chore: update group {i}", "hunk_indices": list(range(start + 1, min(start + size, hunks_n) + 1))
+    } for i, start in enumerate(range(0, hunks_n, size))]
+
+
+class StubProvider(Provider):
+    """
+    Stands in for the model, answering after the given latency.
+    """
+    name = "Stub"
+
+    def __init__(self, model, latency=0.0):
+        super().__init__(model)
+        self.latency = latency
+
+    def cluster(self, prompt_data, clusters_n, hunks_n, follow_ups=(), on_commit=None):
+        time.sleep(self.latency)
+        self.record_usage()
+        commits = stub_clusters(clusters_n, hunks_n)
+        for commit in commits if on_commit else ():
+            on_commit(commit)
+        return commits
+
+    def changelog(self, prompt, max_tokens=None):
+        time.sleep(self.latency)
+        self.record_usage()
+        return "<changelog>\n- Improved stability and performance\n</changelog>"
+
+
+def git(*args):
+    return subprocess.run(["git", *args], capture_output=True, check=True).stdout.decode().strip()
+
+
+@contextlib.contextmanager
+def preserved_repository():
+    """
+    Restores HEAD and the index (with the staged changes) after the block.
+    """
+    head = git("rev-parse", "HEAD")
+    index_path = git("rev-parse", "--git-path", "index")
+    shutil.copyfile(index_path, f"{index_path}.bench")
+    try:
+        yield
+    finally:
+        git("update-ref", "HEAD", head)
+        os.replace(f"{index_path}.bench", index_path)
+
+
+def reset_caches():
+    tokenizer.clear_cache()
+    git_utils.get_session().close()
+    git_utils.get_session.cache_clear()
+
+
+def stage_extract_patches(ctx):
+    cactus.extract_patches(DiffModel.from_bytes(ctx["diff_data"]))
+
+
+def stage_token_counts(ctx):
+    cactus.get_file_token_counts(ctx["diff_model"], ctx["model"])
+
+
+def stage_prepare_prompt_data(ctx):
+    cactus.prepare_prompt_data(ctx["diff_model"], plan_context(ctx["diff_model"], ctx["model"]))
+
+
+def stage_split_into_chunks(ctx):
+    api.split_into_chunks(ctx["diff_text"], ctx["model"])
+
+
+def stage_stage_changes(ctx):
+    with preserved_repository():
+        git("read-tree", "HEAD")
+        git_utils.get_session().apply_cached(ctx["diff_model"].patches)
+
+
+def stage_generate_commits(ctx):
+    clusters = stub_clusters(None, len(ctx["diff_model"].hunks))
+    with preserved_repository():
+        cactus.generate_commits(ctx["diff_model"], clusters, run_hooks=False)
+
+
+def stage_end_to_end(ctx):
+    args = Namespace(
+        context_size=1,
+        model=ctx["model"],
+        offline=False,
+        no_cache=True,
+        shard=False,
+        jobs=4,
+        prefetch=0,
+        n=None,
+        no_verify=True,
+        record=None,
+        replay=None,
+        replay_latency=None,
+        api_base=None)
+    with preserved_repository(), contextlib.redirect_stdout(io.StringIO()):
+        cactus.generate_changes(args)
+
+
+STAGES = {
+    "extract_patches": stage_extract_patches,
+    "get_file_token_counts": stage_token_counts,
+    "prepare_prompt_data": stage_prepare_prompt_data,
+    "split_into_chunks": stage_split_into_chunks,
+    "stage_changes": stage_stage_changes,
+    "generate_commits": stage_generate_commits,
+    "end_to_end": stage_end_to_end,
+}
+
+
+def run_stages(ctx, stages, repeat):
+    results = {}
+    for name in stages:
+        timings = []
+        for _ in range(repeat):
+            reset_caches()
+            start = time.perf_counter()
+            STAGES[name](ctx)
+            timings.append((time.perf_counter() - start) * 1000)
+        results[name] = {"min_ms": min(timings), "median_ms": statistics.median(timings), "runs_ms": timings}
+        print(f"  {name:>22}: {results[name]['median_ms']:9.1f} ms median, {results[name]['min_ms']:9.1f} ms min")
+    return results
+
+
+def compare(results, baseline, threshold, min_delta):
+    """
+    Returns the stages whose median got slower than the baseline by more than the threshold
+    (and by more than `min_delta` milliseconds, to ignore noise on fast stages).
+    """
+    regressions = []
+    for name, result in results.items():
+        if name not in baseline.get("stages", {}):
+            continue
+        before, after = baseline["stages"][name]["median_ms"], result["median_ms"]
+        change = (after - before) / before if before else 0
+        status = "ok"
+        if change > threshold and after - before > min_delta:
+            status = "REGRESSION"
+            regressions.append(name)
+        print(f"  {name:>22}: {before:9.1f} -> {after:9.1f} ms ({change:+.1%}) {status}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--files", type=int, default=200)
+    parser.add_argument("--hunks", type=int, default=5, help="Hunks per file")
+    parser.add_argument("--lines", type=int, default=400, help="Lines per file")
+    parser.add_argument("--binaries", type=int, default=10, help="Number of modified binary files")
+    parser.add_argument("--renames", type=int, default=10, help="Number of renamed files")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--model", default="gpt-4o")
+    parser.add_argument("--latency", type=float, default=0.0, help="Simulated latency of the stubbed provider, in seconds")
+    parser.add_argument("--stages", nargs="+", choices=list(STAGES), default=list(STAGES))
+    parser.add_argument("--word-tokens", action="store_true", help="Count words instead of tokens (no tiktoken encodings needed)")
+    parser.add_argument("--output", help="Write the results to this JSON file")
+    parser.add_argument("--baseline", help="JSON results of a previous run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.2, help="Allowed slowdown of a stage against the baseline (0.2 = 20%%)")
+    parser.add_argument("--min-delta", type=float, default=5.0, help="Slowdowns below this many milliseconds are never regressions")
+    args = parser.parse_args()
+
+    logger.remove()
+    if args.word_tokens:
+        tokenizer.get_encoding = lambda model: WordEncoding()
+    cactus.get_provider = lambda model, **_: StubProvider(model, args.latency)
+    prompt.prompt = lambda *_, **__: "accept"
+
+    params = {key: getattr(args, key) for key in ("files", "hunks", "lines", "binaries", "renames", "seed", "model", "latency", "word_tokens")}
+    os.chdir(create_repo(**{key: params[key] for key in ("files", "hunks", "lines", "binaries", "renames", "seed")}))
+    diff_data = git_utils.get_git_diff(1)
+    ctx = {"model": args.model, "diff_data": diff_data, "diff_model": DiffModel.from_bytes(diff_data), "diff_text": diff_data.decode('utf-8', errors='replace')}
+    print(f"diff: {len(ctx['diff_model'].files)} files, {len(ctx['diff_model'].hunks)} hunks, {len(diff_data)} bytes")
+
+    results = run_stages(ctx, args.stages, args.repeat)
+    report = {
+        "version": cactus.__version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "params": params,
+        "stages": results,
+    }
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"Results written to {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        if baseline.get("params") != params:
+            print("WARNING: the baseline was measured with different parameters")
+        print(f"Comparing against {args.baseline} (threshold {args.threshold:.0%}):")
+        regressions = compare(results, baseline, args.threshold, args.min_delta)
+        if regressions:
+            print(f"FAIL: {', '.join(regressions)} got slower")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Generates throwaway git repositories with a staged diff of configurable shape.
+"""
+import os
+import random
+import subprocess
+import tempfile
+
+WORDS = ["value", "result", "config", "handler", "request", "buffer", "index", "parser", "token", "client", "cache"]
+
+
+def _git(repo, *args):
+    subprocess.run(["git", *args], cwd=repo, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _source_line(rng, i):
+    return f"    {rng.choice(WORDS)}_{i} = compute_{rng.choice(WORDS)}({rng.choice(WORDS)}, {i})\n"
+
+
+def _source_file(rng, lines):
+    content = []
+    for i in range(lines):
+        if i % 20 == 0:
+            content.append(f"def {rng.choice(WORDS)}_{i}():\n")
+        else:
+            content.append(_source_line(rng, i))
+    return content
+
+
+def create_repo(path=None, files=50, hunks=5, lines=200, seed=0, binaries=0, renames=0, binary_size=4096):
+    """
+    Creates a git repository with `files` python files of `lines` lines each, then stages
+    `hunks` separate modifications per file. `binaries` binary files are also modified and
+    `renames` of the python files are renamed instead of modified.
+    Returns the repository path.
+    """
+    rng = random.Random(seed)
+    repo = path or tempfile.mkdtemp(prefix="cactus_bench_")
+    _git(repo, "init", "-q")
+    _git(repo, "config", "user.email", "bench@cactus")
+    _git(repo, "config", "user.name", "bench")
+
+    contents = {}
+    for f in range(files):
+        file_path = os.path.join(f"pkg_{f % 10}", f"module_{f}.py")
+        os.makedirs(os.path.join(repo, os.path.dirname(file_path)), exist_ok=True)
+        contents[file_path] = _source_file(rng, lines)
+        with open(os.path.join(repo, file_path), "w", encoding="utf-8") as fd:
+            fd.writelines(contents[file_path])
+    for b in range(binaries):
+        with open(os.path.join(repo, f"asset_{b}.bin"), "wb") as fd:
+            fd.write(rng.randbytes(binary_size))
+    _git(repo, "add", "-A")
+    _git(repo, "commit", "-q", "-m", "initial")
+
+    # spread the modifications far enough apart so each one becomes its own hunk
+    step = max(lines // max(hunks, 1), 1)
+    renamed = list(contents)[:renames]
+    for file_path in renamed:
+        os.rename(os.path.join(repo, file_path), os.path.join(repo, file_path.replace("module_", "renamed_module_")))
+
+    for file_path, content in contents.items():
+        if file_path in renamed:
+            continue
+        for h in range(hunks):
+            line = min(h*step + step // 2, len(content) - 1)
+            content[line] = _source_line(rng, line).replace("compute_", "evaluate_")
+        with open(os.path.join(repo, file_path), "w", encoding="utf-8") as fd:
+            fd.writelines(content)
+    for b in range(binaries):
+        with open(os.path.join(repo, f"asset_{b}.bin"), "wb") as fd:
+            fd.write(rng.randbytes(binary_size))
+    _git(repo, "add", "-A")
+    return repo
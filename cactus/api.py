@@ -1,15 +1,33 @@
 import json
 import os
 import pprint
+import threading
+import time
+from contextlib import contextmanager
+from functools import lru_cache
 from loguru import logger
-import openai
-import tiktoken
 
-from constants import CLASSIFICATOR_SCHEMA_GEMINI, CLASSIFICATOR_SCHEMA_OPENAI, MODEL_TOKEN_LIMITS, PROMPT_CLASSIFICATOR_SYSTEM
+import profiling
+from tokenizer import count_tokens, count_tokens_batch
+from constants import MODEL_TOKEN_LIMITS, PROMPT_CLASSIFICATOR_REPAIR, PROMPT_CLASSIFICATOR_SYSTEM
+from streaming import StreamAborted
 
-import google.generativeai as genai
-from google.generativeai import protos
-from google.generativeai.types import HarmCategory, HarmBlockThreshold
+# The provider SDKs take a long time to import, so they are only loaded once a request is made
+_api_keys = {}
+
+# Follow-up questions asked about misassigned hunks before asking again from scratch
+MAX_REPAIRS = 2
+# Requests from scratch before giving up, waiting RETRY_BACKOFF seconds (doubled each time) in between
+MAX_ATTEMPTS = 3
+RETRY_BACKOFF = 1.0
+# Share of the hunks that can be invalid or repeated in a streamed answer before it's aborted
+ABORT_RATIO = 0.1
+# Tokens of the context window left for the prompt and the answer when a diff is split in chunks
+CHUNK_HEADROOM = 2048
+# Chunks worth of a streamed diff bin-packed together
+CHUNK_WINDOW = 8
+
+_listener = threading.local()
 
 
 def setup_api_key(api_type):
@@ -31,57 +49,176 @@ def load_api_key(api_type):
         return None
 
 
+def configure_api_key(api_type, api_key):
+    """
+    Stores the API key to be used once the provider SDK is actually needed.
+    """
+    _api_keys[api_type] = api_key
+
+
+@lru_cache(maxsize=None)
+def get_genai():
+    import google.generativeai as genai
+    genai.configure(api_key=_api_keys.get("Gemini"))
+    return genai
+
+
+@lru_cache(maxsize=None)
+def get_openai(base_url=None):
+    """
+    Returns the client of the server at `base_url` (OpenAI's by default) shared by every thread,
+    which keeps its HTTP connections open between requests. Failed requests are retried by the
+    provider layer, not by the SDK.
+    """
+    import openai
+    return openai.OpenAI(api_key=_api_keys.get("OpenAI"), base_url=base_url, max_retries=0)
+
+
 def num_tokens_from_string(text, model):
     """Return the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        # print("Warning: model not found. Using gpt-4-0613 encoding.")
-        model = "gpt-4-0613"
-        encoding = tiktoken.encoding_for_model(model)
-
     tokens_per_message = 4 # every message follows <|start|>{role/name}\n{content}<|end|>\n
     tokens_per_name = 1    # if there's a name, the role is omitted
                            # raise NotImplementedError(f"num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens.")
-    num_tokens = len(encoding.encode(text))
+    num_tokens = count_tokens(text, model)
     num_tokens += 3        # every reply is primed with <|start|>assistant<|message|>
     num_tokens += tokens_per_message + tokens_per_name
     return num_tokens
 
 
-def split_into_chunks(text, model="gpt-4o"):
+def diff_sections(lines):
+    """
+    Splits the lines of a diff into files, returning for each one the range of its header (the
+    lines before its first hunk, or anything before the first file) and the ranges of its hunks.
+    """
+    files = []
+    for i, line in enumerate(lines):
+        if line.startswith("diff --git ") or not files:
+            files.append([(i, i), []])
+        elif line.startswith("@@"):
+            files[-1][1].append((i, i))
+    # every section ends where the next one starts
+    starts = [start for header, hunks in files for start, _ in [header, *hunks]] + [len(lines)]
+    ends = iter(starts[1:])
+    return [((header[0], next(ends)), [(start, next(ends)) for start, _ in hunks]) for header, hunks in files]
+
+
+def split_into_chunks(text, model="gpt-4o", headroom=CHUNK_HEADROOM):
     """
-    Split the text into chunks of the specified size.
+    Splits a diff into as few chunks as possible that fit in the model context window, minus
+    `headroom` tokens left for the prompt and the answer. Files are bin-packed whole, biggest
+    first. A file that doesn't fit in the room left by any chunk is split between hunks, with its
+    header repeated in every piece, and only a hunk too big on its own is split between lines
+    (repeating its @@ line). Every chunk lists its pieces in the order of the diff.
     """
-    max_tokens = MODEL_TOKEN_LIMITS.get(model, 127514) - 64 # Default to 127514 if model not found
-    tokens = text.split('\n')
-    chunks, current_chunk, current_length = [], [], 0
+    lines = text.split('\n')
+    # count all lines in one batch, every line costs one extra token for its newline
+    costs = [length + 1 for length in count_tokens_batch(lines, model)]
+    return [chunk for chunk, _ in pack_chunks(lines, costs, get_chunk_budget(model, headroom))]
+
 
-    for token in tokens:
-        token_length = num_tokens_from_string(token, model)
-        if current_length + token_length > max_tokens:
-            chunks.append('\n'.join(current_chunk))
-            current_chunk, current_length = [], 0
-        current_chunk.append(token)
-        current_length += token_length
+def iter_chunks(records, model="gpt-4o", headroom=CHUNK_HEADROOM, window=CHUNK_WINDOW):
+    """
+    Like split_into_chunks, for a diff read as file records (lists of lines, see
+    git_utils.read_file_diffs) that are only consumed as needed. Files are bin-packed `window`
+    chunks worth at a time, so at most that much of the diff is held in memory (the lines aren't
+    memoized by the tokenizer either). The emptiest chunk of every window is packed again with
+    the next one instead of being sent.
+    """
+    max_tokens = get_chunk_budget(model, headroom)
+    lines, costs, tokens = [], [], 0
+    for record in records:
+        record_costs = [length + 1 for length in count_tokens_batch(record, model, memo=False)]
+        lines += record
+        costs += record_costs
+        tokens += sum(record_costs)
+        if tokens >= window * max_tokens:
+            chunks = pack_chunks(lines, costs, max_tokens)
+            emptiest = min(range(len(chunks)), key=lambda ix: chunks[ix][1])
+            yield from (chunk for ix, (chunk, _) in enumerate(chunks) if ix != emptiest)
+            lines = chunks[emptiest][0].split('\n')
+            costs = [length + 1 for length in count_tokens_batch(lines, model, memo=False)]
+            tokens = sum(costs)
+    if lines:
+        yield from (chunk for chunk, _ in pack_chunks(lines, costs, max_tokens))
 
-    if current_chunk:
-        chunks.append('\n'.join(current_chunk))
 
-    return chunks
+def get_chunk_budget(model, headroom):
+    return max(MODEL_TOKEN_LIMITS.get(model, 127514) - headroom, 1) # Default to 127514 if model not found
+
+
+def pack_chunks(lines, costs, max_tokens):
+    """
+    Bin-packs the files and hunks of a diff, given as its lines and their tokens, into chunks of
+    at most `max_tokens` tokens (see split_into_chunks). Returns every chunk with its tokens.
+    """
+    # every file as its header and the segments that can't be split, as line ranges with their tokens
+    files = []
+    for header, hunks in diff_sections(lines):
+        header_tokens = sum(costs[header[0]:header[1]])
+        segments = []
+        for start, end in hunks:
+            hunk_tokens = sum(costs[start:end])
+            if header_tokens + hunk_tokens <= max_tokens:
+                segments.append(([(start, end)], hunk_tokens))
+                continue
+            line_start, part_tokens = start + 1, costs[start]
+            for i in range(start + 1, end):
+                if i > line_start and header_tokens + part_tokens + costs[i] > max_tokens:
+                    segments.append(([(start, start + 1), (line_start, i)], part_tokens))
+                    line_start, part_tokens = i, costs[start]
+                part_tokens += costs[i]
+            segments.append(([(start, start + 1), (line_start, end)], part_tokens))
+        files.append((header, header_tokens, segments))
+
+    # chunks as [tokens, {file: segments}], first fit decreasing with whole files when they fit
+    # in a chunk, and with their segments otherwise (each chunk paying for the header once)
+    chunks = []
+    order = sorted(range(len(files)), key=lambda ix: -(files[ix][1] + sum(tokens for _, tokens in files[ix][2])))
+    for file_ix in order:
+        header, header_tokens, segments = files[file_ix]
+        tokens = header_tokens + sum(tokens for _, tokens in segments)
+        target = next((chunk for chunk in chunks if chunk[0] + tokens <= max_tokens), None)
+        if target is not None or not segments:
+            if target is None:
+                target = [0, {}]
+                chunks.append(target)
+            target[0] += tokens
+            target[1][file_ix] = list(range(len(segments)))
+            continue
+        for segment_ix in sorted(range(len(segments)), key=lambda ix: -segments[ix][1]):
+            cost = lambda chunk: segments[segment_ix][1] + (0 if file_ix in chunk[1] else header_tokens)
+            target = next((chunk for chunk in chunks if chunk[0] + cost(chunk) <= max_tokens), None)
+            if target is None:
+                target = [0, {}]
+                chunks.append(target)
+            target[0] += cost(target)
+            target[1].setdefault(file_ix, []).append(segment_ix)
+
+    return [('\n'.join(
+        line for file_ix, segment_ixs in sorted(chunk[1].items())
+        for start, end in [files[file_ix][0], *(line_range for ix in sorted(segment_ixs) for line_range in files[file_ix][2][ix][0])]
+        for line in lines[start:end]), chunk[0]) for chunk in chunks]
+
+
+def get_prompt_instructions(clusters_n, hunks_n):
+    return ("\n## PROMPT\nGroup the hunks above into " + (f"exactly **{clusters_n}** commits" if clusters_n else "at least 1 commit")
+            + f" encompassing logically related hunks each, for all the **{hunks_n}** hunks above. Use every single hunk once and only once."
+            + " Closely follow the instructions and format the output as a JSON array of commits.")
 
 
 def get_initial_messages(prompt_data, clusters_n, hunks_n, model) -> list:
+    """
+    Returns the messages of a grouping request. The instructions, the only part that changes
+    between the steps of a run, come last in their own message so the rest is a cacheable prefix.
+    """
+    instructions = {"role": "user", "content": get_prompt_instructions(clusters_n, hunks_n)}
     if "o1" in model:
         return [
             {
                 "role": "user",
-                "content": PROMPT_CLASSIFICATOR_SYSTEM
-                    + prompt_data + "\n## PROMPT\nGroup the hunks above into " +
-                      (f"exactly **{clusters_n}** commits" if clusters_n else "at least 1 commit")
-                    + f" encompassing logically related hunks each, for all the **{hunks_n}** hunks above. Use every single hunk once and only once."
-                    + " Closely follow the instructions and format the output as a JSON array of commits."
+                "content": PROMPT_CLASSIFICATOR_SYSTEM + prompt_data
             },
+            instructions,
         ]
     else:
         return [
@@ -89,73 +226,166 @@ def get_initial_messages(prompt_data, clusters_n, hunks_n, model) -> list:
                 "role": "system", "content": PROMPT_CLASSIFICATOR_SYSTEM
             },
             {
-                "role": "user",
-                "content": prompt_data + "\n## PROMPT\nGroup the hunks above into " +
-                           (f"exactly **{clusters_n}** commits" if clusters_n else "at least 1 commit")
-                            + f" encompassing logically related hunks each, for all the **{hunks_n}** hunks above. Use every single hunk once and only once."
-                            + " Closely follow the instructions and format the output as a JSON array of commits."
+                "role": "user", "content": prompt_data
             },
+            instructions,
         ]
 
 
-def get_clusters_from_openai(prompt_data, clusters_n, hunks_n, model):
-    model_instance = openai.chat.completions.create(
-        model=model,
-        top_p=1,
-        temperature=1,
-        max_tokens=1024,
-        response_format={
-            "type": "json_schema", "json_schema": CLASSIFICATOR_SCHEMA_OPENAI
-        },                                                                        # type: ignore
-        messages=get_initial_messages(prompt_data, clusters_n, hunks_n, model))
-    logger.debug(get_initial_messages(prompt_data, clusters_n, hunks_n, model))
-    clusters = json.loads(model_instance.choices[0].message.content)["commits"]   # type: ignore
-    sum_hunks = sum([len(cluster['hunk_indices']) for cluster in clusters])
-    if sum_hunks != hunks_n:
-        logger.debug(pprint.pformat(clusters))
-        logger.warning(f"Expected {hunks_n} hunks, but got {sum_hunks}. Trying again.")
-        return get_clusters_from_openai(prompt_data, clusters_n, hunks_n, model)
-    return clusters
-
-
-def get_clusters_from_gemini(prompt_data, clusters_n, hunks_n, model):
-    model_instance = genai.GenerativeModel(
-        model_name=model,
-        generation_config={
-            "temperature": 1.1,
-            "top_p": 1,
-            "max_output_tokens": 4096,
-            "response_mime_type": "application/json",
-            "response_schema": CLASSIFICATOR_SCHEMA_GEMINI
-        },                                                                                 # type: ignore
-        safety_settings={
-            HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
-            HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE
-        },
-        system_instruction=PROMPT_CLASSIFICATOR_SYSTEM,
-    )
-
-    chat_session = model_instance.start_chat(history=[])
-
-    response = chat_session.send_message(
-        json.dumps(prompt_data) + "\n## PROMPT\nGroup the hunks above into " +
-               (f"exactly **{clusters_n}** commits" if clusters_n else "at least 1 commit")
-                + f" encompassing logically related hunks each, for all the **{hunks_n}** hunks above. Use every single hunk once and only once."
-                + " Closely follow the instructions and format the output as a JSON array of commits.")
-
-    # Check if response was blocked or has issues
-    if not response.candidates or not response.candidates[0].content.parts:
-        logger.error(f"Gemini API response was blocked or empty. Finish reason: {response.candidates[0].finish_reason if response.candidates else 'No candidates'}")
-        raise ValueError("Gemini API response was blocked or contained no valid content")
-
-    content = json.loads(response.candidates[0].content.parts[0].text)
-    clusters = content["commits"]
-
-    sum_hunks = sum([len(cluster['hunk_indices']) for cluster in clusters])
-    if sum_hunks != hunks_n:
-        logger.warning(f"Expected {hunks_n} hunks, but got {sum_hunks}. Trying again.")
-        logger.debug(pprint.pformat(clusters))
-        return get_clusters_from_gemini(prompt_data, clusters_n, hunks_n, model)
-    return clusters
+@contextmanager
+def commit_listener(callback):
+    """
+    Calls `callback` with every commit of the groupings requested by this thread in the block, as
+    soon as it's streamed. Requests made by other threads (speculative ones, shards) stay silent.
+    """
+    previous = getattr(_listener, "callback", None)
+    _listener.callback = callback
+    try:
+        yield
+    finally:
+        _listener.callback = previous
+
+
+def get_hunk_indices(commit):
+    """
+    Returns the hunk indices of a commit of the answer as a list. They are whatever the model
+    wrote, so a single value is wrapped and the values may not even be hashable.
+    """
+    indices = commit.get("hunk_indices", [])
+    return indices if isinstance(indices, list) else [indices]
+
+
+def is_hunk_index(index, hunks_n):
+    # bools are ints too
+    return isinstance(index, int) and not isinstance(index, bool) and 1 <= index <= hunks_n
+
+
+class StreamChecker:
+    """
+    Checks the commits of an answer while it's streamed, aborting it as soon as it's obviously
+    broken: too many hunks that don't exist or are used twice, or more commits than asked for.
+    The hunks that are simply missing can only be known at the end.
+    """
+    def __init__(self, hunks_n, clusters_n=None, callback=None):
+        self.hunks_n = hunks_n
+        self.clusters_n = clusters_n
+        self.callback = callback
+        self.limit = max(int(hunks_n * ABORT_RATIO), 2)
+        self.seen = set()
+        self.errors = 0
+        self.commits = 0
+
+    def __call__(self, commit):
+        self.commits += 1
+        for index in get_hunk_indices(commit):
+            if not is_hunk_index(index, self.hunks_n) or index in self.seen:
+                self.errors += 1
+            else:
+                self.seen.add(index)
+        if self.errors > self.limit:
+            raise StreamAborted(f"{self.errors} hunks don't exist or are used twice")
+        if self.clusters_n and self.commits > self.clusters_n:
+            raise StreamAborted(f"more than the {self.clusters_n} commits asked for")
+        if self.callback:
+            self.callback(commit)
+
+
+def check_clusters(clusters, hunks_n):
+    """
+    Drops the invalid hunk indices (out of range or not integers) and the ones repeated within a
+    commit. Returns the cleaned clusters, the missing indices, the indices used by several commits
+    (with the positions of those commits) and the invalid indices.
+    """
+    cleaned, invalid, used = [], [], {}
+    for position, cluster in enumerate(clusters):
+        indices = []
+        for index in get_hunk_indices(cluster):
+            if not is_hunk_index(index, hunks_n):
+                invalid.append(index)
+            elif index not in indices:
+                indices.append(index)
+                used.setdefault(index, []).append(position)
+        cleaned.append({**cluster, "hunk_indices": indices})
+    missing = [index for index in range(1, hunks_n + 1) if index not in used]
+    duplicated = {index: positions for index, positions in used.items() if len(positions) > 1}
+    return cleaned, missing, duplicated, invalid
+
+
+def get_repair_prompt(clusters, clusters_n, hunks_n, missing, duplicated, invalid):
+    problems = []
+    if missing:
+        problems.append(f"- Missing from every commit: hunks {', '.join(map(str, missing))}.")
+    for index, positions in sorted(duplicated.items()):
+        messages = ", ".join(json.dumps(clusters[position]["message"]) for position in positions)
+        problems.append(f"- Hunk {index} is in several commits: {messages}. Choose only one of them.")
+    if invalid:
+        problems.append(f"- These hunks do not exist, there are only {hunks_n} hunks: {', '.join(map(str, invalid))}.")
+    return PROMPT_CLASSIFICATOR_REPAIR.format(
+        problems="\n".join(problems),
+        hunks=", ".join(map(str, sorted(set(missing) | set(duplicated)))),
+        new_commits=f" (there must still be exactly {clusters_n} commits)" if clusters_n else ", or write a new message to create a new commit")
+
+
+def apply_repair(clusters, repair, repaired):
+    """
+    Moves every repaired hunk to the commit the model put it in: the one with the same message, or
+    a new commit. Commits left without hunks are dropped.
+    """
+    clusters = [{**cluster, "hunk_indices": list(cluster["hunk_indices"])} for cluster in clusters]
+    by_message = {cluster["message"].strip().lower(): cluster for cluster in clusters}
+    for commit in repair:
+        indices = [index for index in get_hunk_indices(commit) if isinstance(index, int) and not isinstance(index, bool) and index in repaired]
+        if not indices:
+            continue
+        for cluster in clusters:
+            cluster["hunk_indices"] = [index for index in cluster["hunk_indices"] if index not in indices]
+        target = by_message.get(commit.get("message", "").strip().lower())
+        if target is None:
+            target = {"message": commit.get("message", ""), "hunk_indices": []}
+            by_message[target["message"].strip().lower()] = target
+            clusters.append(target)
+        target["hunk_indices"] = sorted(target["hunk_indices"] + indices)
+    return [cluster for cluster in clusters if cluster["hunk_indices"]]
+
+
+def get_clusters(provider, prompt_data, clusters_n, hunks_n):
+    """
+    Asks the provider to group the hunks. The answer is checked while it's streamed and aborted
+    early if it's obviously broken. When it misses, repeats or makes up hunks, a short follow-up
+    in the same conversation asks about those hunks only, and the whole request is only sent
+    again (with backoff) if that didn't fix it.
+    """
+    with profiling.span("llm", model=provider.model, prompt_bytes=len(prompt_data)) as span:
+        for attempt in range(MAX_ATTEMPTS):
+            if attempt:
+                span.add(retries=1)
+                time.sleep(RETRY_BACKOFF * 2**(attempt - 1))
+            try:
+                checker = StreamChecker(hunks_n, clusters_n, getattr(_listener, "callback", None))
+                answer = provider.cluster(prompt_data, clusters_n, hunks_n, on_commit=checker)
+            except StreamAborted as e:
+                logger.warning(f"Aborted the answer after {checker.commits} commits: {e}.")
+                span.add(aborts=1)
+                continue
+            clusters, follow_ups = answer, []
+            for repairs in range(MAX_REPAIRS + 1):
+                clusters, missing, duplicated, invalid = check_clusters(clusters, hunks_n)
+                # a repair can add commits (new messages) or drop the ones it emptied
+                if repairs and clusters_n and len(clusters) != clusters_n:
+                    logger.warning(f"The repaired answer has {len(clusters)} commits instead of {clusters_n}.")
+                    break
+                if not missing and not duplicated:
+                    return clusters
+                logger.warning(f"The model misassigned some hunks: {len(missing)} missing, {len(duplicated)} in several commits, "
+                               f"{len(invalid)} invalid.")
+                logger.debug(pprint.pformat(clusters))
+                if repairs == MAX_REPAIRS:
+                    break
+                span.add(repairs=1)
+                follow_ups.append((json.dumps({"commits": answer}),
+                                   get_repair_prompt(clusters, clusters_n, hunks_n, missing, duplicated, invalid)))
+                answer = provider.cluster(prompt_data, clusters_n, hunks_n, follow_ups=follow_ups)
+                clusters = apply_repair(clusters, answer, set(missing) | set(duplicated))
+            if attempt < MAX_ATTEMPTS - 1:
+                logger.warning("Could not fix the answer. Trying again.")
+        raise Exception(f"The model failed to use every hunk exactly once after {MAX_ATTEMPTS} attempts")
@@ -0,0 +1,201 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from loguru import logger
+
+from constants import (CACHE_SCHEMA_VERSION, CHANGELOG_PROMPT_VERSION, PROMPT_CHANGELOG_COMMIT, PROMPT_CHANGELOG_COMMITS,
+                       PROMPT_CHANGELOG_GENERATOR, PROMPT_CHANGELOG_MERGE, PROMPT_CHANGELOG_SYSTEM, PROMPT_CLASSIFICATOR_SYSTEM,
+                       PROMPT_FORMAT_VERSION)
+
+CACHE_DIR = os.path.join(os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")), "cactus")
+CACHE_MAX_BYTES = 64 * 1024 * 1024
+CACHE_MAX_AGE = 14 * 24 * 60 * 60
+
+
+class ResponseCache:
+    """
+    Content-addressed on-disk cache of model responses.
+
+    Entries are plain JSON files named after their key. Reading an entry refreshes its mtime, so
+    eviction (oldest first, once entries are too old or the cache grows too big) is LRU.
+    """
+    def __init__(self, path=None, max_bytes=CACHE_MAX_BYTES, max_age=CACHE_MAX_AGE):
+        self.path = os.path.join(path or CACHE_DIR, "responses")
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    @staticmethod
+    def key(prompt_data, model, clusters_n):
+        key_data = json.dumps({
+            "schema": CACHE_SCHEMA_VERSION,
+            "format": PROMPT_FORMAT_VERSION,
+            "system": hashlib.sha256(PROMPT_CLASSIFICATOR_SYSTEM.encode('utf-8')).hexdigest(),
+            "prompt": hashlib.sha256(prompt_data.encode('utf-8', errors='replace')).hexdigest(),
+            "model": model,
+            "clusters_n": clusters_n or 0,
+        }, sort_keys=True)
+        return hashlib.sha256(key_data.encode('utf-8')).hexdigest()
+
+    def _entry_path(self, key):
+        return os.path.join(self.path, f"{key}.json")
+
+    def get(self, key):
+        entry_path = self._entry_path(key)
+        try:
+            if time.time() - os.path.getmtime(entry_path) > self.max_age:
+                os.remove(entry_path)
+                return None
+            with open(entry_path, "r", encoding='utf-8') as f:
+                value = json.load(f)
+            os.utime(entry_path)
+            return value
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.debug(f"Ignoring unreadable cache entry {entry_path}: {e}")
+            return None
+
+    def put(self, key, value):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            tmp_path = f"{self._entry_path(key)}.{os.getpid()}.tmp"
+            with open(tmp_path, "w", encoding='utf-8') as f:
+                json.dump(value, f)
+            os.replace(tmp_path, self._entry_path(key))
+        except OSError as e:
+            logger.debug(f"Failed to write cache entry: {e}")
+            return
+        self.evict()
+
+    def evict(self):
+        try:
+            entries = []
+            for entry in os.scandir(self.path):
+                if entry.name.endswith(".json"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.path))
+        except OSError:
+            return
+
+        now = time.time()
+        total_bytes = sum(size for _, size, _ in entries)
+        for mtime, size, entry_path in sorted(entries):
+            if now - mtime <= self.max_age and total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(entry_path)
+                total_bytes -= size
+            except OSError:
+                pass
+
+
+class SummaryStore:
+    """
+    SQLite store of the changelog summaries of single commits, keyed by commit SHA, model, prompt
+    version and diff options, and of the answers to the merges of those summaries. Commits never
+    change, so summaries don't expire; changing the prompts changes their key instead.
+    """
+    # number of SHAs looked up by a single query, under SQLite's limit of bound parameters
+    BATCH_SIZE = 500
+
+    def __init__(self, path=None):
+        self.path = os.path.join(path or CACHE_DIR, "changelog.sqlite3")
+        self.prompt = self.prompt_version()
+        self.lock = threading.Lock()
+        self.db = None
+
+    @staticmethod
+    def prompt_version():
+        prompts = "\n".join((PROMPT_CHANGELOG_SYSTEM, PROMPT_CHANGELOG_GENERATOR, PROMPT_CHANGELOG_COMMITS, PROMPT_CHANGELOG_COMMIT,
+                              PROMPT_CHANGELOG_MERGE))
+        return f"{CHANGELOG_PROMPT_VERSION}:{hashlib.sha256(prompts.encode('utf-8')).hexdigest()[:16]}"
+
+    def _connect(self):
+        if self.db is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            # shared by the changelog threads, every access holds the lock
+            self.db = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self.db.execute("PRAGMA journal_mode=WAL")
+            self.db.execute("CREATE TABLE IF NOT EXISTS summaries (sha TEXT, model TEXT, prompt TEXT, options TEXT, summary TEXT, created REAL,"
+                            " PRIMARY KEY (sha, model, prompt, options))")
+            self.db.execute("CREATE TABLE IF NOT EXISTS merges (key TEXT PRIMARY KEY, summary TEXT, created REAL)")
+        return self.db
+
+    def get_summaries(self, shas, model, options):
+        """
+        Returns the stored summaries of the given commits, by SHA.
+        """
+        summaries = {}
+        try:
+            with self.lock:
+                db = self._connect()
+                for i in range(0, len(shas), self.BATCH_SIZE):
+                    batch = shas[i:i + self.BATCH_SIZE]
+                    rows = db.execute(
+                        f"SELECT sha, summary FROM summaries WHERE model = ? AND prompt = ? AND options = ? AND sha IN ({', '.join('?' * len(batch))})",
+                        (model, self.prompt, options, *batch))
+                    summaries.update(rows)
+        except sqlite3.Error as e:
+            logger.debug(f"Failed to read the changelog store {self.path}: {e}")
+        return summaries
+
+    def put_summary(self, sha, model, options, summary):
+        self._write("INSERT OR REPLACE INTO summaries VALUES (?, ?, ?, ?, ?, ?)", (sha, model, self.prompt, options, summary, time.time()))
+
+    def merge_key(self, model, changelogs):
+        key_data = json.dumps({"prompt": self.prompt, "model": model, "changelogs": changelogs})
+        return hashlib.sha256(key_data.encode('utf-8', errors='replace')).hexdigest()
+
+    def get_merge(self, model, changelogs):
+        """
+        Returns the stored merge of the given changelogs, or None.
+        """
+        try:
+            with self.lock:
+                row = self._connect().execute("SELECT summary FROM merges WHERE key = ?", (self.merge_key(model, changelogs),)).fetchone()
+        except sqlite3.Error as e:
+            logger.debug(f"Failed to read the changelog store {self.path}: {e}")
+            return None
+        return row[0] if row else None
+
+    def put_merge(self, model, changelogs, summary):
+        self._write("INSERT OR REPLACE INTO merges VALUES (?, ?, ?)", (self.merge_key(model, changelogs), summary, time.time()))
+
+    def _write(self, query, values):
+        # committed right away, so an interrupted run keeps what it paid for
+        try:
+            with self.lock:
+                db = self._connect()
+                db.execute(query, values)
+                db.commit()
+        except sqlite3.Error as e:
+            logger.debug(f"Failed to write to the changelog store {self.path}: {e}")
+
+
+def with_cache(get_clusters_func, model, cache=None):
+    """
+    Wraps a clustering function so identical requests are answered from the cache.
+    Passing refresh=True skips the lookup, and store=False keeps the response out of the cache
+    until it's explicitly stored with `get_clusters.store`.
+    """
+    def store_clusters(prompt_data, clusters_n, clusters):
+        if cache is not None:
+            cache.put(cache.key(prompt_data, model, clusters_n), clusters)
+
+    def get_clusters(prompt_data, clusters_n, refresh=False, store=True):
+        if cache is not None and not refresh:
+            clusters = cache.get(cache.key(prompt_data, model, clusters_n))
+            if clusters is not None:
+                logger.info("Using cached response for the staged changes.")
+                return clusters
+
+        clusters = get_clusters_func(prompt_data, clusters_n=clusters_n)
+        if store:
+            get_clusters.store(prompt_data, clusters_n, clusters)
+        return clusters
+
+    get_clusters.store = store_clusters
+    return get_clusters
@@ -5,6 +5,7 @@ CACTUS Automates Commits Through Uncomplicated Suggestions
 __version__ = "4.6.1"
 
 import argparse
+import atexit
 from functools import partial
 import json
 import re
@@ -12,188 +13,160 @@ import sys
 import time
 from loguru import logger
 
-import openai
-import google.generativeai as genai
-
 import os  # Added to handle relative imports
 
 sys.path.append(os.path.dirname(os.path.dirname(os.path.realpath(__file__))))  # Add
 
-from api import get_clusters_from_gemini, get_clusters_from_openai, load_api_key, setup_api_key, num_tokens_from_string
-from changelog import generate_changelog
+from api import CHUNK_HEADROOM, configure_api_key, get_clusters, load_api_key, setup_api_key
 from utils import setup_logging
-from git_utils import run, get_git_diff, restore_changes, parse_diff, stage_changes
-from grouper import parse_diff, stage_changes
-
-from unidiff import PatchSet
-from loguru import logger
+import profiling
+from git_utils import CommitBuilder, get_git_diff, get_session
+from diff_model import DiffModel
+from cache import ResponseCache, with_cache
+from prefetch import Prefetcher
+from providers import configure_limits, get_provider
+from tokenizer import count_tokens, count_tokens_batch
+from sharding import ShardedClusterer, get_prompt_budget
+from context import FileContext, format_line_ranges, plan_context, read_files, staged_paths
 
-from prompt_toolkit.shortcuts import print_formatted_text
-from prompt_toolkit.formatted_text import FormattedText
-from prompt_toolkit.styles import Style
-from prompt import display_clusters, handle_user_input
 
 
-def extract_patches(diff_data):
+def extract_patches(diff_model):
     """
-    Extracts individual hunks from the diff data and returns a list of binary patches.
-    Correctly formats the diff headers, handling scenarios like added or deleted files.
+    Returns the list of binary patches, one per hunk of the diff model.
+    Binary files and files without hunks yield a header-only patch.
     """
-    diff_text = diff_data.decode('latin-1')
-    patches = []
-
-    try:
-        patch_set = PatchSet.from_string(diff_text)
-    except Exception as e:
-        logger.error(f"Failed to parse diff data: {e}")
-        return []
-
-    for patched_file in patch_set:
-        logger.debug(f"Processing file: {patched_file.path} with {len(patched_file)} hunks")
-
-        file_headers = []
-        file_headers.append(str("".join(list(patched_file.patch_info)[:-1])).strip())
-
-        if patched_file.is_modified_file:
-            file_headers.append(f'--- {patched_file.source_file}')
-            file_headers.append(f'+++ {patched_file.target_file}')
-
-        file_header_text = '\n'.join(file_headers)
-
-        if patched_file.is_binary_file:
-            logger.info(f"Skipping binary file {patched_file.path}")
-            patch_bytes = file_header_text.encode('latin-1')
-            patches.append(patch_bytes)
-            continue  # Skip binary files
-
-        if len(patched_file) == 0:
-            logger.info(f"No hunks found for {patched_file.path}.")
-            patch_bytes = file_header_text.encode('latin-1')
-            patches.append(patch_bytes)
-            continue
-
-        for i, hunk in enumerate(patched_file):
-            logger.debug(f"  Hunk {i+1}: {len(str(hunk).splitlines())} lines")
-            hunk_text = str(hunk)
-            patch_text = file_header_text + '\n' + hunk_text
-            patch_bytes = patch_text.encode('latin-1')
-            patches.append(patch_bytes)
-
-    logger.debug(f"Total patches created: {len(patches)}")
+    patches = diff_model.patches
+    logger.debug(f"Total patches extracted: {len(patches)}")
     return patches
 
 
-
-def get_file_token_counts(diff_data, model):
+def get_file_token_counts(diff_model, model):
     """
     Calculate token counts for each file's diff content.
     Returns a list of tuples (file_path, token_count) sorted by token count.
     """
-    diff_text = diff_data.decode('latin-1')
-    file_token_counts = []
-
-    try:
-        patch_set = PatchSet.from_string(diff_text)
-    except Exception as e:
-        logger.error(f"Failed to parse diff data: {e}")
-        return []
-
-    for patched_file in patch_set:
-        file_path = patched_file.path
-        file_diff_content = []
-
-        for hunk in patched_file:
-            hunk_lines = [line.encode('latin-1').decode('utf-8', errors='replace') for line in str(hunk).splitlines()]
-            file_diff_content.extend(hunk_lines)
-
-        if file_diff_content:
-            diff_text_for_file = '\n'.join(file_diff_content)
-            token_count = num_tokens_from_string(diff_text_for_file, model)
-            file_token_counts.append((file_path, token_count))
+    diff_files = [diff_file for diff_file in diff_model.files if diff_file.diff_text]
+    token_counts = count_tokens_batch([diff_file.diff_text for diff_file in diff_files], model)
+    file_token_counts = [(diff_file.path, token_count) for diff_file, token_count in zip(diff_files, token_counts)]
 
     # Sort by token count (ascending order)
     file_token_counts.sort(key=lambda x: x[1])
     return file_token_counts
 
 
-def prepare_prompt_data(diff_data):
+def describe_file(diff_file):
+    if diff_file.is_binary:
+        return f"{diff_file.path} (binary)"
+    if diff_file.is_added:
+        return f"{diff_file.path} (added)"
+    if diff_file.is_removed:
+        return f"{diff_file.path} (deleted)"
+    if diff_file.is_rename:
+        source = diff_file.source_file[2:] if diff_file.source_file.startswith("a/") else diff_file.source_file
+        return f"{diff_file.path} (renamed from {source})"
+    return diff_file.path
+
+
+def render_hunk(hunk, diff_file, file_context):
     """
-    Prepares the prompt data in specific format from the diff data.
+    Returns the lines of a hunk in the prompt. When the file lines it touches are shown, the
+    lines it adds are referenced by number and only the removed lines are written out.
     """
-    diff_text = diff_data.decode('latin-1')
-    file_data = []
-    hunk_data = []
+    if hunk.is_header_only:
+        return [f"\n### HUNK {hunk.index}: {'binary content changed' if diff_file.is_binary else 'no content changes'}"]
+
+    header = f"\n### HUNK {hunk.index}"
+    end = hunk.target_start + hunk.target_length - 1
+    shown = hunk.target_length > 0 and file_context.shows(hunk.target_start, end)
+    if hunk.target_length:
+        header += f", lines {hunk.target_start}-{end}"
+    if not shown:
+        # the file doesn't show these lines (deleted or binary file, no room left for context)
+        return [header] + hunk.lines[1:]
+    if hunk.added_lines:
+        header += f", adds {format_line_ranges(hunk.added_lines)}"
+    return [header] + [line for line in hunk.lines[1:] if line.startswith('-')]
+
+
+def prepare_prompt_data(diff_model, context_plan=None):
+    """
+    Prepares the prompt data (format PROMPT_FORMAT_VERSION) from the diff model: every file once
+    with its numbered lines, followed by its hunks. Only the windows of the context plan are
+    included, or whole files without one.
+    """
+    prompt_data = []
+    files = read_files(staged_paths(diff_model)) if not context_plan else {}
+
+    for diff_file in diff_model.files:
+        file_context = context_plan[diff_file.path] if context_plan else FileContext(*files.get(diff_file.path, ([], False)))
+        added = {number for hunk in diff_file.hunks for number in hunk.added_lines}
+        prompt_data.append(f"\n## FILE {describe_file(diff_file)}")
+        prompt_data.extend(file_context.render(added))
+        for hunk in diff_file.hunks:
+            prompt_data.extend(render_hunk(hunk, diff_file, file_context))
 
-    try:
-        patch_set = PatchSet.from_string(diff_text)
-    except Exception as e:
-        logger.error(f"Failed to parse diff data: {e}")
-        return ""
-
-    hunk_index = 1
-    # Prepare files and hunks section
-    for patched_file in patch_set:
-        file_path = patched_file.path
-        file_data.append(f"\n# FILE: {file_path}")
-        try:
-            with open(file_path, 'r', encoding='utf-8') as f:
-                content_lines = f.readlines()
-        except UnicodeDecodeError:
-                logger.warning(f"Failed to read file {file_path} due to binary content.")
-                content_lines = ["### [BINARY FILE]"]
-        except FileNotFoundError:
-                logger.warning(f"File not found: {file_path}")
-                content_lines = ["### File Not Found"]
-
-        for line in content_lines:
-            line = line.rstrip('\n')
-            file_data.append(f"FILE: {line}")
-
-        for hunk in patched_file:
-            hunk_lines = [line.encode('latin-1').decode('utf-8', errors='replace') for line in str(hunk).splitlines()]
-            hunk_data.append(f"\n## HUNK {hunk_index} ({file_path})")
-            for line in hunk_lines:
-                hunk_data.append(f"HUNK: {line}")
-            hunk_index += 1
-
-    prompt_data = file_data + hunk_data
     return "\n".join(prompt_data)
 
 
-def generate_commits(all_hunks, clusters, previous_sha, full_diff):
-    for cluster in clusters:
-        try:
-            stage_changes([all_hunks[i - 1] for i in cluster["hunk_indices"]])
-        except Exception as e:
-            logger.error(f"Failed to stage changes: {e}. Restoring changes.")
-            # TODO: this is wrong, we should be restoring the entire
-            #       repository to the original state before cactus ran
-            #       if some commits worked and this failed afterwards
-            run(f"git reset {previous_sha}")
-            restore_changes(full_diff)
-            sys.exit(1)
+def generate_commits(diff_model, clusters, run_hooks=True):
+    """
+    Creates one commit per cluster. The commits are built in a temporary index and HEAD is only
+    updated once all of them succeeded, so on failure the repository and the staged changes are
+    left untouched.
+    """
+    all_hunks = extract_patches(diff_model)
+    session = get_session()
+    if run_hooks and not session.run_hook("pre-commit"):
+        logger.error("The pre-commit hook failed, no commits were created.")
+        sys.exit(1)
 
-        logger.info(f"Auto-committing: {cluster['message']}")
-        if run(f"git commit -m '{cluster['message']}'").returncode != 0:
-            logger.error("Failed to commit changes. Restoring changes.")
-            run(f"git reset {previous_sha}")
-            restore_changes(full_diff)
-            sys.exit(1)
+    builder = CommitBuilder(session, run_hooks=run_hooks)
+    try:
+        for cluster in clusters:
+            if not cluster["hunk_indices"]:
+                logger.warning(f"Skipping commit without hunks: {cluster['message']}")
+                continue
+            logger.info(f"Auto-committing: {cluster['message']}")
+            builder.add_commit([all_hunks[i - 1] for i in cluster["hunk_indices"]], cluster["message"])
+        builder.update_head()
+    except Exception as e:
+        logger.error(f"Failed to create the commits: {e}. No changes were made.")
+        sys.exit(1)
+    finally:
+        builder.close()
 
+    if run_hooks:
+        session.run_hook("post-commit")
 
-def generate_changes(args):
-    previous_sha = run("git rev-parse --short HEAD").stdout
-    full_diff = get_git_diff(args.context_size)
-    patches = extract_patches(full_diff)
-    prompt_data = prepare_prompt_data(full_diff)
 
-    # Debug logging
-    logger.debug(f"Total patches extracted: {len(patches)}")
+def generate_changes(args):
+    with profiling.span("git diff") as span:
+        diff_data = get_git_diff(args.context_size)
+        span.add(bytes=len(diff_data))
+
+    # Parse the staged diff only once, every stage below works on the same model
+    with profiling.span("parse diff") as span:
+        diff_model = DiffModel.from_bytes(diff_data)
+        patches = extract_patches(diff_model)
+        span.add(files=len(diff_model.files), hunks=len(patches))
+
+    # Only windows of the touched files fitting the model budget are sent (the tokenizer may not be available offline)
+    with profiling.span("plan context") as span:
+        context_plan = plan_context(diff_model, args.model) if not args.offline else None
+        span.add(tokens=sum(file_context.tokens for file_context in context_plan.values()) if context_plan else 0)
+
+    # nothing is sent offline, so the touched files aren't even read
+    with profiling.span("build prompt") as span:
+        prompt_data = prepare_prompt_data(diff_model, context_plan) if not args.offline else ""
+        span.add(bytes=len(prompt_data))
 
     # Display file token counts before clustering
-    file_token_counts = get_file_token_counts(full_diff, args.model)
+    with profiling.span("count file tokens") as span:
+        file_token_counts = get_file_token_counts(diff_model, args.model) if not args.offline else []
+        span.add(tokens=sum(token_count for _, token_count in file_token_counts))
     if file_token_counts:
-        logger.info("Token usage by file (diff content only):")
+        logger.info("Token usage by file (diff content, and file context sent out of the whole file):")
 
         # Calculate the maximum file path length for alignment
         max_path_length = max(len(file_path) for file_path, _ in file_token_counts)
@@ -201,21 +174,55 @@ def generate_changes(args):
         for file_path, token_count in file_token_counts:
             # Use colored output with aligned columns
             padded_path = file_path.ljust(max_path_length)
-            print(f"  \033[36m{padded_path}\033[0m : \033[33m{token_count:>6}\033[0m tokens")
+            file_context = context_plan[file_path]
+            saved = 1 - file_context.tokens / file_context.full_tokens if file_context.full_tokens else 0
+            print(f"  \033[36m{padded_path}\033[0m : \033[33m{token_count:>6}\033[0m tokens"
+                  f" | context \033[33m{file_context.tokens:>6}\033[0m / {file_context.full_tokens:>6} tokens"
+                  f" (\033[32m-{saved:.0%}\033[0m)")
+
+        full_tokens = sum(file_context.full_tokens for file_context in context_plan.values())
+        context_tokens = sum(file_context.tokens for file_context in context_plan.values())
+        print(f"  Context saved: \033[32m{full_tokens - context_tokens}\033[0m out of {full_tokens} tokens")
         print()
 
-    if "gemini" in args.model:
-        get_clusters_func=partial(get_clusters_from_gemini, hunks_n=len(patches), model=args.model)
-    else:
-        get_clusters_func=partial(get_clusters_from_openai, hunks_n=len(patches), model=args.model)
-
-    clusters = handle_user_input(prompt_data, args.n, get_clusters_func)
+    provider = get_provider(args.model, record=args.record, replay=args.replay, replay_latency=args.replay_latency, api_base=args.api_base)
+    make_clusters_func = lambda hunks_n: partial(get_clusters, provider, hunks_n=hunks_n)
 
-    # Unstage all staged changes
-    logger.warning("Unstaging all staged changes and applying individual diffs...")
-    run("git restore --staged .")
-
-    generate_commits(patches, clusters, previous_sha, full_diff)
+    if args.offline:
+        from grouper import get_clusters_offline
+        get_clusters_func=partial(get_clusters_offline, diff_model=diff_model)
+    else:
+        # Diffs that don't fit the context window are clustered in shards and merged afterwards
+        budget = get_prompt_budget(args.model)
+        with profiling.span("count prompt tokens") as span:
+            prompt_tokens = count_tokens(prompt_data, args.model)
+            span.add(tokens=prompt_tokens)
+        if args.shard or prompt_tokens > budget:
+            logger.warning(f"Prompt needs {prompt_tokens} tokens, over the {budget} tokens budget. Clustering in shards.")
+            get_clusters_func = ShardedClusterer(
+                diff_model,
+                make_clusters_func,
+                lambda shard_model: prepare_prompt_data(shard_model, plan_context(shard_model, args.model)),
+                args.model,
+                budget,
+                jobs=args.jobs)
+        else:
+            get_clusters_func = make_clusters_func(len(patches))
+
+    from prompt import handle_user_input
+    # recorded and replayed runs always go through the provider
+    use_cache = not (args.no_cache or args.offline or args.record or args.replay)
+    get_clusters_func = with_cache(get_clusters_func, args.model, ResponseCache() if use_cache else None)
+    # one request slot is always kept for the user's own requests
+    prefetch = min(args.prefetch, args.jobs - 1)
+    prefetcher = Prefetcher(get_clusters_func, prompt_data, budget=prefetch) if prefetch > 0 and not args.offline else None
+    # includes the time spent waiting for the user
+    with profiling.span("review"):
+        clusters = handle_user_input(prompt_data, args.n, get_clusters_func, prefetcher=prefetcher)
+    provider.log_usage()
+
+    with profiling.span("commits", commits=len(clusters)):
+        generate_commits(diff_model, clusters, run_hooks=not args.no_verify)
 
 
 def main():
@@ -243,6 +250,61 @@ def main():
         default="gemini-flash-latest",
         help="Model used for the generations",
     )
+    PARSER.add_argument(
+        "--offline",
+        action="store_true",
+        help="Group hunks locally by path and changed identifiers and use template commit messages, without calling any model")
+    PARSER.add_argument(
+        "--no-verify",
+        action="store_true",
+        help="Don't run the pre-commit and post-commit hooks (they run once for all the generated commits)")
+    PARSER.add_argument(
+        "--profile", action="store_true", help="Print the time spent in each phase of the run, with its counters")
+    PARSER.add_argument(
+        "--profile-trace",
+        metavar="FILE",
+        help="Like --profile, and also write a Chrome trace-event JSON file (for chrome://tracing or Perfetto)")
+    PARSER.add_argument(
+        "--api-base",
+        metavar="URL",
+        help="Base URL of an OpenAI-compatible server to send the requests to (e.g. http://127.0.0.1:8080/v1/), whatever the model")
+    PARSER.add_argument("--record", metavar="CASSETTE", help="Append every model request and response to this cassette file")
+    PARSER.add_argument(
+        "--replay", metavar="CASSETTE", help="Answer the model requests from a cassette recorded with --record, without network access")
+    PARSER.add_argument(
+        "--replay-latency",
+        type=float,
+        metavar="SECONDS",
+        help="Delay of every replayed response (by default, the latency measured when recording)")
+    PARSER.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always query the model instead of reusing cached responses for identical staged changes (or stored commit summaries for changelogs)")
+    PARSER.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="Maximum number of concurrent requests to the model, shared by every kind of request")
+    PARSER.add_argument(
+        "--rpm", type=int, default=0, help="Maximum number of requests per minute sent to the model, 0 for no limit")
+    PARSER.add_argument(
+        "--tpm", type=int, default=0, help="Maximum number of tokens per minute sent to the model, 0 for no limit")
+    PARSER.add_argument(
+        "--timeout",
+        type=float,
+        default=120,
+        metavar="SECONDS",
+        help="Give up on a request (and retry it) if its answer isn't complete after this many seconds")
+    PARSER.add_argument(
+        "--shard",
+        action="store_true",
+        help="Cluster the hunks in shards merged afterwards, even if the prompt fits the model context window")
+    PARSER.add_argument(
+        "--prefetch",
+        type=int,
+        default=1,
+        help="Number of alternative groupings (regenerate, increase, decrease) to fetch in the background, 0 disables it")
     PARSERS = PARSER.add_subparsers(title="subcommands", dest="action")
     GENERATE_PARSER = PARSERS.add_parser(
         "generate",
@@ -257,7 +319,14 @@ def main():
         help="Generates a changelog between the HEAD commit and a target commit")
     CHANGELOG_PARSER.add_argument(
         "-p", "--pathspec", action="store", nargs="?", help="Get changelogs for these pathspecs only")
-    CHANGELOG_PARSER.add_argument("sha", nargs="?", help="Target commit SHA from which to generate the changelog")
+    CHANGELOG_PARSER.add_argument("sha", nargs="?", help="Target commit SHA from which to generate the changelog (default: the last tag, or the whole history)")
+    CHANGELOG_PARSER.add_argument(
+        "--headroom",
+        type=int,
+        default=CHUNK_HEADROOM,
+        help="Tokens of the model context window left for the prompt and the answer when a commit is too big and split in chunks")
+    # also accepted after the subcommand, as in older versions
+    CHANGELOG_PARSER.add_argument("--rpm", type=int, default=argparse.SUPPRESS, help="Same as the global --rpm")
     SETUP_PARSER = PARSERS.add_parser(
         "setup", help="Performs the initial setup for setting the API token", formatter_class=Formatter)
     SETUP_PARSER.add_argument("api", choices=["OpenAI", "Gemini"], help="The API to set up.")
@@ -276,6 +345,10 @@ def main():
         sys.argv.insert(1, "generate")
     args = PARSER.parse_args()
 
+    if args.profile or args.profile_trace:
+        profiling.enable()
+        atexit.register(profiling.report, args.profile_trace)
+
     if args.debug:
         setup_logging("DEBUG", {"function": True})
     else:
@@ -288,18 +361,29 @@ def main():
         setup_api_key(args.api)
         sys.exit(0)
 
-    if "gemini" in args.model:
+    if args.offline and args.action == "changelog":
+        logger.error("Changelogs can't be generated with --offline.")
+        sys.exit(1)
+
+    if args.offline or args.replay:
+        logger.debug("Running offline, skipping API key setup.")
+    elif args.api_base:
+        # OpenAI-compatible servers (e.g. stub_server.py) usually don't check the key
+        configure_api_key("OpenAI", load_api_key("OpenAI") or "unused")
+    elif "gemini" in args.model:
         gemini_api_key = load_api_key("Gemini")
         if gemini_api_key is None:
             logger.error("Gemini API key not found. Please run `cactus setup Gemini` first.")
             sys.exit(1)
-        genai.configure(api_key=gemini_api_key)
+        configure_api_key("Gemini", gemini_api_key)
     else:
         openai_token = load_api_key("OpenAI")
         if openai_token is None:
             logger.error("OpenAI token not found. Please run `cactus setup OpenAI` first.")
             sys.exit(1)
-        openai.api_key = openai_token
+        configure_api_key("OpenAI", openai_token)
+
+    configure_limits(jobs=args.jobs, rpm=args.rpm, tpm=args.tpm, timeout=args.timeout)
 
     if isinstance(args.action, int):
         args.n = args.action
@@ -308,12 +392,18 @@ def main():
         args.action = "generate"
 
     if args.action == "generate":
-        if "n" not in args:
+        if "n" not in args or not args.n:
             args.n = None
-        logger.info(f"Using {args.model} to generate " + (f"{args.n} commits..." if args.n else "commit messages..."))
+        logger.info(f"Using {'local clustering' if args.offline else args.model} to generate " + (f"{args.n} commits..." if args.n else "commit messages..."))
         generate_changes(args)
     elif args.action == "changelog":
-        generate_changelog(args, args.model)
+        from cache import SummaryStore
+        from changelog import generate_changelog
+        # recorded and replayed runs always go through the provider
+        use_store = not (args.no_cache or args.record or args.replay)
+        generate_changelog(args,
+                           get_provider(args.model, record=args.record, replay=args.replay, replay_latency=args.replay_latency, api_base=args.api_base),
+                           SummaryStore() if use_store else None)
 
 
 if __name__ == "__main__":
@@ -1,57 +1,308 @@
+import json
+import re
+import shlex
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain, groupby
+from operator import itemgetter
 from loguru import logger
 
-from constants import MODEL_TOKEN_LIMITS, PROMPT_CHANGELOG_GENERATOR, PROMPT_CHANGELOG_SYSTEM
-from api import num_tokens_from_string, split_into_chunks
-from utils import run
-import google.generativeai as genai
-import openai
+from constants import MODEL_TOKEN_LIMITS, PROMPT_CHANGELOG_COMMIT, PROMPT_CHANGELOG_COMMITS, PROMPT_CHANGELOG_GENERATOR, PROMPT_CHANGELOG_MERGE
+from api import get_chunk_budget, iter_chunks
+from git_utils import get_session, read_file_diffs
+import profiling
+from providers import AnswerTruncated
+from tokenizer import count_tokens, count_tokens_batch
 
-def generate_changelog(args, model):
-    # get list of commit messages from args.sha to HEAD
-    commit_messages = [msg for msg in run(f"git log --pretty=format:'%s' {args.sha}..HEAD").stdout.decode('utf-8').split("\n") if msg]
+# Number of partial changelogs combined by a single merge request
+MERGE_FAN_IN = 4
+# Tokens of commit summaries combined by the first merge requests
+MERGE_BUDGET = 4000
+# Chunks read ahead of the answers, per job
+MAX_PENDING_CHUNKS = 2
+# Least tokens a changelog answer may use, merges get as many as their partial changelogs have
+CHANGELOG_MAX_TOKENS = 1000
+# Commits fitting in a single chunk summarized by the same request, and answer tokens for each
+BATCH_MAX_COMMITS = 8
+BATCH_COMMIT_TOKENS = 250
 
-    # prepare exclude patterns for git diff
-    pathspec = f"-- {args.pathspec}" if args.pathspec else ''
 
-    # get git diff from args.sha to HEAD
-    result = run(f"git diff --ignore-all-space --ignore-blank-lines -U{args.context_size} {args.sha} {pathspec}")
+class ChangelogWriter:
+    """
+    Sends changelog prompts to the provider, which applies the request limits shared with every
+    other request of the process. Merges are answered from the summary store when it has them.
+    """
+    def __init__(self, provider, store=None):
+        self.provider = provider
+        self.store = store
+
+    def send(self, prompt, max_tokens=CHANGELOG_MAX_TOKENS):
+        with profiling.span("llm", model=self.provider.model, prompt_bytes=len(prompt)):
+            return self.provider.changelog(prompt, max_tokens)
+
+    def summarize(self, subjects, diff):
+        try:
+            changelog = self.send(PROMPT_CHANGELOG_GENERATOR.format(commit_messages=subjects, chunk=diff))
+        except AnswerTruncated as e:
+            logger.warning(f"The summary of {subjects} was cut at {CHANGELOG_MAX_TOKENS} tokens.")
+            changelog = e.text
+        return strip_changelog_tags(changelog)
+
+    def summarize_batch(self, commits):
+        """
+        Summarizes several commits, as (SHA, subject, diff) tuples, with a single request. Returns
+        the summaries found in the answer by SHA: the commits the model skipped, or that were cut
+        at the token limit, are left out.
+        """
+        ids = {sha[:12]: sha for sha, _, _ in commits}
+        prompt = PROMPT_CHANGELOG_COMMITS.format(commits="\n".join(
+            PROMPT_CHANGELOG_COMMIT.format(id=sha[:12], message=subject, diff=diff) for sha, subject, diff in commits))
+        try:
+            answer = self.send(prompt, max(CHANGELOG_MAX_TOKENS, BATCH_COMMIT_TOKENS * len(commits)))
+        except AnswerTruncated as e:
+            answer = e.text
+        return {ids[match.group(1)]: match.group(2).strip("\n")
+                for match in re.finditer(r'<changelog commit="(\w+)">(.*?)</changelog>', answer, re.S) if match.group(1) in ids}
+
+    def merge(self, changelogs):
+        """
+        Merges the partial changelogs into one. The answer may be as long as all of them together,
+        and if the model still stops at the limit, each half of them is merged on its own.
+        """
+        merged = self.store.get_merge(self.provider.model, changelogs) if self.store else None
+        if merged is None:
+            max_tokens = max(CHANGELOG_MAX_TOKENS, sum(count_tokens_batch(changelogs, self.provider.model)))
+            try:
+                merged = deduplicate_changelog(self.send(PROMPT_CHANGELOG_MERGE.format(changelogs="\n\n".join(changelogs)), max_tokens))
+            except AnswerTruncated:
+                logger.warning(f"The merge of {len(changelogs)} partial changelogs was cut at {max_tokens} tokens, merging them in two halves.")
+                halves = [changelogs[:len(changelogs) // 2], changelogs[len(changelogs) // 2:]]
+                merged = deduplicate_changelog("\n\n".join(half[0] if len(half) == 1 else self.merge(half) for half in halves))
+            if self.store:
+                self.store.put_merge(self.provider.model, changelogs, merged)
+        return merged
+
+
+def strip_changelog_tags(changelog):
+    return re.sub(r"</?changelog>", "", changelog).strip("\n")
+
+
+def deduplicate_changelog(changelog):
+    """
+    Strips the <changelog> tags and drops the repeated bullet items of a merged changelog, keeping
+    the first occurrence. Headings, blank lines and any other line are kept as they are.
+    """
+    lines, seen = [], set()
+    for line in strip_changelog_tags(changelog).splitlines():
+        if re.match(r"\s*[-*]\s", line):
+            key = re.sub(r"\W+", " ", line).strip().lower()
+            if key in seen:
+                continue
+            if key:
+                seen.add(key)
+        lines.append(line.rstrip())
+    return "\n".join(lines)
+
+
+def merge_changelogs(writer, executor, changelogs):
+    """
+    Merges the partial changelogs level by level, MERGE_FAN_IN at a time, keeping their order.
+    Without an executor, the merges are sent one after the other.
+    """
+    while len(changelogs) > 1:
+        groups = [changelogs[i:i + MERGE_FAN_IN] for i in range(0, len(changelogs), MERGE_FAN_IN)]
+        logger.debug(f"Merging {len(changelogs)} partial changelogs into {len(groups)}")
+        with profiling.span("changelog merge", partials=len(changelogs)):
+            changelogs = list((executor.map if executor else map)(lambda group: group[0] if len(group) == 1 else writer.merge(group), groups))
+    return changelogs[0] if changelogs else ""
+
+
+def pack_summaries(summaries, model):
+    """
+    Groups consecutive commit summaries up to MERGE_BUDGET tokens each. Groups are filled from the
+    oldest commit, so commits added to the range only change the last groups (and their merges).
+    """
+    groups, current, current_tokens = [], [], 0
+    for summary, tokens in zip(summaries, count_tokens_batch(summaries, model)):
+        if current and current_tokens + tokens > MERGE_BUDGET:
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(summary)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+def get_last_tag(session):
+    """
+    Returns the most recent tag reachable from HEAD, or None if there isn't any.
+    """
+    result = session.run("describe", "--tags", "--abbrev=0", "HEAD")
+    return result.stdout.decode('utf-8').strip() if result.returncode == 0 else None
+
+
+def list_commits(session, sha, pathspec):
+    """
+    Returns the SHA and subject of the commits from `sha` (excluded) to HEAD, oldest first, or of
+    the whole history without `sha`. Merge commits are left out, their changes are summarized
+    with the commits they merge.
+    """
+    result = session.run("log", "--reverse", "--no-merges", "--format=%H %s", f"{sha}..HEAD" if sha else "HEAD", *pathspec)
     if result.returncode != 0:
-        logger.error(f"An error occurred while getting git diff: {result.stderr.decode('utf-8')}")
+        logger.error(f"An error occurred while listing the commits: {result.stderr.decode('utf-8')}")
         sys.exit(1)
-    diff = result.stdout.decode('utf-8')
-
-    # Split the diff into chunks if it exceeds the token limit
-    chunks = split_into_chunks(diff, model)
-    logger.debug(f"Diff length: {len(diff)}")
-
-    if len(chunks) > 1:
-        logger.warning(
-            f"Diff went over max token limit ({num_tokens_from_string(diff, model)} > {MODEL_TOKEN_LIMITS.get(model)}). Splitted into {len(chunks)} chunks.")
-
-    changelog = ''.join(
-        genai.GenerativeModel(
-            model_name=model,
-            generation_config={
-                "temperature": 1,
-                "top_p": 0.95,
-                "top_k": 64,
-                "max_output_tokens": 8192,
-                "response_mime_type": "text/plain",
-            },
-            system_instruction=PROMPT_CHANGELOG_SYSTEM,
-        ).start_chat().send_message(
-            PROMPT_CHANGELOG_GENERATOR.format(commit_messages=commit_messages, chunk=chunk)
-        ).text if "gemini" in model else openai.chat.completions.create(
-            model=model,
-            n=1,
-            top_p=0.8,
-            temperature=0.8,
-            max_tokens=1000,
-            messages=[
-                {"role": "system", "content": PROMPT_CHANGELOG_SYSTEM},
-                {"role": "user", "content": PROMPT_CHANGELOG_GENERATOR.format(commit_messages=commit_messages, chunk=chunk)}
-            ]
-        ).choices[0].message.content for chunk in chunks
-    )
+    return [tuple(line.split(" ", 1)) if " " in line else (line, "") for line in result.stdout.decode('utf-8').splitlines() if line]
+
+
+def stream_commit_diffs(session, shas, context_size, pathspec):
+    """
+    Yields the file records (see read_file_diffs) of the diff of each commit against its parent,
+    read as they come from a single git process.
+    """
+    lines = session.stream("log", "--no-walk=unsorted", "--stdin", "-p", "--format=%x00%H", "--ignore-all-space", "--ignore-blank-lines",
+                           f"-U{context_size}", *pathspec, input="\n".join(shas).encode() + b"\n")
+    try:
+        yield from read_file_diffs(lines)
+    finally:
+        lines.close()
+
+
+def summarize_commits(args, writer, executor, commits, options, pathspec):
+    """
+    Summarizes the commits as their diffs are read. Every chunk is sent as soon as it's packed and
+    at most MAX_PENDING_CHUNKS per job wait for an answer, so the memory used doesn't depend on
+    the size of the range. Consecutive commits that fit in a single chunk are batched, up to a
+    chunk and BATCH_MAX_COMMITS of them, and summarized by the same request. Every summary is
+    stored as soon as it's written.
+    """
+    model, store = writer.provider.model, writer.store
+    subjects = dict(commits)
+    slots = threading.Semaphore(max(args.jobs, 1) * MAX_PENDING_CHUNKS)
+    budget = get_chunk_budget(model, args.headroom)
+
+    def summarize_chunk(subject, chunk):
+        try:
+            return writer.summarize([subject], chunk)
+        finally:
+            slots.release()
+
+    def summarize_batch(batch):
+        try:
+            summaries = writer.summarize_batch(batch)
+            # the commits missing from the answer are summarized on their own
+            for sha, subject, chunk in batch:
+                if sha not in summaries:
+                    summaries[sha] = writer.summarize([subject], chunk)
+            return summaries
+        finally:
+            slots.release()
+
+    def finish(sha, futures, batched=False):
+        partials = [future.result()[sha] if batched else future.result() for future in futures]
+        if len(partials) > 1:
+            logger.warning(f"Commit {sha[:8]} went over the max token limit ({MODEL_TOKEN_LIMITS.get(model)}), summarized in {len(partials)} chunks.")
+        summary = merge_changelogs(writer, None, partials)
+        if store:
+            store.put_summary(sha, model, options, summary)
+        return summary
+
+    # the first request that fails stops the reading, instead of the end of the range
+    failures, submitted = [], []
+
+    def watch(future):
+        submitted.append(future)
+        future.add_done_callback(lambda done: failures.append(done.exception()) if not done.cancelled() and done.exception() else None)
+        return future
+
+    def check_failures():
+        if failures:
+            for future in submitted:
+                future.cancel()
+            raise failures[0]
+
+    # the answers are waited for in another thread, so the jobs never wait for each other
+    results, batch = {}, []
+    with ThreadPoolExecutor(max_workers=1, thread_name_prefix="changelog-finish") as finisher:
+
+        def submit(sha, chunks):
+            futures = []
+            for chunk in chunks:
+                slots.acquire()
+                check_failures()
+                futures.append(watch(executor.submit(summarize_chunk, subjects[sha], chunk)))
+            results[sha] = watch(finisher.submit(finish, sha, futures))
+
+        def submit_batch():
+            if len(batch) == 1:
+                submit(batch[0][0], [batch[0][2]])
+            elif batch:
+                slots.acquire()
+                check_failures()
+                future = watch(executor.submit(summarize_batch, [(sha, subject, chunk) for sha, subject, chunk, _ in batch]))
+                for sha, _, _, _ in batch:
+                    results[sha] = watch(finisher.submit(finish, sha, [future], True))
+            batch.clear()
+
+        records = stream_commit_diffs(get_session(), list(subjects), args.context_size, pathspec)
+        try:
+            for sha, commit_records in groupby(records, key=itemgetter(0)):
+                chunks = iter_chunks((record for _, record in commit_records), model, headroom=args.headroom)
+                first, second = next(chunks, None), next(chunks, None)
+                if first is None:
+                    continue
+                if second is not None:
+                    submit(sha, chain([first, second], chunks))
+                    continue
+                tokens = count_tokens(first, model, memo=False)
+                if len(batch) == BATCH_MAX_COMMITS or sum(entry[3] for entry in batch) + tokens > budget:
+                    submit_batch()
+                batch.append((sha, subjects[sha], first, tokens))
+            submit_batch()
+        finally:
+            # stops the git process if the range wasn't read to the end
+            records.close()
+    # commits without any diff left (e.g. whitespace changes) are stored as empty summaries
+    return {sha: results[sha].result() if sha in results else finish(sha, []) for sha in subjects}
+
+
+def generate_changelog(args, provider, store=None):
+    """
+    Summarizes every commit from args.sha (by default the last tag) to HEAD that isn't in the
+    store yet, then merges the summaries of all of them into the changelog.
+    """
+    session = get_session()
+    # prepare exclude patterns for git diff
+    pathspec = ["--", *shlex.split(args.pathspec)] if args.pathspec else []
+    # summaries of the same commit with other diff options are stored separately
+    options = json.dumps({"context_size": args.context_size, "pathspec": pathspec, "headroom": args.headroom})
+
+    sha = args.sha
+    if not sha:
+        sha = get_last_tag(session)
+        logger.info(f"Generating the changelog since the last tag, {sha}." if sha else "No tags found, generating the changelog of the whole history.")
+
+    with profiling.span("git log"):
+        commits = list_commits(session, sha, pathspec)
+    shas = [sha for sha, _ in commits]
+    with profiling.span("changelog store") as span:
+        summaries = store.get_summaries(shas, provider.model, options) if store else {}
+        span.add(stored=len(summaries))
+    missing = [(sha, subject) for sha, subject in commits if sha not in summaries]
+    logger.info(f"{len(commits)} commits, {len(commits) - len(missing)} already summarized, summarizing {len(missing)}.")
+
+    writer = ChangelogWriter(provider, store)
+    with ThreadPoolExecutor(max_workers=max(args.jobs, 1), thread_name_prefix="changelog") as executor:
+        if missing:
+            with profiling.span("changelog commits", commits=len(missing)):
+                summaries.update(summarize_commits(args, writer, executor, missing, options, pathspec))
+
+        # the merges of the commits summarized before are answered by the store
+        groups = pack_summaries([summaries[sha] for sha in shas if summaries[sha]], provider.model)
+        with profiling.span("changelog groups", groups=len(groups)):
+            partials = list(executor.map(lambda group: group[0] if len(group) == 1 else writer.merge(group), groups))
+        changelog = merge_changelogs(writer, executor, partials)
+
     logger.info(changelog)
+    provider.log_usage()
@@ -13,6 +13,15 @@ MODEL_TOKEN_LIMITS = {
     "gemini-2.0-flash-lite": 2097152,
 }
 
+# Bump whenever the format of cached responses changes
+CACHE_SCHEMA_VERSION = 1
+
+# Version of the layout of the prompt data (files, hunks), see prepare_prompt_data
+PROMPT_FORMAT_VERSION = 2
+
+# Bump whenever the changelog prompts or their post-processing change, so stored commit summaries are written again
+CHANGELOG_PROMPT_VERSION = 3
+
 CLASSIFICATOR_SCHEMA_GEMINI = {
     "type": "object",
     "properties": {
@@ -53,55 +62,41 @@ Analyze the provided code hunks (representing file changes) and restructure them
 
 ## Input Structure:
 
-You will receive the input in the following format:
+You will receive every changed file once, followed by its hunks:
 
 ```
-###############
-#### FILES ####
-###############
-./path/to/file1.py
-FILE:
-<Entire contents of file1.py>
-...
-
-./path/to/file2.py
-FILE:
-<Entire contents of file2.py>
-...
-
-###############
-#### HUNKS ####
-###############
-Total hunks: N
-
-Index: 1
-HUNK:
-@@ -start_line,count +start_line,count @@
---- a/path/to/file1.py
-+++ b/path/to/file1.py
-<diff content>
-...
-
-Index: 2
-HUNK:
-@@ -start_line,count +start_line,count @@
---- a/path/to/file2.py
-+++ b/path/to/file2.py
-<diff content>
-...
-
-...
+## FILE path/to/file1.py
+1  import os
+2+ import sys
+3
+[lines 4-40 not shown]
+41     def load(path):
+42+        if not os.path.exists(path):
+43+            return None
+44         with open(path) as f:
+
+### HUNK 1, lines 1-3, adds 2
+### HUNK 2, lines 41-44, adds 42-43
+-        assert os.path.exists(path)
+
+## FILE path/to/file2.py (deleted)
+### HUNK 3
+-<removed line>
+-<removed line>
+
+## FILE assets/logo.png (binary)
+### HUNK 4: binary content changed
 ```
 
-*   **FILES**: Contains the full path and complete content of each file *before* the changes represented by the hunks were applied. Use this for essential context.
-*   **HUNKS**: Contains each code modification (diff) with a unique `Index`.
+*   **FILE**: The path of a changed file, with its status when it isn't a plain modification (added, deleted, renamed from another path, binary). Below it come the lines of the file *after* the changes, each prefixed with its line number. Lines added by the hunks are marked with a `+` after the number. Parts of the file far from the changes may be left out and replaced with a `[lines X-Y not shown]` marker.
+*   **HUNK**: One change of the file above it, with its unique index. `lines X-Y` is the span of the file the hunk touches and `adds` lists the file lines it added, which are only shown in the file listing. The lines the hunk removed are written out below it, prefixed with `-`. When the file listing can't show the touched lines, the hunk is written out in full as a unified diff: `-` for removed lines, `+` for added lines and a space for unchanged ones.
 
 ## Core Task: Generate Commits with Rationale
 
 Process the input hunks and file contents to create commits that tell a coherent story about the development process through their grouping, ordering, and insightful messages.
 
 1.  **Group Hunks by Purpose:**
-    *   Examine all hunks, leveraging the full file contents for context.
+    *   Examine all hunks, leveraging the file contents for context.
     *   Identify groups of hunks (potentially spanning multiple files) that collectively achieve a single, logical goal. Examples of such goals include:
         *   Fixing a specific bug or addressing an edge case.
         *   Implementing a distinct functional part of a feature.
@@ -154,6 +149,16 @@ Provide your result **exclusively** as a single JSON object adhering strictly to
 *   `message`: The commit message string (lowercase, imperative mood, human-like style) clearly explaining the purpose ("why") of the changes in this commit.
 *   `hunk_indices`: A list of integers representing the unique indices of the hunks included in this specific commit."""
 
+PROMPT_SHARD_MERGE = """
+The staged changes were too large to be analyzed at once, so they were split into parts and each part was already grouped into commits. There are no file contents here: each hunk below stands for one of those commits, described by its commit message and the files it touches. Group the hunks that belong to the same logical change across the parts, and write a new message for each resulting commit.
+"""
+
+PROMPT_CLASSIFICATOR_REPAIR = """## FOLLOW-UP
+Your answer did not use every hunk exactly once:
+{problems}
+
+Keep all the other hunks where they are and answer with the same JSON format, listing **only** the hunks above ({hunks}), each one in exactly one commit. To put a hunk in one of your commits, repeat the message of that commit exactly{new_commits}."""
+
 PROMPT_CHANGELOG_GENERATOR = """You are tasked with generating a changelog for beta testers based on a list of commit messages and their corresponding diffs. Your goal is to create a concise, informative list of changes that is neither too technical nor too simplistic.
 
 First, review the following commit messages:
@@ -197,4 +202,53 @@ Your output should look like this:
 
 Remember to focus on changes that are most relevant and impactful for beta testers. Your goal is to provide them with a clear understanding of what has changed in the application with a little bit of technical details."""
 
+PROMPT_CHANGELOG_COMMITS = """You are tasked with generating a changelog for beta testers for each of the following commits, based on its message and its diff. Your goal is to create a concise, informative list of changes that is neither too technical nor too simplistic.
+
+<commits>
+{commits}
+</commits>
+
+For each commit:
+
+1. Analyze the commit message and the diff, paying more attention to the contents of the diff.
+
+2. Identify significant changes, new features, improvements, and bug fixes that would be relevant to beta testers.
+
+3. Summarize each change in a clear, concise line that starts with an action verb (e.g., "Added," "Fixed," "Improved," "Updated"). Avoid overly technical jargon, but don't oversimplify to the point of losing important details.
+
+4. Leave the list empty if the commit has no change relevant to beta testers.
+
+Answer with one changelog per commit, in the order of the commits, each one inside <changelog> tags with the id of its commit, without any additional text:
+
+<changelog commit="1f0c2a9e4b7d">
+- Added [feature] to improve [aspect of the application]
+- Fixed issue with [problem] that was causing [symptom]
+</changelog>
+<changelog commit="8e41d0b3c952">
+- Improved performance of [feature or section] by [brief explanation]
+</changelog>"""
+
+PROMPT_CHANGELOG_COMMIT = """<commit id="{id}">
+<message>{message}</message>
+<diff>
+{diff}
+</diff>
+</commit>"""
+
+PROMPT_CHANGELOG_MERGE = """The following partial changelogs were generated from consecutive parts of the same set of changes:
+
+<changelogs>
+{changelogs}
+</changelogs>
+
+Merge them into a single changelog:
+
+1. Combine entries that describe the same change or closely related changes into one entry.
+
+2. Remove duplicated entries, keeping the most informative wording.
+
+3. Keep the original order of the entries as much as possible, and do not add changes that are not in the partial changelogs.
+
+Output the merged changelog as a markdown list, one change per line, without any additional text, headings or explanations, inside <changelog> tags."""
+
 PROMPT_CHANGELOG_SYSTEM = "You are a highly skilled AI tasked with creating a user-friendly changelog based on git diffs. Your goal is to analyze the following git diffs and produce a clear, concise list of changes that are relevant and understandable to end-users."
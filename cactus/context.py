@@ -0,0 +1,242 @@
+"""
+Plans how much of each touched file is sent to the model as context for its hunks.
+
+Instead of whole files, only windows around the hunks are included, expanded to the enclosing
+function or class when it's short enough. The detail level is shared by all files and is lowered
+step by step until the context fits its share of the model prompt budget, so windows shrink as
+the diff grows and eventually only the hunks themselves are sent.
+"""
+import re
+from dataclasses import dataclass
+from itertools import accumulate
+from typing import List, Optional
+from loguru import logger
+
+from git_utils import get_session
+from sharding import get_prompt_budget
+from tokenizer import count_tokens_batch
+
+# Share of the prompt budget that can be spent on file context, the rest is left for the hunks
+CONTEXT_BUDGET_RATIO = 0.5
+# Tokens taken by the line number and line break of every context line
+LINE_OVERHEAD = 2
+# Tokens taken by the marker of a skipped range of lines
+GAP_OVERHEAD = 10
+# Enclosing scopes longer than this are never included whole
+MAX_SCOPE_LINES = 150
+# Detail levels, from the widest to the narrowest: (expand to the enclosing scope, lines around each hunk)
+CONTEXT_LEVELS = [(True, 20), (True, 8), (False, 8), (False, 3), (False, 0)]
+
+SCOPE_PATTERN = re.compile(
+    r"^\s*(?:(?:export|pub|public|private|protected|static|async|abstract|final|default)\s+)*"
+    r"(?:def|class|function|func|fn|impl|struct|interface|enum|trait|module)\b")
+CLOSING_PATTERN = re.compile(r"^\s*(?:[)\]}]|end\b)")
+
+
+@dataclass
+class FileContext:
+    """
+    Lines of a touched file and the 1-based, inclusive line ranges of it sent to the model.
+    `windows` is None when the whole file is sent.
+    """
+    lines: List[str]
+    is_text: bool = True
+    windows: Optional[List[tuple]] = None
+    full_tokens: int = 0
+    tokens: int = 0
+
+    def shown_windows(self):
+        if not self.is_text:
+            return []
+        if self.windows is None:
+            return [(1, len(self.lines))] if self.lines else []
+        return self.windows
+
+    def shows(self, start, end):
+        """
+        Whether the lines from `start` to `end` (inclusive) are all sent to the model.
+        """
+        return any(window_start <= start and end <= window_end for window_start, window_end in self.shown_windows())
+
+    def render(self, added=frozenset()):
+        """
+        Returns the numbered lines sent to the model, marking the `added` ones with a '+'. Files
+        that can't be shown (binary or deleted) render nothing, their file header says why.
+        """
+        if not self.is_text:
+            return []
+
+        rendered, last = [], 0
+        for start, end in self.shown_windows():
+            if start > last + 1:
+                rendered.append(f"[lines {last + 1}-{start - 1} not shown]")
+            rendered.extend(f"{number}{'+' if number in added else ' '} {line}"
+                            for number, line in enumerate(self.lines[start - 1:end], start=start))
+            last = end
+        if last < len(self.lines):
+            rendered.append(f"[lines {last + 1}-{len(self.lines)} not shown]")
+        return rendered
+
+
+def read_files(file_paths):
+    """
+    Returns the lines of the staged version of each file and whether it could be read as text.
+    Contents come from the index, so they always match the staged hunks.
+    """
+    files = {}
+    for file_path, (content, is_binary) in get_session().index_reader.read_files(file_paths).items():
+        if content is None:
+            logger.warning(f"File not found: {file_path}")
+            files[file_path] = ([], False)
+        elif is_binary:
+            logger.debug(f"Not showing content of binary file {file_path}")
+            files[file_path] = ([], False)
+        else:
+            # split on line feeds only, so line numbers match the ones of the hunks
+            lines = content.decode('utf-8', errors='replace').split('\n')
+            if lines[-1] == '':
+                lines.pop()
+            files[file_path] = ([line.rstrip('\r') for line in lines], True)
+    return files
+
+
+def staged_paths(diff_model):
+    """
+    Returns the paths of the files of the diff that are still in the index (not deleted).
+    """
+    return [diff_file.path for diff_file in diff_model.files if not diff_file.is_removed]
+
+
+def indentation(line):
+    return len(line) - len(line.lstrip())
+
+
+def enclosing_scope(lines, start, end):
+    """
+    Returns the line range of the innermost function or class around the given lines, found by
+    indentation, or None if there's none or it's longer than MAX_SCOPE_LINES.
+    """
+    indent = min((indentation(line) for line in lines[start - 1:end] if line.strip()), default=0)
+    scope_start = None
+    for i in range(start - 1, max(start - MAX_SCOPE_LINES, 0), -1):
+        line = lines[i - 1]
+        if not line.strip() or indentation(line) >= indent:
+            continue
+        if SCOPE_PATTERN.match(line):
+            scope_start = i
+            break
+        indent = indentation(line)
+        if indent == 0:
+            break
+    if scope_start is None:
+        return None
+
+    # include the decorators of the scope
+    scope_indent = indentation(lines[scope_start - 1])
+    while scope_start > 1 and lines[scope_start - 2].strip().startswith("@") and indentation(lines[scope_start - 2]) == scope_indent:
+        scope_start -= 1
+
+    scope_end = scope_start
+    for i in range(scope_start + 1, len(lines) + 1):
+        line = lines[i - 1]
+        if not line.strip():
+            continue
+        if indentation(line) > scope_indent:
+            scope_end = i
+            if scope_end - scope_start >= MAX_SCOPE_LINES:
+                return None
+            continue
+        # closing braces and 'end' keywords belong to the scope
+        if CLOSING_PATTERN.match(line):
+            scope_end = i
+        break
+    return scope_start, max(scope_end, end)
+
+
+def merge_ranges(ranges):
+    merged = []
+    for start, end in sorted(ranges):
+        if merged and start <= merged[-1][1] + 1:
+            merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+        else:
+            merged.append((start, end))
+    return merged
+
+
+def format_line_ranges(numbers):
+    """
+    Returns the line numbers as a compact list of ranges, e.g. "3-5, 9".
+    """
+    ranges = merge_ranges((number, number) for number in numbers)
+    return ", ".join(str(start) if start == end else f"{start}-{end}" for start, end in ranges)
+
+
+def hunk_ranges(diff_file, lines):
+    """
+    Returns the line range of the working tree file touched by each hunk of the file.
+    """
+    ranges = []
+    for hunk in diff_file.hunks:
+        if hunk.is_header_only or not lines:
+            continue
+        start = min(max(hunk.target_start, 1), len(lines))
+        ranges.append((start, min(max(start + hunk.target_length - 1, start), len(lines))))
+    return ranges
+
+
+def plan_context(diff_model, model, budget=None):
+    """
+    Returns the FileContext of every file of the diff, with the widest windows that fit the budget.
+    By default the budget is CONTEXT_BUDGET_RATIO of the prompt budget, minus what the hunks need.
+    """
+    files = read_files(staged_paths(diff_model))
+    plan = {diff_file.path: FileContext(*files.get(diff_file.path, ([], False))) for diff_file in diff_model.files}
+    text_files = [(diff_file, plan[diff_file.path]) for diff_file in diff_model.files if plan[diff_file.path].is_text]
+
+    if budget is None:
+        prompt_budget = get_prompt_budget(model)
+        hunk_tokens = sum(count_tokens_batch([diff_file.diff_text for diff_file in diff_model.files], model))
+        budget = max(min(int(prompt_budget * CONTEXT_BUDGET_RATIO), prompt_budget - hunk_tokens), 0)
+
+    # token cost of every line is counted once, windows are then priced with prefix sums
+    line_costs = count_tokens_batch([line for _, file_context in text_files for line in file_context.lines], model)
+    prefix_sums, position = {}, 0
+    for diff_file, file_context in text_files:
+        costs = line_costs[position:position + len(file_context.lines)]
+        position += len(file_context.lines)
+        prefix_sums[diff_file.path] = [0] + list(accumulate(cost + LINE_OVERHEAD for cost in costs))
+        file_context.full_tokens = prefix_sums[diff_file.path][-1]
+
+    def cost(path, windows):
+        sums = prefix_sums[path]
+        bounds = [0] + [line for window in windows for line in window] + [len(sums)]
+        gaps = sum(1 for end, start in zip(bounds[::2], bounds[1::2]) if start > end + 1)
+        return sum(sums[end] - sums[start - 1] for start, end in windows) + gaps * GAP_OVERHEAD
+
+    ranges = {diff_file.path: hunk_ranges(diff_file, file_context.lines) for diff_file, file_context in text_files}
+    scopes = {}
+    for with_scope, radius in CONTEXT_LEVELS:
+        windows = {}
+        for diff_file, file_context in text_files:
+            lines, candidates = file_context.lines, []
+            for start, end in ranges[diff_file.path]:
+                candidates.append((max(start - radius, 1), min(end + radius, len(lines))))
+                if with_scope:
+                    if (diff_file.path, start, end) not in scopes:
+                        scopes[diff_file.path, start, end] = enclosing_scope(lines, start, end)
+                    if scopes[diff_file.path, start, end]:
+                        candidates.append(scopes[diff_file.path, start, end])
+            windows[diff_file.path] = merge_ranges(candidates)
+
+        total = sum(cost(path, file_windows) for path, file_windows in windows.items())
+        if total <= budget:
+            logger.debug(f"File context: {radius} lines around each hunk{' and enclosing scopes' if with_scope else ''}, {total} tokens out of {budget}")
+            break
+    else:
+        logger.warning(f"Not enough tokens left for file context ({budget} tokens), sending only the hunks.")
+        windows = {diff_file.path: [] for diff_file, _ in text_files}
+
+    for diff_file, file_context in text_files:
+        file_context.windows = windows[diff_file.path]
+        file_context.tokens = cost(diff_file.path, file_context.windows)
+    return plan
@@ -0,0 +1,208 @@
+import dataclasses
+import hashlib
+from dataclasses import dataclass, field
+from functools import cached_property
+from typing import List, Optional
+from loguru import logger
+from git_utils import parse_diff
+
+
+@dataclass
+class DiffHunk:
+    """
+    A single stageable unit of the diff, as referenced by the model through its 1-based index.
+    Binary files and files without hunks (renames, mode changes) are represented by a single
+    header-only unit so that indices always line up with the list of patches.
+    """
+    index: int
+    id: str
+    path: str
+    header: str
+    text: str
+    patch: bytes
+    offset: Optional[int]
+    source_start: int = 0
+    source_length: int = 0
+    target_start: int = 0
+    target_length: int = 0
+    is_header_only: bool = False
+
+    @cached_property
+    def lines(self):
+        return [line.encode('latin-1').decode('utf-8', errors='replace') for line in self.text.splitlines()]
+
+    @cached_property
+    def added_lines(self):
+        """
+        The 1-based numbers of the lines this hunk adds, in the staged version of the file.
+        """
+        numbers, line_number = [], self.target_start
+        # the first line is the @@ header
+        for line in self.lines[1:]:
+            if line.startswith('+'):
+                numbers.append(line_number)
+                line_number += 1
+            elif line.startswith(' '):
+                line_number += 1
+        return numbers
+
+
+@dataclass
+class DiffFile:
+    path: str
+    source_file: str
+    target_file: str
+    header_text: str
+    offset: Optional[int]
+    end_offset: Optional[int] = None
+    is_added: bool = False
+    is_removed: bool = False
+    is_modified: bool = False
+    is_rename: bool = False
+    is_binary: bool = False
+    hunks: List[DiffHunk] = field(default_factory=list)
+
+    @cached_property
+    def diff_text(self):
+        """
+        The utf-8 decoded content of every hunk of this file, used for token accounting.
+        """
+        return '\n'.join(line for hunk in self.hunks if not hunk.is_header_only for line in hunk.lines)
+
+
+@dataclass
+class DiffModel:
+    """
+    Parsed representation of the staged diff. It is built once per run and shared by patch
+    extraction, token accounting, prompt building and staging.
+    """
+    raw: bytes
+    files: List[DiffFile]
+    hunks: List[DiffHunk]
+
+    @property
+    def patches(self):
+        return [hunk.patch for hunk in self.hunks]
+
+    def subset(self, diff_files):
+        """
+        Returns a model with only the given files and their hunks renumbered from 1, together with
+        the original index of each of its hunks.
+        """
+        files, hunks, indices = [], [], []
+        for diff_file in diff_files:
+            file_hunks = [dataclasses.replace(hunk, index=len(hunks) + i + 1) for i, hunk in enumerate(diff_file.hunks)]
+            files.append(dataclasses.replace(diff_file, hunks=file_hunks))
+            hunks.extend(file_hunks)
+            indices.extend(hunk.index for hunk in diff_file.hunks)
+        return DiffModel(raw=self.raw, files=files, hunks=hunks), indices
+
+    def file_text(self, diff_file):
+        """
+        Returns the raw diff section of a single file, sliced straight from the original bytes.
+        """
+        if diff_file.offset is None:
+            return ''
+        return self.raw[diff_file.offset:diff_file.end_offset].decode('latin-1')
+
+    @classmethod
+    def from_bytes(cls, diff_data):
+        diff_text = diff_data.decode('latin-1')
+        try:
+            patch_set = parse_diff(diff_text)
+        except Exception as e:
+            logger.error(f"Failed to parse diff data: {e}")
+            return cls(raw=diff_data, files=[], hunks=[])
+
+        # latin-1 maps every byte to exactly one character, so string offsets are byte offsets
+        file_offsets, hunk_offsets = _scan_offsets(diff_text)
+        if len(file_offsets) != len(patch_set):
+            logger.debug(f"Found {len(file_offsets)} file headers but parsed {len(patch_set)} files, ignoring offsets.")
+            file_offsets, hunk_offsets = [], []
+        file_ends = file_offsets[1:] + [len(diff_data)]
+
+        files, hunks = [], []
+        for file_ix, patched_file in enumerate(patch_set):
+            logger.debug(f"Processing file: {patched_file.path} with {len(patched_file)} hunks")
+
+            file_headers = []
+            file_headers.append(str("".join(list(patched_file.patch_info)[:-1])).strip())
+            if patched_file.is_modified_file:
+                file_headers.append(f'--- {patched_file.source_file}')
+                file_headers.append(f'+++ {patched_file.target_file}')
+            file_header_text = '\n'.join(file_headers)
+
+            diff_file = DiffFile(
+                path=patched_file.path,
+                source_file=patched_file.source_file,
+                target_file=patched_file.target_file,
+                header_text=file_header_text,
+                offset=file_offsets[file_ix] if file_offsets else None,
+                end_offset=file_ends[file_ix] if file_offsets else None,
+                is_added=patched_file.is_added_file,
+                is_removed=patched_file.is_removed_file,
+                is_modified=patched_file.is_modified_file,
+                is_rename=getattr(patched_file, 'is_rename', False),
+                is_binary=patched_file.is_binary_file)
+            files.append(diff_file)
+
+            if patched_file.is_binary_file or len(patched_file) == 0:
+                if patched_file.is_binary_file:
+                    logger.info(f"Skipping binary file {patched_file.path}")
+                else:
+                    logger.info(f"No hunks found for {patched_file.path}.")
+                diff_file.hunks.append(
+                    DiffHunk(
+                        index=len(hunks) + 1,
+                        id=_hunk_id(diff_file.path, file_header_text),
+                        path=diff_file.path,
+                        header='',
+                        text='',
+                        # the raw section of the file keeps the full rename header and the binary payload
+                        patch=diff_data[diff_file.offset:diff_file.end_offset] if file_offsets else file_header_text.encode('latin-1'),
+                        offset=diff_file.offset,
+                        is_header_only=True))
+                hunks.append(diff_file.hunks[-1])
+                continue
+
+            offsets = hunk_offsets[file_ix] if hunk_offsets else []
+            for i, hunk in enumerate(patched_file):
+                hunk_text = str(hunk)
+                logger.debug(f"  Hunk {i+1}: {len(hunk_text.splitlines())} lines")
+                diff_file.hunks.append(
+                    DiffHunk(
+                        index=len(hunks) + 1,
+                        id=_hunk_id(diff_file.path, hunk_text),
+                        path=diff_file.path,
+                        header=hunk_text.split('\n', 1)[0],
+                        text=hunk_text,
+                        patch=(file_header_text + '\n' + hunk_text).encode('latin-1'),
+                        offset=offsets[i] if i < len(offsets) else None,
+                        source_start=hunk.source_start,
+                        source_length=hunk.source_length,
+                        target_start=hunk.target_start,
+                        target_length=hunk.target_length))
+                hunks.append(diff_file.hunks[-1])
+
+        logger.debug(f"Total patches created: {len(hunks)}")
+        return cls(raw=diff_data, files=files, hunks=hunks)
+
+
+def _hunk_id(path, text):
+    return hashlib.sha1(f"{path}\0{text}".encode('latin-1', errors='replace')).hexdigest()[:12]
+
+
+def _scan_offsets(diff_text):
+    """
+    Returns the offsets of every file header and, per file, of every hunk header in the diff.
+    """
+    file_offsets, hunk_offsets = [], []
+    offset = 0
+    for line in diff_text.split('\n'):
+        if line.startswith('diff --git '):
+            file_offsets.append(offset)
+            hunk_offsets.append([])
+        elif line.startswith('@@ ') and hunk_offsets:
+            hunk_offsets[-1].append(offset)
+        offset += len(line) + 1
+    return file_offsets, hunk_offsets
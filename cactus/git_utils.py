@@ -1,20 +1,199 @@
+import atexit
 import os
 import subprocess
 import sys
 import tempfile
+import threading
+import time
+from functools import lru_cache
 from loguru import logger
-from unidiff import PatchSet, UnidiffParseError
-from utils import run
 
+import profiling
 
-def get_git_diff(context_size):
-    if run("git diff --cached --quiet --exit-code").returncode == 0:
+
+# Size of the file records read from a streamed diff, see read_file_diffs
+RECORD_MAX_BYTES = 1024 * 1024
+
+
+class GitSession:
+    """
+    Runs the git commands of a cactus run in a repository, without a shell, passing patches and
+    other inputs through stdin instead of temporary files. Every invocation is counted and timed,
+    including the requests sent to long-lived processes.
+    """
+    def __init__(self, repo="."):
+        self.repo = repo
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.index_reader = IndexReader(self)
+        self.hooks = None
+        self.toplevel = None
+
+    def record(self, name, seconds, processes=0, requests=1):
+        profiling.add(git_processes=processes, git_requests=requests)
+        with self.lock:
+            stat = self.stats.setdefault(name, {"processes": 0, "requests": 0, "seconds": 0.0})
+            stat["processes"] += processes
+            stat["requests"] += requests
+            stat["seconds"] += seconds
+
+    def run(self, *args, input=None, env=None, capture_output=True, check=False, cwd=None):
+        """
+        Runs a git command and returns the completed process, with bytes stdout and stderr.
+        `env` only holds the variables added to the current environment. Commands taking paths
+        of a diff, which are relative to the top-level directory, are run there with `cwd`.
+        """
+        logger.trace(f"Running git {' '.join(args)}")
+        name = self.command_name(args)
+        start = time.perf_counter()
+        try:
+            with profiling.span("git", command=name):
+                return subprocess.run(["git", *args],
+                                      cwd=cwd or self.repo,
+                                      input=input,
+                                      env={**os.environ, **env} if env else None,
+                                      capture_output=capture_output,
+                                      check=check)
+        finally:
+            self.record(name, time.perf_counter() - start, processes=1)
+
+    def stream(self, *args, input=None):
+        """
+        Runs a git command and yields the lines of its output as they are read, decoded as utf-8
+        and without their line ending. The input is written from another thread, so the pipes
+        never fill up in both directions. Stopping early kills the process.
+        """
+        name = self.command_name(args)
+        start = time.perf_counter()
+        process = self.popen(*args, stdin=subprocess.PIPE if input is not None else subprocess.DEVNULL, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stderr = []
+        threads = [threading.Thread(target=lambda: stderr.append(process.stderr.read()), daemon=True)]
+        if input is not None:
+            threads.append(threading.Thread(target=self._write_input, args=(process.stdin, input), daemon=True))
+        for thread in threads:
+            thread.start()
+        finished = False
+        try:
+            for line in process.stdout:
+                yield line[:-1].decode('utf-8', errors='replace') if line.endswith(b"\n") else line.decode('utf-8', errors='replace')
+            finished = True
+        finally:
+            if not finished:
+                process.kill()
+            process.stdout.close()
+            process.wait()
+            for thread in threads:
+                thread.join()
+            self.record(name, time.perf_counter() - start, requests=1)
+        if process.returncode != 0:
+            logger.error(f"git {name} failed: {b''.join(stderr).decode('utf-8', errors='ignore')}")
+            sys.exit(1)
+
+    @staticmethod
+    def _write_input(pipe, data):
+        try:
+            pipe.write(data)
+            pipe.close()
+        except BrokenPipeError:
+            pass
+
+    def popen(self, *args, **kwargs):
+        """
+        Starts a long-lived git process, whose requests are recorded by the caller.
+        """
+        logger.trace(f"Starting git {' '.join(args)}")
+        self.record(self.command_name(args), 0.0, processes=1, requests=0)
+        return subprocess.Popen(["git", *args], cwd=self.repo, **kwargs)
+
+    @staticmethod
+    def command_name(args):
+        return next((arg for arg in args if not arg.startswith("-")), "git")
+
+    def get_toplevel(self):
+        """
+        Returns the top-level directory of the working tree.
+        """
+        if self.toplevel is None:
+            self.toplevel = self.run("rev-parse", "--show-toplevel", check=True).stdout.decode().strip()
+        return self.toplevel
+
+    def rev_parse(self, revision):
+        """
+        Returns the full SHA of the revision, or None if it doesn't exist (e.g. HEAD of an empty repository).
+        """
+        result = self.run("rev-parse", "--verify", "-q", revision)
+        return result.stdout.decode().strip() if result.returncode == 0 else None
+
+    def apply_cached(self, patches, env=None):
+        """
+        Applies the patches to the index, raising an exception if any of them doesn't apply.
+        """
+        # from a subdirectory, git apply would skip the files outside of it
+        result = self.run("apply", "--cached", "--unidiff-zero", "-", input=b"".join(patch + b"\n" for patch in patches), env=env,
+                          cwd=self.get_toplevel())
+        if result.returncode != 0:
+            logger.error(f"Failed to apply patch: {result.stdout.decode('utf-8', errors='ignore')}\n{result.stderr.decode('utf-8', errors='ignore')}")
+            raise Exception("Failed to apply patch")
+
+    def hook_path(self, name):
+        """
+        Returns the path of a hook if it's installed (honoring core.hooksPath), or None.
+        """
+        if self.hooks is None:
+            version = self.run("--version").stdout.decode().split()[2]
+            hooks_dir = self.run("rev-parse", "--git-path", "hooks", check=True).stdout.decode().strip()
+            self.hooks = {
+                "supported": tuple(int(part) for part in version.split(".")[:2] if part.isdigit()) >= (2, 36),
+                "dir": os.path.join(self.repo, hooks_dir),
+            }
+        path = os.path.join(self.hooks["dir"], name)
+        return path if os.path.isfile(path) and os.access(path, os.X_OK) else None
+
+    def run_hook(self, name, *args, env=None):
+        """
+        Runs a git hook if it's installed, returning whether it succeeded. Older git versions
+        without `git hook` (before 2.36) get the hook run directly, like git does.
+        """
+        path = self.hook_path(name)
+        if path is None:
+            return True
+        if self.hooks["supported"]:
+            return self.run("hook", "run", name, "--", *args, env=env, capture_output=False).returncode == 0
+        start = time.perf_counter()
+        try:
+            return subprocess.run([path, *args], cwd=self.get_toplevel(), env={**os.environ, **env} if env else None).returncode == 0
+        finally:
+            self.record("hook", time.perf_counter() - start, processes=1)
+
+    def log_stats(self):
+        with self.lock:
+            stats = sorted(self.stats.items(), key=lambda item: -item[1]["seconds"])
+        for name, stat in stats:
+            logger.debug(f"git {name}: {stat['requests']} requests, {stat['processes']} processes, {stat['seconds'] * 1000:.1f} ms")
+
+    def close(self):
+        self.index_reader.close()
+        self.log_stats()
+
+
+@lru_cache(maxsize=None)
+def get_session():
+    """
+    Returns the session of the current repository, shared by the whole run.
+    """
+    session = GitSession()
+    atexit.register(session.close)
+    return session
+
+
+def get_git_diff(context_size, session=None):
+    session = session or get_session()
+    if session.run("diff", "--cached", "--quiet", "--exit-code").returncode == 0:
         logger.error("No staged changes found, please stage the desired changes.")
         sys.exit(1)
 
-    result = run(
-        f"git diff --inter-hunk-context={context_size} --unified={context_size} --minimal -p --staged --binary",
-        capture_output=True)
+    result = session.run(
+        "diff", f"--inter-hunk-context={context_size}", f"--unified={context_size}", "--minimal", "-p", "--staged", "--binary")
     if result.returncode != 0:
         logger.error(f"Failed to get git diff: {result.stderr.decode('utf-8', errors='ignore')}")
         sys.exit(1)
@@ -25,13 +204,8 @@ def get_git_diff(context_size):
     return result.stdout # Return binary data
 
 
-def restore_changes(full_diff):
-    with open("/tmp/cactus.diff", "wb") as f:
-        f.write(full_diff)
-        run("git apply --cached --unidiff-zero /tmp/cactus.diff")
-
-
 def parse_diff(git_diff):
+    from unidiff import PatchSet, UnidiffParseError
     for _ in range(5):
         try:
             return PatchSet.from_string(git_diff)
@@ -40,21 +214,213 @@ def parse_diff(git_diff):
     raise Exception("Failed to parse diff")
 
 
-def stage_changes(hunks):
-    with tempfile.NamedTemporaryFile(mode='wb', prefix='.tmp_patch_', delete=False) as fd:
-        filename = fd.name
+def read_file_diffs(lines, max_bytes=RECORD_MAX_BYTES):
+    """
+    Groups the lines of `git log -p --format=%x00%H` into (commit SHA, lines) records, one per
+    file diff, as they are read. A file over `max_bytes` is cut into several records at its next
+    hunk (or at any line once it's twice that size), each one starting with the file header again.
+    """
+    sha, record, header, hunk_line, size = None, [], None, None, 0
+    for line in lines:
+        if line.startswith("\0"):
+            if record:
+                yield sha, record
+            sha, record, header, hunk_line, size = line[1:], [], None, None, 0
+            continue
+        if line.startswith("diff --git "):
+            if record:
+                yield sha, record
+            record, header, hunk_line, size = [], None, None, 0
+        elif not line or not record:
+            # the empty lines around the diff of every commit, diff lines always have a prefix
+            continue
+        elif line.startswith("@@"):
+            if header is None:
+                header = list(record)
+            elif size > max_bytes:
+                yield sha, record
+                record, size = list(header), sum(len(header_line) + 1 for header_line in header)
+            hunk_line = line
+        elif hunk_line is not None and size > 2 * max_bytes:
+            yield sha, record
+            record = [*header, hunk_line]
+            size = sum(len(record_line) + 1 for record_line in record)
+        record.append(line)
+        size += len(line) + 1
+    if record:
+        yield sha, record
 
-    for hunk in hunks:
-        with open(filename, 'ab') as fd:
-            fd.write(hunk)
-            fd.write(b'\n')
 
-    result = subprocess.run(
-        f'git apply --cached --unidiff-zero {filename}',
-        shell=True,
-        stdout=subprocess.PIPE,
-        stderr=subprocess.PIPE)
+class IndexReader:
+    """
+    Reads the staged content of files from the index through a single long-lived
+    `git cat-file --batch` process. Blobs are cached by SHA, so unchanged content is read once.
+    """
+    # git itself only looks for null bytes in the first 8000 bytes to tell binary files apart
+    SNIFF_LENGTH = 8000
+    ARGS_PER_CALL = 1000
 
-    if result.returncode != 0:
-        logger.error(f"Failed to apply patch: {result.stdout.decode('utf-8', errors='ignore')}\n{result.stderr.decode('utf-8', errors='ignore')}")
-        raise Exception("Failed to apply patch")
+    def __init__(self, session):
+        self.session = session
+        self.process = None
+        self.blobs = {}
+
+    def index_shas(self, paths):
+        """
+        Returns the blob SHA of each path staged in the index, paths not in the index are left out.
+        Paths are relative to the top-level directory, like the ones of a diff.
+        """
+        shas = {}
+        for i in range(0, len(paths), self.ARGS_PER_CALL):
+            result = self.session.run("--literal-pathspecs", "ls-files", "-s", "-z", "--", *paths[i:i + self.ARGS_PER_CALL],
+                                      check=True, cwd=self.session.get_toplevel())
+            for entry in result.stdout.split(b"\0"):
+                if not entry:
+                    continue
+                info, path = entry.split(b"\t", 1)
+                mode, sha, stage = info.split()
+                # submodules (gitlinks) have no blob to read
+                if stage == b"0" and mode != b"160000":
+                    shas[os.fsdecode(path)] = sha.decode()
+        return shas
+
+    def binary_attributes(self, paths):
+        """
+        Returns the paths marked as binary by the git attributes (`binary`, `-diff` or `-text`).
+        """
+        if not paths:
+            return set()
+        result = self.session.run("check-attr", "--cached", "-z", "--stdin", "binary", "diff", "text",
+                                  input=b"\0".join(os.fsencode(path) for path in paths) + b"\0",
+                                  check=True, cwd=self.session.get_toplevel())
+        fields = result.stdout.split(b"\0")
+        binary = set()
+        for path, attribute, value in zip(fields[0::3], fields[1::3], fields[2::3]):
+            if (attribute, value) in ((b"binary", b"set"), (b"diff", b"unset"), (b"text", b"unset")):
+                binary.add(os.fsdecode(path))
+        return binary
+
+    def read_blobs(self, shas):
+        """
+        Reads the blobs not cached yet. Requests are written from another thread while the answers
+        are read, so the pipes never fill up in both directions.
+        """
+        missing = list(dict.fromkeys(sha for sha in shas if sha not in self.blobs))
+        if not missing:
+            return
+        if self.process is None:
+            self.process = self.session.popen("cat-file", "--batch", stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        start = time.perf_counter()
+
+        def write_requests():
+            self.process.stdin.write("".join(f"{sha}\n" for sha in missing).encode())
+            self.process.stdin.flush()
+
+        writer = threading.Thread(target=write_requests, daemon=True)
+        writer.start()
+        for sha in missing:
+            header = self.process.stdout.readline().split()
+            if len(header) != 3:
+                raise Exception(f"Failed to read blob {sha}: {b' '.join(header).decode(errors='replace')}")
+            self.blobs[sha] = self.process.stdout.read(int(header[2]))
+            self.process.stdout.read(1)  # trailing line feed
+        writer.join()
+        self.session.record("cat-file", time.perf_counter() - start, requests=len(missing))
+
+    def read_files(self, paths):
+        """
+        Returns the staged content of each path as (content, is_binary), with None as the content of
+        paths that aren't in the index (e.g. removed files).
+        """
+        paths = list(dict.fromkeys(paths))
+        shas = self.index_shas(paths)
+        binary = self.binary_attributes(list(shas))
+        self.read_blobs(shas.values())
+        files = {}
+        for path in paths:
+            if path not in shas:
+                files[path] = (None, False)
+                continue
+            content = self.blobs[shas[path]]
+            files[path] = (content, path in binary or b"\0" in content[:self.SNIFF_LENGTH])
+        return files
+
+    def close(self):
+        if self.process is not None:
+            self.process.stdin.close()
+            self.process.wait()
+            self.process = None
+
+
+class CommitBuilder:
+    """
+    Creates a series of commits without touching the index or the working tree.
+
+    Each commit's tree is computed by applying its patches to a temporary index (GIT_INDEX_FILE)
+    that starts from HEAD, and the commits are chained with commit-tree, signed when
+    commit.gpgSign is set. The prepare-commit-msg and commit-msg hooks run on every message, as
+    with `git commit`. HEAD only moves once, with a single update-ref, after every commit has been
+    created, so a failure leaves the repository exactly as it was.
+    """
+    def __init__(self, session, run_hooks=True):
+        self.session = session
+        self.run_hooks = run_hooks
+        self.tmp_dir = tempfile.TemporaryDirectory(prefix="cactus-")
+        self.env = {"GIT_INDEX_FILE": os.path.join(self.tmp_dir.name, "index")}
+        self.message_path = os.path.join(self.tmp_dir.name, "COMMIT_EDITMSG")
+        self.head = session.rev_parse("HEAD")
+        self.parent = self.head
+        self.commits = []
+        self.sign = session.run("config", "--type=bool", "commit.gpgSign").stdout.decode().strip() == "true"
+        self._git("read-tree", self.head or "--empty")
+
+    def _git(self, *args, input=None):
+        result = self.session.run(*args, input=input, env=self.env)
+        if result.returncode != 0:
+            raise Exception(f"git {args[0]} failed: {result.stderr.decode('utf-8', errors='ignore').strip()}")
+        return result.stdout.decode('utf-8', errors='ignore').strip()
+
+    def run_message_hooks(self, message):
+        """
+        Runs the prepare-commit-msg and (unless hooks are skipped) commit-msg hooks on the message,
+        returning it as the hooks left it.
+        """
+        hooks = [("prepare-commit-msg", "message")] + ([("commit-msg",)] if self.run_hooks else [])
+        hooks = [hook for hook in hooks if self.session.hook_path(hook[0])]
+        if not hooks:
+            return message
+        with open(self.message_path, "w", encoding="utf-8") as f:
+            f.write(message)
+        for name, *args in hooks:
+            if not self.session.run_hook(name, self.message_path, *args, env=self.env):
+                raise Exception(f"the {name} hook failed")
+        with open(self.message_path, encoding="utf-8") as f:
+            return f.read()
+
+    def add_commit(self, patches, message):
+        """
+        Applies the patches on top of the previous commit and creates a commit with them.
+        """
+        self.session.apply_cached(patches, env=self.env)
+        message = self.run_message_hooks(message)
+        tree = self._git("write-tree")
+        self.parent = self._git("commit-tree", tree, *(["-p", self.parent] if self.parent else []), *(["-S"] if self.sign else []),
+                                "-F", "-", input=message.encode('utf-8'))
+        self.commits.append(self.parent)
+        return self.parent
+
+    def update_head(self, reflog_message="cactus: automated commits"):
+        """
+        Moves HEAD (and the branch it points to) to the last commit, as long as it wasn't moved
+        in the meantime, and resets the real index to it.
+        """
+        if not self.commits:
+            return
+        # an empty old value means the branch must not exist yet, whatever the object format
+        self.session.run("update-ref", "-m", reflog_message, "HEAD", self.parent, self.head or "", check=True)
+        # unlike `git reset`, this doesn't add a reflog entry, and keeps the cached stat information
+        if self.session.run("read-tree", "--reset", "HEAD").returncode != 0:
+            logger.warning("Failed to reset the index to the new commits, run `git reset` to do it.")
+
+    def close(self):
+        self.tmp_dir.cleanup()
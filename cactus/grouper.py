@@ -1,14 +1,15 @@
 from typing import List
 import os
 import re
+import time
 import numpy as np
 from collections import Counter
-from git_utils import parse_diff, stage_changes
+from scipy import sparse
+from loguru import logger
 from sklearn.cluster import AgglomerativeClustering
 from sklearn.feature_extraction.text import CountVectorizer, TfidfVectorizer
 from sklearn.metrics.pairwise import cosine_similarity
 from thefuzz import fuzz
-from unidiff import PatchedFile, PatchSet, UnidiffParseError
 
 # List of common programming language reserved words to exclude (example for Python)
 RESERVED_WORDS = set([
@@ -66,6 +67,16 @@ COMMON_ENGLISH_WORDS = set([
 ])
 
 
+EXCLUDED_WORDS = RESERVED_WORDS | COMMON_ENGLISH_WORDS
+WORD_PATTERN = re.compile(r'\w+')
+SPACES_PATTERN = re.compile(r" +")
+SIGN_PATTERN = re.compile(r"([+-]) ?")
+NON_ALPHANUMERIC_PATTERN = re.compile(r"[^a-zA-Z0-9\s]")
+
+# Signature value of hunks without any word, MinHash values themselves always fit in 32 bits
+MINHASH_EMPTY = np.iinfo(np.uint64).max
+
+
 def jaccard_similarity(str1, str2):
     words1 = set(str1.split())
     words2 = set(str2.split())
@@ -79,30 +90,60 @@ def jaccard_similarity(str1, str2):
     return len(intersection) / len(union)
 
 
-def get_most_common_words(hunks, n=10):
+def count_words(hunks):
     word_counts = Counter()
 
     for hunk in hunks:
-        words = re.findall(r'\w+', get_modified_lines(hunk))
-        filtered_words = filter(lambda word: word.lower() not in RESERVED_WORDS | COMMON_ENGLISH_WORDS, map(str.lower, words))
-        word_counts.update(filtered_words)
+        words = map(str.lower, WORD_PATTERN.findall(get_modified_lines(hunk)))
+        word_counts.update(word for word in words if word not in EXCLUDED_WORDS)
+
+    return word_counts
+
 
-    return [word for word, _ in word_counts.most_common(n)]
+def get_most_common_words(hunks, n=10):
+    return [word for word, _ in count_words(hunks).most_common(n)]
 
 
 def get_optimal_n_common_words(hunks, min_n=1, max_n=50):
-    explained_variances = []
+    """
+    Finds how many of the most common words to ignore with the elbow method on the explained
+    variance of the count similarity matrix.
+
+    The term matrix and the word ranking are built only once. Ignoring one more word then just
+    subtracts its column from the Gram matrix, which gives every cosine similarity matrix of the
+    sweep without refitting a vectorizer.
+    """
+    ranked_words = get_most_common_words(hunks, n=max_n)
 
+    vectorizer = CountVectorizer(stop_words=list(EXCLUDED_WORDS), lowercase=False)
+    counts = vectorizer.fit_transform(hunks).astype(np.float64).tocsc()
+    vocabulary = vectorizer.vocabulary_
+    gram = (counts @ counts.T).toarray()
+    hunks_n = gram.shape[0]
+
+    explained_variances = []
+    ignored = 0
     for n in range(min_n, max_n + 1):
-        # Get the most common words for the current value of n
-        most_common_words = get_most_common_words(hunks, n=n)
+        # Remove the words that became stop words since the previous step
+        changed = not explained_variances
+        for word in ranked_words[ignored:n]:
+            if word in vocabulary:
+                column = counts[:, vocabulary[word]].toarray().ravel()
+                gram -= np.outer(column, column)
+                changed = True
+        ignored = max(ignored, n)
 
-        # Calculate the similarity matrix while ignoring the most common words
-        stop_words = list(set().union(most_common_words, RESERVED_WORDS, COMMON_ENGLISH_WORDS))
-        matrix = similarity_matrix(hunks, type='count', stop_words=stop_words)
+        if not changed:
+            explained_variances.append(explained_variances[-1])
+            continue
 
-        # Calculate the explained variance for the current n
-        explained_variance = np.sum(np.var(matrix, axis=0))
+        # The cosine similarity matrix is W @ gram @ W with W = diag(1 / norms), so the sum of its
+        # column variances comes from its squared sum and its column sums
+        norms = np.sqrt(np.clip(np.diag(gram), 0, None))
+        weights = np.divide(1, norms, out=np.zeros_like(norms), where=norms > 0)
+        column_sums = weights * (gram @ weights)
+        squares_sum = (weights**2) @ np.square(gram) @ (weights**2)
+        explained_variance = squares_sum/hunks_n - np.sum(column_sums**2) / hunks_n**2
         explained_variances.append(explained_variance)
 
     ## Plot the explained variance as a function of n
@@ -112,19 +153,20 @@ def get_optimal_n_common_words(hunks, min_n=1, max_n=50):
     # plt.show()
 
     # Find the optimal n using the elbow method
+    explained_variances = np.array(explained_variances)
     optimal_n = min_n
-    max_diff = 0
-    for i in range(1, len(explained_variances) - 1):
-        diff = explained_variances[i - 1] - explained_variances[i + 1]
-        if diff > max_diff:
-            max_diff = diff
-            optimal_n = i + min_n
+    if len(explained_variances) > 2:
+        diffs = explained_variances[:-2] - explained_variances[2:]
+        if diffs.max() > 0:
+            optimal_n = int(np.argmax(diffs)) + 1 + min_n
 
     # return the words that we want to ignore
-    return get_most_common_words(hunks, optimal_n)
+    return ranked_words[:optimal_n]
 
 
 def similarity_matrix(hunks, type='count', stop_words=None):
+    if type == 'minhash':
+        return minhash_similarity_matrix(hunks)
     vectorizer = TfidfVectorizer if type == 'tfidf' else CountVectorizer
     matrix = cosine_similarity(vectorizer(stop_words=stop_words, lowercase=False).fit_transform(hunks)) if type in ['tfidf', 'count'] else np.array([
         [1 if i == j else (jaccard_similarity(hunks[i], hunks[j]) if type == 'jaccard' else fuzz.token_set_ratio(hunks[i], hunks[j]) / 100) for j in range(len(hunks))] for i in range(len(hunks))
@@ -132,25 +174,233 @@ def similarity_matrix(hunks, type='count', stop_words=None):
     return matrix
 
 
+def minhash_signatures(hunks, num_perm=128, seed=0, batch_size=65536):
+    """
+    Returns the (len(hunks), num_perm) MinHash signatures of the word sets of the hunks, using the
+    same words as `jaccard_similarity`. Hunks without words get MINHASH_EMPTY everywhere.
+
+    Words are numbered and hashed with multiply-shift hash functions, `batch_size` words at a time.
+    """
+    vocabulary = {}
+    ids = [np.fromiter((vocabulary.setdefault(word, len(vocabulary)) for word in dict.fromkeys(hunk.split())), dtype=np.uint64)
+           for hunk in hunks]
+
+    rng = np.random.default_rng(seed)
+    a = rng.integers(0, 1 << 63, size=(num_perm, 1), dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+    b = rng.integers(0, 1 << 63, size=(num_perm, 1), dtype=np.uint64)
+
+    signatures = np.full((len(hunks), num_perm), MINHASH_EMPTY, dtype=np.uint64)
+    start = 0
+    while start < len(hunks):
+        # hash the words of as many hunks as fit in the batch at once
+        end, size = start, 0
+        while end < len(hunks) and (size == 0 or size + len(ids[end]) <= batch_size):
+            size += len(ids[end])
+            end += 1
+        lengths = np.array([len(hunk_ids) for hunk_ids in ids[start:end]])
+        if lengths.sum():
+            hashes = (a * np.concatenate(ids[start:end]) + b) >> np.uint64(32)
+            non_empty = np.flatnonzero(lengths)
+            offsets = np.concatenate(([0], np.cumsum(lengths)[:-1]))[non_empty]
+            signatures[start + non_empty] = np.minimum.reduceat(hashes, offsets, axis=1).T
+        start = end
+
+    return signatures
+
+
+def lsh_candidate_pairs(signatures, bands=32, max_bucket_size=256):
+    """
+    Returns a (k, 2) array of the i < j pairs of hunks sharing at least one LSH band bucket.
+    Buckets bigger than `max_bucket_size` (e.g. thousands of identical reformatting hunks) are
+    linked as a star around their first member, which keeps them connected without producing a
+    quadratic number of pairs.
+    """
+    hunks_n = signatures.shape[0]
+    rows = signatures.shape[1] // bands
+    empty = (signatures == MINHASH_EMPTY).all(axis=1)
+    pairs = [np.empty(0, dtype=np.int64)]
+    for band in range(bands):
+        # collapse the rows of the band into a single bucket key, collisions only add candidates
+        keys = np.zeros(hunks_n, dtype=np.uint64)
+        for row in signatures[:, band * rows:(band+1) * rows].T:
+            keys = keys * np.uint64(0x9E3779B97F4A7C15) + row
+        order = np.argsort(keys[~empty], kind='stable')
+        order = np.flatnonzero(~empty)[order]
+        starts = np.flatnonzero(np.diff(keys[order], prepend=keys[order][:1] + np.uint64(1)))
+        sizes = np.diff(np.append(starts, len(order)))
+
+        # pair up the members of all the buckets of the same size at once
+        for size in np.unique(sizes[sizes > 1]):
+            members = order[starts[sizes == size][:, None] + np.arange(size)]
+            if size > max_bucket_size:
+                first, second = np.repeat(members[:, :1], size - 1, axis=1), members[:, 1:]
+            else:
+                upper = np.triu_indices(size, 1)
+                first, second = members[:, upper[0]], members[:, upper[1]]
+            first, second = first.ravel(), second.ravel()
+            pairs.append(np.minimum(first, second) * hunks_n + np.maximum(first, second))
+
+    pairs = np.sort(np.concatenate(pairs))
+    pairs = pairs[np.diff(pairs, prepend=-1) != 0]
+    return np.stack((pairs // hunks_n, pairs % hunks_n), axis=1)
+
+
+def minhash_similarity_matrix(hunks, num_perm=128, bands=32, threshold=0.0, seed=0):
+    """
+    Sparse approximation of the 'jaccard' similarity matrix. Only pairs found through
+    locality-sensitive hashing are compared, using the fraction of equal MinHash values.
+    Library-only: `cluster_hunks` needs a dense distance matrix anyway and its sparse
+    TF-IDF product is as fast up to ~10k hunks.
+    """
+    signatures = minhash_signatures(hunks, num_perm=num_perm, seed=seed)
+    pairs = lsh_candidate_pairs(signatures, bands=bands)
+
+    rows, cols = pairs[:, 0], pairs[:, 1]
+    similarities = (signatures[rows] == signatures[cols]).mean(axis=1)
+    keep = similarities > threshold
+    rows, cols, similarities = rows[keep], cols[keep], similarities[keep]
+
+    diagonal = np.arange(len(hunks))
+    return sparse.csr_matrix(
+        (np.concatenate((similarities, similarities, np.ones(len(hunks)))),
+         (np.concatenate((rows, cols, diagonal)), np.concatenate((cols, rows, diagonal)))),
+        shape=(len(hunks), len(hunks)))
+
+
 def get_modified_lines(hunk):
     return os.linesep.join(
-        re.sub(r"[^a-zA-Z0-9\s]", " ", re.sub(r"([+-]) ?", "", re.sub(r" +", " ", line)))
+        NON_ALPHANUMERIC_PATTERN.sub(" ", SIGN_PATTERN.sub("", SPACES_PATTERN.sub(" ", line)))
         for line in hunk.splitlines() if line.startswith(('+', '-'))
     )
 
 
-def extract_renames(git_diff):
-    patch_set = parse_diff(git_diff)
-
+def extract_renames(diff_model):
     renames = []
     clean_diff = []
 
-    for patched_file in patch_set:
-        if patched_file.is_rename:
-            renames.append((patched_file, str(patched_file)))
+    for diff_file in diff_model.files:
+        if diff_file.is_rename:
+            renames.append((diff_file, diff_model.file_text(diff_file)))
         else:
-            clean_diff.append(str(patched_file))
+            clean_diff.append(diff_model.file_text(diff_file))
 
     return renames, clean_diff
 
 
+
+
+# File types that get their own conventional-commit type when a commit only touches them
+DOCS_EXTENSIONS = (".md", ".rst", ".txt", ".adoc")
+CONFIG_EXTENSIONS = (".json", ".toml", ".yml", ".yaml", ".cfg", ".ini", ".lock")
+
+
+def get_identifiers(hunk_text):
+    return [
+        word for line in hunk_text.splitlines() if line.startswith(('+', '-'))
+        for word in re.findall(r"[A-Za-z_][A-Za-z0-9_]{2,}", line[1:])
+        if word.lower() not in RESERVED_WORDS and word.lower() not in COMMON_ENGLISH_WORDS
+    ]
+
+
+def path_similarity_matrix(paths):
+    """
+    1 for hunks of the same file, 0.6 for files in the same directory and 0.3 for files
+    sharing their top-level directory.
+    """
+    def same(values):
+        codes = np.unique(values, return_inverse=True)[1]
+        return codes[:, None] == codes[None, :]
+
+    dirs = [os.path.dirname(path) for path in paths]
+    tops = [path.split("/", 1)[0] if "/" in path else "" for path in paths]
+    nested = np.array([top != "" for top in tops])
+    return np.maximum.reduce([same(paths) * 1.0, same(dirs) * 0.6, (same(tops) & nested[:, None]) * 0.3])
+
+
+def hunk_similarity_matrix(diff_model):
+    """
+    Combines the path similarity with the TF-IDF similarity of the identifiers each hunk changes.
+    """
+    hunks = diff_model.hunks
+    documents = [" ".join(get_identifiers(hunk.text)) for hunk in hunks]
+    try:
+        tfidf = TfidfVectorizer(lowercase=True, token_pattern=r"\S+").fit_transform(documents)
+        identifiers = (tfidf @ tfidf.T).toarray()
+    except ValueError:
+        # no identifiers at all (e.g. only binary files or renames)
+        identifiers = np.zeros((len(hunks), len(hunks)))
+    return 0.5*path_similarity_matrix([hunk.path for hunk in hunks]) + 0.5*identifiers
+
+
+def cluster_hunks(diff_model, clusters_n=None, distance_threshold=0.75):
+    """
+    Groups the hunks with agglomerative clustering on the combined similarity. Returns lists of
+    1-based hunk indices, ordered by their first hunk.
+    """
+    hunks = diff_model.hunks
+    if len(hunks) < 2 or clusters_n == 1:
+        return [[hunk.index for hunk in hunks]] if hunks else []
+
+    distances = np.clip(1 - hunk_similarity_matrix(diff_model), 0, None)
+    np.fill_diagonal(distances, 0)
+    clustering = AgglomerativeClustering(
+        n_clusters=min(clusters_n, len(hunks)) if clusters_n else None,
+        distance_threshold=None if clusters_n else distance_threshold,
+        metric="precomputed",
+        linkage="average").fit(distances)
+
+    groups = {}
+    for hunk, label in zip(hunks, clustering.labels_):
+        groups.setdefault(label, []).append(hunk.index)
+    return sorted(groups.values(), key=lambda group: group[0])
+
+
+def describe_cluster(diff_model, hunk_indices):
+    """
+    Builds a conventional-commit message for a group of hunks out of templates.
+    """
+    hunks = [diff_model.hunks[i - 1] for i in hunk_indices]
+    paths = list(dict.fromkeys(hunk.path for hunk in hunks))
+    files = [diff_file for diff_file in diff_model.files if diff_file.path in paths]
+    lines = [line for hunk in hunks for line in hunk.text.splitlines()[1:]]
+    added = sum(1 for line in lines if line.startswith('+'))
+    removed = sum(1 for line in lines if line.startswith('-'))
+
+    if all(path.lower().endswith(DOCS_EXTENSIONS) for path in paths):
+        commit_type, verb = "docs", "update"
+    elif all("test" in os.path.basename(path).lower() for path in paths):
+        commit_type, verb = "test", "update"
+    elif all(path.lower().endswith(CONFIG_EXTENSIONS) for path in paths):
+        commit_type, verb = "chore", "update"
+    elif all(diff_file.is_added for diff_file in files):
+        commit_type, verb = "feat", "add"
+    elif all(diff_file.is_removed for diff_file in files):
+        commit_type, verb = "refactor", "remove"
+    elif all(diff_file.is_rename for diff_file in files):
+        commit_type, verb = "refactor", "rename"
+    elif added and not removed:
+        commit_type, verb = "feat", "extend"
+    else:
+        commit_type, verb = "refactor", "update"
+
+    directory = os.path.commonpath([os.path.dirname(path) for path in paths])
+    scope = os.path.basename(directory) or (os.path.splitext(os.path.basename(paths[0]))[0] if len(paths) == 1 else "")
+
+    identifiers = [word for word, _ in Counter(word for hunk in hunks for word in get_identifiers(hunk.text)).most_common(2)]
+    targets = ", ".join(os.path.basename(path) for path in paths) if len(paths) <= 2 else f"{len(paths)} files"
+    subject = f"{verb} {', '.join(identifiers)} in {targets}" if identifiers else f"{verb} {targets}"
+
+    message = f"{commit_type}({scope}): {subject}" if scope else f"{commit_type}: {subject}"
+    return message[:72]
+
+
+def get_clusters_offline(prompt_data, clusters_n, diff_model):
+    """
+    Drop-in replacement for the LLM clustering functions that works entirely locally.
+    """
+    start = time.perf_counter()
+    clusters = [{
+        "message": describe_cluster(diff_model, group), "hunk_indices": [int(ix) for ix in group]
+    } for group in cluster_hunks(diff_model, clusters_n)]
+    logger.debug(f"Clustered {len(diff_model.hunks)} hunks offline in {(time.perf_counter() - start) * 1000:.1f}ms")
+    return clusters
@@ -0,0 +1,85 @@
+import threading
+from concurrent.futures import Future
+from loguru import logger
+
+from providers import cancellable
+
+
+class Prefetcher:
+    """
+    Speculatively fetches the groupings the user is most likely to ask for next (one more commit,
+    one less commit, or a fresh sample) while the current proposal is being reviewed.
+
+    Requests run in daemon threads so abandoned ones never delay exiting, and at most `budget`
+    of them are in flight at the same time. Cancelling a request also stops it while it runs, so
+    the answers nobody will look at aren't paid for.
+    """
+    def __init__(self, get_clusters_func, prompt_data, budget=1):
+        self.get_clusters_func = get_clusters_func
+        self.prompt_data = prompt_data
+        self.budget = budget
+        self.semaphore = threading.BoundedSemaphore(max(budget, 1))
+        self.futures = {}
+        self.events = {}
+
+    def get(self, clusters_n, refresh=False):
+        """
+        Returns the clusters for the request, waiting for the speculative one if it was made.
+        """
+        future = self.futures.pop((clusters_n, refresh), None)
+        self.events.pop((clusters_n, refresh), None)
+        if future is not None and not future.cancelled():
+            try:
+                clusters = future.result()
+                logger.debug(f"Using speculative result for {clusters_n} commits (refresh={refresh})")
+                if refresh:
+                    self.get_clusters_func.store(self.prompt_data, clusters_n, clusters)
+                return clusters
+            except Exception as e:
+                logger.debug(f"Speculative request failed, retrying: {e}")
+        return self.get_clusters_func(self.prompt_data, clusters_n=clusters_n, refresh=refresh)
+
+    def speculate(self, clusters_n, current_n):
+        """
+        Starts fetching the results of 'regenerate', 'increase' and 'decrease' for the current proposal.
+        """
+        wanted = [(clusters_n, True), (current_n + 1 if clusters_n is None else clusters_n + 1, False)]
+        decreased_n = current_n if clusters_n is None else clusters_n
+        if decreased_n > 1:
+            wanted.append((decreased_n - 1, False))
+        wanted = wanted[:self.budget]
+
+        for key in list(self.futures):
+            if key not in wanted:
+                self._cancel(key)
+
+        for key in wanted:
+            if key not in self.futures:
+                self.events[key] = threading.Event()
+                self.futures[key] = self._submit(*key, self.events[key])
+
+    def cancel(self):
+        for key in list(self.futures):
+            self._cancel(key)
+
+    def _cancel(self, key):
+        self.futures.pop(key).cancel()
+        self.events.pop(key).set()
+
+    def _submit(self, clusters_n, refresh, cancelled):
+        future = Future()
+
+        def worker():
+            with self.semaphore:
+                if not future.set_running_or_notify_cancel():
+                    return
+                try:
+                    # fresh samples are only stored once the user actually picks them
+                    with cancellable(cancelled):
+                        future.set_result(
+                            self.get_clusters_func(self.prompt_data, clusters_n=clusters_n, refresh=refresh, store=not refresh))
+                except BaseException as e:
+                    future.set_exception(e)
+
+        threading.Thread(target=worker, name=f"prefetch-{clusters_n}-{refresh}", daemon=True).start()
+        return future
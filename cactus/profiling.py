@@ -0,0 +1,145 @@
+"""
+Lightweight span-based instrumentation of the phases of a run.
+
+Spans record their wall time and counters (bytes, tokens, retries, git processes...). Counters
+added with `add` go to the innermost open span of the calling thread. While profiling is
+disabled `span` returns a shared no-op object and `add` returns right away, so instrumented
+code pays one global lookup per call.
+"""
+import json
+import os
+import threading
+import time
+
+_enabled = False
+_spans = []
+_lock = threading.Lock()
+_local = threading.local()
+_origin = time.perf_counter()
+
+
+class _NoopSpan:
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def add(self, **counters):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class Span:
+    def __init__(self, name, counters):
+        self.name = name
+        self.counters = counters
+        self.thread = threading.current_thread()
+        self.start = self.end = None
+
+    def add(self, **counters):
+        for key, value in counters.items():
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def __enter__(self):
+        stack = _local.__dict__.setdefault("stack", [])
+        stack.append(self)
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.end = time.perf_counter()
+        _local.stack.pop()
+        with _lock:
+            _spans.append(self)
+        return False
+
+    @property
+    def duration(self):
+        return self.end - self.start
+
+
+def enable():
+    global _enabled
+    _enabled = True
+
+
+def span(name, **counters):
+    """
+    Returns a context manager timing the block as a span with the given initial counters.
+    """
+    if not _enabled:
+        return NOOP_SPAN
+    return Span(name, counters)
+
+
+def add(**counters):
+    """
+    Adds the counters to the innermost open span of the current thread.
+    """
+    if not _enabled:
+        return
+    stack = getattr(_local, "stack", None)
+    if stack:
+        stack[-1].add(**counters)
+
+
+def get_summary():
+    """
+    Returns the calls, total time and summed counters of the finished spans, by name, in the
+    order they were first started.
+    """
+    with _lock:
+        spans = sorted(_spans, key=lambda s: s.start)
+    summary = {}
+    for s in spans:
+        entry = summary.setdefault(s.name, {"calls": 0, "seconds": 0.0, "counters": {}})
+        entry["calls"] += 1
+        entry["seconds"] += s.duration
+        for key, value in s.counters.items():
+            if isinstance(value, (int, float)):
+                entry["counters"][key] = entry["counters"].get(key, 0) + value
+    return summary
+
+
+def print_summary():
+    summary = get_summary()
+    if not summary:
+        return
+    name_width = max(len(name) for name in summary)
+    print(f"\n  {'phase'.ljust(name_width)} : {'calls':>5} {'time (ms)':>10}  counters")
+    for name, entry in summary.items():
+        counters = ", ".join(f"{key}={value:g}" for key, value in entry["counters"].items())
+        print(f"  \033[36m{name.ljust(name_width)}\033[0m : {entry['calls']:>5} \033[33m{entry['seconds'] * 1000:>10.1f}\033[0m  {counters}")
+    print()
+
+
+def write_trace(path):
+    """
+    Writes the spans as a Chrome trace-event file, viewable in chrome://tracing or Perfetto.
+    """
+    with _lock:
+        spans = list(_spans)
+    events = [{
+        "name": s.name,
+        "ph": "X",
+        "ts": (s.start - _origin) * 1e6,
+        "dur": s.duration * 1e6,
+        "pid": os.getpid(),
+        "tid": s.thread.ident,
+        "args": s.counters,
+    } for s in spans]
+    events += [{
+        "name": "thread_name", "ph": "M", "pid": os.getpid(), "tid": thread.ident, "args": {"name": thread.name}
+    } for thread in {s.thread for s in spans}]
+    with open(path, "w", encoding='utf-8') as f:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, f, default=str)
+
+
+def report(trace_path=None):
+    print_summary()
+    if trace_path:
+        write_trace(trace_path)
+        print(f"  Trace written to {trace_path}\n")
@@ -3,9 +3,13 @@ from prompt_toolkit.key_binding import KeyBindings
 from prompt_toolkit.styles import Style
 from prompt_toolkit.shortcuts import clear
 from prompt_toolkit.formatted_text import FormattedText
+from prompt_toolkit.patch_stdout import patch_stdout
 from loguru import logger
+import itertools
 import sys
 
+from api import commit_listener
+
 def display_clusters(clusters):
     n_hunks = sum([len(cluster['hunk_indices']) for cluster in clusters])
     logger.info(f"Grouped {n_hunks} hunks into {len(clusters)} commits:\n")
@@ -16,7 +20,19 @@ def display_clusters(clusters):
         for line in message_lines[1:]:
             logger.debug(line, color="gray")
 
-def handle_user_input(prompt_data, clusters_n, get_clusters_func):
+def display_streamed_commit():
+    """
+    Returns a callback logging the commits as they are received from the model.
+    """
+    counter = itertools.count()
+
+    def display(commit):
+        message = str(commit.get("message", "")).strip().split("\n")[0]
+        logger.info(f"Received commit {next(counter)}: {message}")
+
+    return display
+
+def handle_user_input(prompt_data, clusters_n, get_clusters_func, refresh=False, prefetcher=None):
     choices = [
         ('accept', 'Accept', 'c'),
         ('regenerate', 'Regenerate', 'r'),
@@ -86,31 +102,43 @@ def handle_user_input(prompt_data, clusters_n, get_clusters_func):
     def _(event):
         pass
 
-    clusters = get_clusters_func(prompt_data, clusters_n=clusters_n)
+    with commit_listener(display_streamed_commit()):
+        if prefetcher is not None:
+            clusters = prefetcher.get(clusters_n, refresh=refresh)
+        else:
+            clusters = get_clusters_func(prompt_data, clusters_n=clusters_n, refresh=refresh)
     display_clusters(clusters)
 
-    result = prompt('',
-                    key_bindings=kb,
-                    bottom_toolbar=get_toolbar,
-                    style=style,
-                    )
+    if prefetcher is not None:
+        prefetcher.speculate(clusters_n, len(clusters))
+
+    # speculative requests may log while the toolbar is shown
+    with patch_stdout():
+        result = prompt('',
+                        key_bindings=kb,
+                        bottom_toolbar=get_toolbar,
+                        style=style,
+                        )
 
     print(feedback[0])
 
     if result == 'accept':
-        pass  # Proceed to return clusters
+        if prefetcher is not None:
+            prefetcher.cancel()
     elif result == 'regenerate':
-        return handle_user_input(prompt_data, clusters_n, get_clusters_func)
+        return handle_user_input(prompt_data, clusters_n, get_clusters_func, refresh=True, prefetcher=prefetcher)
     elif result == 'increase':
-        return handle_user_input(prompt_data, len(clusters) + 1 if clusters_n is None else clusters_n + 1, get_clusters_func)
+        return handle_user_input(prompt_data, len(clusters) + 1 if clusters_n is None else clusters_n + 1, get_clusters_func, prefetcher=prefetcher)
     elif result == 'decrease':
         clusters_n = len(clusters) if clusters_n is None else clusters_n
         if clusters_n <= 1:
             logger.warning("Cannot decrease further. Minimum number of clusters is 1.")
         else:
             clusters_n -= 1
-        return handle_user_input(prompt_data, clusters_n, get_clusters_func)
+        return handle_user_input(prompt_data, clusters_n, get_clusters_func, prefetcher=prefetcher)
     elif result == 'quit':
+        if prefetcher is not None:
+            prefetcher.cancel()
         logger.error("Aborted by user.")
         sys.exit(1)
 
@@ -0,0 +1,641 @@
+"""
+Model backends used to group hunks and write changelogs.
+
+Every backend implements the Provider interface. Besides Gemini and OpenAI (or any server
+speaking the OpenAI chat-completions protocol, see stub_server.py), requests can be recorded to
+a cassette and replayed from it later, deterministically and without network access.
+
+Grouping prompts start with everything that doesn't change while the user regenerates or
+changes the number of commits (the system prompt, the files and the hunks), so that only the
+final instructions are new on every step: OpenAI caches such prefixes by itself, and Gemini
+gets them as cached content once the same prompt is sent a second time.
+
+All the requests of the process (groupings, speculative ones, shards, changelog chunks) share
+the same limits: at most `jobs` requests in flight, and per-model buckets of requests and
+tokens per minute. Rate limits, server errors and timeouts are retried with jittered backoff.
+"""
+import abc
+import atexit
+import datetime
+import hashlib
+import json
+import random
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from loguru import logger
+
+import profiling
+from streaming import CommitStreamParser
+from tokenizer import count_tokens
+from utils import TokenBucket
+from api import get_genai, get_initial_messages, get_openai, get_prompt_instructions
+from constants import CLASSIFICATOR_SCHEMA_GEMINI, CLASSIFICATOR_SCHEMA_OPENAI, PROMPT_CHANGELOG_SYSTEM, PROMPT_CLASSIFICATOR_SYSTEM
+
+
+# Retries of a request failing with a rate limit, a server error or a timeout
+MAX_RETRIES = 4
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+
+_limits = {"jobs": 4, "rpm": 0, "tpm": 0, "timeout": 120}
+_slots = threading.BoundedSemaphore(_limits["jobs"])
+# speculative requests can only take jobs - 1 slots, so there is always one for the user's
+_speculative_slots = threading.BoundedSemaphore(_limits["jobs"] - 1)
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+_cancel = threading.local()
+
+
+class RequestCancelled(Exception):
+    """
+    Raised in a thread whose requests were cancelled, see `cancellable`.
+    """
+
+
+class AnswerTruncated(Exception):
+    """
+    Raised when the model stopped writing a changelog at the `max_tokens` limit. `text` is the
+    part it wrote.
+    """
+    def __init__(self, text):
+        super().__init__("The answer was cut at the max tokens limit")
+        self.text = text
+
+
+@contextmanager
+def cancellable(event):
+    """
+    Cancels the requests made by the current thread inside the block once `event` is set: the
+    ones waiting for their turn never start, and streamed answers stop being read, which closes
+    the connection so the model stops writing them. Used for speculative requests.
+    """
+    _cancel.event = event
+    try:
+        yield
+    finally:
+        _cancel.event = None
+
+
+def is_speculative():
+    return getattr(_cancel, "event", None) is not None
+
+
+def acquire(slots):
+    while not slots.acquire(timeout=0.1):
+        check_cancelled()
+
+
+def check_cancelled():
+    event = getattr(_cancel, "event", None)
+    if event is not None and event.is_set():
+        raise RequestCancelled("The request was cancelled")
+
+
+def pause(seconds):
+    """
+    Sleeps between attempts, waking up early if the requests of the thread are cancelled.
+    """
+    event = getattr(_cancel, "event", None)
+    if event is None:
+        time.sleep(seconds)
+    else:
+        event.wait(seconds)
+    check_cancelled()
+
+
+def configure_limits(jobs=4, rpm=0, tpm=0, timeout=120):
+    """
+    Sets the limits shared by every request: concurrent requests, requests and tokens per minute
+    for each model (0 for no limit) and the seconds a request can take, streaming included.
+    """
+    global _slots, _speculative_slots
+    _limits.update(jobs=max(jobs, 1), rpm=rpm, tpm=tpm, timeout=timeout)
+    _slots = threading.BoundedSemaphore(_limits["jobs"])
+    _speculative_slots = threading.BoundedSemaphore(_limits["jobs"] - 1)
+    with _buckets_lock:
+        _buckets.clear()
+
+
+def get_buckets(model):
+    """
+    Returns the request and token buckets of the model.
+    """
+    with _buckets_lock:
+        if model not in _buckets:
+            _buckets[model] = (TokenBucket(_limits["rpm"]), TokenBucket(_limits["tpm"]))
+        return _buckets[model]
+
+
+def is_retryable(error):
+    """
+    Tells rate limits (429), server errors (5xx), timeouts and connection errors apart from the
+    errors that would happen again, for both the OpenAI and the Google SDK exceptions.
+    """
+    status = getattr(error, "status_code", None) or getattr(error, "code", None)
+    if isinstance(status, int):
+        return status == 429 or status >= 500
+    return isinstance(error, (TimeoutError, ConnectionError)) or type(error).__name__ in (
+        "APIConnectionError", "APITimeoutError", "DeadlineExceeded", "ServiceUnavailable", "ResourceExhausted")
+
+
+def retry_delay(error, attempt):
+    """
+    Returns a random delay up to an exponentially growing cap ("full jitter"), or the delay the
+    server asked for with a Retry-After header if it's longer.
+    """
+    delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2**attempt))
+    response = getattr(error, "response", None)
+    try:
+        retry_after = float(response.headers.get("retry-after")) if response is not None else 0
+    except (AttributeError, TypeError, ValueError):
+        retry_after = 0
+    return max(delay, min(retry_after, RETRY_MAX_DELAY))
+
+
+def emit(emitted, on_commit):
+    """
+    Returns a callback keeping the streamed commits in `emitted` before passing them on.
+    """
+    def callback(commit):
+        emitted.append(commit)
+        if on_commit:
+            on_commit(commit)
+
+    return callback
+
+
+def parse_stream(pieces, deadline, on_commit):
+    """
+    Feeds the text pieces of a streamed answer to a CommitStreamParser, calling `on_commit` with
+    every commit, and gives up if the answer isn't complete by the deadline or is cancelled.
+    """
+    parser = CommitStreamParser()
+    for piece in pieces:
+        check_cancelled()
+        if time.monotonic() > deadline:
+            raise TimeoutError("The answer wasn't complete before the deadline")
+        for commit in parser.feed(piece):
+            on_commit(commit)
+    return parser
+
+
+class Provider(abc.ABC):
+    """
+    Sends the requests of a run to a model and keeps track of its usage.
+    """
+    name = "provider"
+
+    def __init__(self, model):
+        self.model = model
+        self.usage = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0, "completion_tokens": 0}
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def request(self, send, prompt="", max_tokens=0, retryable=None):
+        """
+        Calls `send(deadline)`, which makes one request to the model, within the shared limits.
+        The token bucket is charged with an estimate (the prompt tokens plus `max_tokens`) that is
+        corrected once the usage is known. Failed requests are retried unless `retryable()` says
+        that part of the answer was already used.
+        """
+        requests, tokens = get_buckets(self.model)
+        slots = [_speculative_slots, _slots] if is_speculative() else [_slots]
+        cancel = getattr(_cancel, "event", None)
+        for attempt in range(MAX_RETRIES + 1):
+            with profiling.span("rate limit") as span:
+                waited = requests.acquire(cancel=cancel)
+                check_cancelled()
+                estimate = count_tokens(prompt, self.model, memo=False) + max_tokens if tokens.rate else 0
+                waited += tokens.acquire(estimate, cancel=cancel)
+                if cancel is not None and cancel.is_set():
+                    requests.refund(1)
+                    check_cancelled()
+                for i, semaphore in enumerate(slots):
+                    try:
+                        acquire(semaphore)
+                    except RequestCancelled:
+                        for acquired in slots[:i]:
+                            acquired.release()
+                        raise
+                span.add(waited_ms=waited * 1000)
+            self.local.tokens = None
+            try:
+                check_cancelled()
+                return send(time.monotonic() + _limits["timeout"])
+            except Exception as e:
+                if attempt == MAX_RETRIES or not is_retryable(e) or (retryable and not retryable()):
+                    raise
+                delay = retry_delay(e, attempt)
+                logger.warning(f"{self.name} request failed ({type(e).__name__}: {e}), retrying in {delay:.1f}s")
+                profiling.add(retries=1)
+            finally:
+                for semaphore in slots:
+                    semaphore.release()
+                if self.local.tokens is not None:
+                    tokens.refund(estimate - self.local.tokens)
+            pause(delay)
+
+    @abc.abstractmethod
+    def cluster(self, prompt_data, clusters_n, hunks_n, follow_ups=(), on_commit=None):
+        """
+        Returns the commits (dicts with a message and 1-based hunk indices) proposed by the model.
+        `follow_ups` continues the conversation: pairs of a previous answer of the model and the
+        question asked about it. The answer is streamed, and `on_commit` is called with every
+        commit as soon as it's complete (it may raise StreamAborted to stop reading). The result
+        isn't validated, see api.get_clusters.
+        """
+
+    @abc.abstractmethod
+    def changelog(self, prompt, max_tokens=None):
+        """
+        Returns the model answer to a changelog prompt, of at most `max_tokens` (by default the
+        provider's own limit). Raises AnswerTruncated if the model reached the limit.
+        """
+
+    def record_usage(self, prompt_tokens=0, completion_tokens=0, cached_tokens=0):
+        """
+        Counts a request. `prompt_tokens` includes the `cached_tokens` read from a provider-side cache.
+        """
+        with self.lock:
+            self.usage["requests"] += 1
+            self.usage["prompt_tokens"] += prompt_tokens or 0
+            self.usage["cached_tokens"] += cached_tokens or 0
+            self.usage["completion_tokens"] += completion_tokens or 0
+        if prompt_tokens or completion_tokens:
+            self.local.tokens = prompt_tokens + completion_tokens
+        profiling.add(prompt_tokens=prompt_tokens or 0, cached_tokens=cached_tokens or 0, completion_tokens=completion_tokens or 0)
+
+    def log_usage(self):
+        with self.lock:
+            usage = dict(self.usage)
+        if usage["requests"]:
+            logger.info(f"{self.name} usage: {usage['requests']} requests, {usage['prompt_tokens']} prompt tokens "
+                        f"({usage['cached_tokens']} cached, {usage['prompt_tokens'] - usage['cached_tokens']} uncached), "
+                        f"{usage['completion_tokens']} completion tokens")
+
+
+# Lifetime of the Gemini cached contents, long enough to review a few proposals
+GEMINI_CACHE_TTL = datetime.timedelta(minutes=10)
+
+
+class GeminiProvider(Provider):
+    name = "Gemini"
+
+    def __init__(self, model):
+        super().__init__(model)
+        self.changelog_model = None
+        self.cluster_model = None
+        self.cached_models = {}
+        self.cache_locks = defaultdict(threading.Lock)
+        self.caches = []
+
+    def _cluster_config(self):
+        from google.generativeai.types import HarmCategory, HarmBlockThreshold
+
+        return {
+            "generation_config": {
+                "temperature": 1.1,
+                "top_p": 1,
+                "max_output_tokens": 4096,
+                "response_mime_type": "application/json",
+                "response_schema": CLASSIFICATOR_SCHEMA_GEMINI
+            },
+            "safety_settings": {
+                HarmCategory.HARM_CATEGORY_DANGEROUS_CONTENT: HarmBlockThreshold.BLOCK_NONE,
+                HarmCategory.HARM_CATEGORY_SEXUALLY_EXPLICIT: HarmBlockThreshold.BLOCK_NONE,
+                HarmCategory.HARM_CATEGORY_HARASSMENT: HarmBlockThreshold.BLOCK_NONE,
+                HarmCategory.HARM_CATEGORY_HATE_SPEECH: HarmBlockThreshold.BLOCK_NONE
+            },
+        }
+
+    def _cached_model(self, static_prompt):
+        """
+        Returns a model bound to a cached content holding the system prompt and `static_prompt`,
+        or None the first time the prompt is seen (it may never be sent again, like the prompts of
+        shards) and when caching isn't possible (prompts below the minimum size, some models).
+        """
+        key = hashlib.sha256(static_prompt.encode('utf-8', errors='replace')).hexdigest()
+        with self.lock:
+            key_lock = self.cache_locks[key]
+        with key_lock:
+            # absent: never sent, None: sent once, False: caching failed
+            if key not in self.cached_models:
+                self.cached_models[key] = None
+            elif self.cached_models[key] is None:
+                self.cached_models[key] = self._create_cached_model(static_prompt)
+            return self.cached_models[key] or None
+
+    def _create_cached_model(self, static_prompt):
+        genai = get_genai()
+
+        def send(deadline):
+            return genai.caching.CachedContent.create(
+                model=self.model,
+                system_instruction=PROMPT_CLASSIFICATOR_SYSTEM,
+                contents=[{"role": "user", "parts": [static_prompt]}],
+                ttl=GEMINI_CACHE_TTL)
+
+        try:
+            with profiling.span("gemini cache", prompt_bytes=len(static_prompt)):
+                # like any other request, it takes a slot and is counted against the rate limits
+                cache = self.request(send, prompt=static_prompt)
+        except RequestCancelled:
+            raise
+        except Exception as e:
+            logger.debug(f"Could not cache the prompt on Gemini, sending it whole: {e}")
+            return False
+        with self.lock:
+            if not self.caches:
+                atexit.register(self.close)
+            self.caches.append(cache)
+        logger.debug(f"Cached {cache.usage_metadata.total_token_count} prompt tokens on Gemini until {cache.expire_time}")
+        return genai.GenerativeModel.from_cached_content(cached_content=cache, **self._cluster_config())
+
+    def close(self):
+        """
+        Deletes the cached contents instead of paying for their storage until they expire.
+        """
+        with self.lock:
+            caches, self.caches = self.caches, []
+        for cache in caches:
+            try:
+                cache.delete()
+            except Exception as e:
+                logger.debug(f"Could not delete the Gemini cached content {cache.name}: {e}")
+
+    def cluster(self, prompt_data, clusters_n, hunks_n, follow_ups=(), on_commit=None):
+        static_prompt = prompt_data
+        instructions = get_prompt_instructions(clusters_n, hunks_n)
+        model_instance = self._cached_model(static_prompt)
+        if model_instance is not None:
+            # the cached content already holds the prompt data, only the instructions are sent
+            turns = [instructions]
+        else:
+            if self.cluster_model is None:
+                self.cluster_model = get_genai().GenerativeModel(
+                    model_name=self.model, system_instruction=PROMPT_CLASSIFICATOR_SYSTEM, **self._cluster_config())
+            model_instance = self.cluster_model
+            turns = [static_prompt + instructions]
+        for answer, question in follow_ups:
+            turns += [answer, question]
+        history = [{"role": "user" if i % 2 == 0 else "model", "parts": [turn]} for i, turn in enumerate(turns[:-1])]
+        emitted = []
+
+        def send(deadline):
+            chat_session = model_instance.start_chat(history=history)
+            response = chat_session.send_message(
+                turns[-1], stream=True, request_options={"timeout": max(deadline - time.monotonic(), 1)})
+            received = []
+
+            def pieces():
+                for chunk in response:
+                    if chunk.candidates and chunk.candidates[0].content.parts:
+                        received.append(chunk)
+                        yield chunk.candidates[0].content.parts[0].text
+
+            try:
+                parser = parse_stream(pieces(), deadline, emit(emitted, on_commit))
+            finally:
+                self.record_usage(*self._usage(getattr(response, "usage_metadata", None)))
+
+            # Check if response was blocked or has issues
+            if not received:
+                logger.error(f"Gemini API response was blocked or empty. Finish reason: {response.candidates[0].finish_reason if response.candidates else 'No candidates'}")
+                raise ValueError("Gemini API response was blocked or contained no valid content")
+            return parser.result()
+
+        return self.request(send, prompt="".join(turns), max_tokens=4096, retryable=lambda: not emitted)
+
+    @staticmethod
+    def _usage(usage):
+        if not usage:
+            return 0, 0, 0
+        return usage.prompt_token_count, usage.candidates_token_count, getattr(usage, "cached_content_token_count", 0)
+
+    def changelog(self, prompt, max_tokens=None):
+        max_tokens = min(max_tokens or 8192, 8192)
+        if self.changelog_model is None:
+            # a single instance is shared by all the changelog requests
+            self.changelog_model = get_genai().GenerativeModel(
+                model_name=self.model,
+                generation_config={
+                    "temperature": 1,
+                    "top_p": 0.95,
+                    "top_k": 64,
+                    "max_output_tokens": 8192,
+                    "response_mime_type": "text/plain",
+                },
+                system_instruction=PROMPT_CHANGELOG_SYSTEM,
+            )
+
+        def send(deadline):
+            response = self.changelog_model.generate_content(prompt,
+                                                             generation_config={"max_output_tokens": max_tokens},
+                                                             request_options={"timeout": max(deadline - time.monotonic(), 1)})
+            self.record_usage(*self._usage(getattr(response, "usage_metadata", None)))
+            finish_reason = response.candidates[0].finish_reason if response.candidates else None
+            if getattr(finish_reason, "name", finish_reason) == "MAX_TOKENS":
+                raise AnswerTruncated(response.text)
+            return response.text
+
+        return self.request(send, prompt=prompt, max_tokens=max_tokens)
+
+
+class OpenAIProvider(Provider):
+    name = "OpenAI"
+
+    def __init__(self, model, base_url=None):
+        super().__init__(model)
+        self.base_url = base_url
+
+    def cluster(self, prompt_data, clusters_n, hunks_n, follow_ups=(), on_commit=None):
+        messages = get_initial_messages(prompt_data, clusters_n, hunks_n, self.model)
+        for answer, question in follow_ups:
+            messages += [{"role": "assistant", "content": answer}, {"role": "user", "content": question}]
+        logger.debug(messages)
+        emitted = []
+
+        def send(deadline):
+            response = get_openai(self.base_url).chat.completions.create(
+                model=self.model,
+                top_p=1,
+                temperature=1,
+                max_tokens=1024,
+                response_format={
+                    "type": "json_schema", "json_schema": CLASSIFICATOR_SCHEMA_OPENAI
+                },                                                                    # type: ignore
+                messages=messages,
+                stream=True,
+                stream_options={"include_usage": True},
+                timeout=max(deadline - time.monotonic(), 1))
+            usage = []
+
+            def pieces():
+                for chunk in response:
+                    if chunk.usage:
+                        usage.append(chunk.usage)
+                    if chunk.choices and chunk.choices[0].delta.content:
+                        yield chunk.choices[0].delta.content
+
+            try:
+                parser = parse_stream(pieces(), deadline, emit(emitted, on_commit))
+            finally:
+                # closing the stream early stops the generation of the rest of an aborted answer
+                response.close()
+                self.record_usage(*self._usage(usage[-1] if usage else None))
+            return parser.result()
+
+        return self.request(send,
+                            prompt="".join(message["content"] for message in messages),
+                            max_tokens=1024,
+                            retryable=lambda: not emitted)
+
+    def changelog(self, prompt, max_tokens=None):
+        max_tokens = max_tokens or 1000
+
+        def send(deadline):
+            response = get_openai(self.base_url).chat.completions.create(
+                model=self.model,
+                n=1,
+                top_p=0.8,
+                temperature=0.8,
+                max_tokens=max_tokens,
+                messages=[
+                    {"role": "system", "content": PROMPT_CHANGELOG_SYSTEM},
+                    {"role": "user", "content": prompt}
+                ],
+                timeout=max(deadline - time.monotonic(), 1))
+            self.record_usage(*self._usage(getattr(response, "usage", None)))
+            if response.choices[0].finish_reason == "length":
+                raise AnswerTruncated(response.choices[0].message.content)
+            return response.choices[0].message.content
+
+        return self.request(send, prompt=PROMPT_CHANGELOG_SYSTEM + prompt, max_tokens=max_tokens)
+
+    @staticmethod
+    def _usage(usage):
+        if not usage:
+            return 0, 0, 0
+        details = getattr(usage, "prompt_tokens_details", None)
+        return usage.prompt_tokens, usage.completion_tokens, getattr(details, "cached_tokens", 0) or 0
+
+
+def request_key(method, model, **arguments):
+    """
+    Identifies a request in a cassette, independently of when and by which provider it was made.
+    """
+    data = json.dumps({"method": method, "model": model, **arguments}, sort_keys=True)
+    return hashlib.sha256(data.encode('utf-8', errors='replace')).hexdigest()
+
+
+def cluster_arguments(prompt_data, clusters_n, hunks_n, follow_ups):
+    arguments = {"prompt_data": prompt_data, "clusters_n": clusters_n, "hunks_n": hunks_n}
+    if follow_ups:
+        # only present when needed, so that first requests keep the keys of older cassettes
+        arguments["follow_ups"] = [list(follow_up) for follow_up in follow_ups]
+    return arguments
+
+
+class RecordingProvider(Provider):
+    """
+    Forwards the requests to another provider and appends every request and response to a
+    cassette, a JSON lines file that ReplayProvider can serve later.
+    """
+    def __init__(self, provider, cassette_path):
+        super().__init__(provider.model)
+        self.provider = provider
+        self.name = provider.name
+        self.usage = provider.usage
+        self.cassette_path = cassette_path
+
+    def _record(self, method, arguments, func):
+        start = time.perf_counter()
+        response = func()
+        interaction = {
+            "key": request_key(method, self.model, **arguments),
+            "method": method,
+            "model": self.model,
+            "request": arguments,
+            "response": response,
+            "latency": time.perf_counter() - start,
+        }
+        with self.lock:
+            with open(self.cassette_path, "a", encoding='utf-8') as f:
+                f.write(json.dumps(interaction) + "\n")
+        return response
+
+    def cluster(self, prompt_data, clusters_n, hunks_n, follow_ups=(), on_commit=None):
+        # aborted answers are not recorded, the exception goes through _record
+        return self._record("cluster", cluster_arguments(prompt_data, clusters_n, hunks_n, follow_ups),
+                            lambda: self.provider.cluster(prompt_data, clusters_n, hunks_n, follow_ups, on_commit))
+
+    def changelog(self, prompt, max_tokens=None):
+        return self._record("changelog", {"prompt": prompt}, lambda: self.provider.changelog(prompt, max_tokens))
+
+
+class ReplayProvider(Provider):
+    """
+    Serves the responses of a cassette. Identical requests get the recorded responses in the
+    order they were recorded, starting over once all were served. Each response is delayed by
+    `latency` seconds, or by its recorded latency if it's None.
+    """
+    name = "Replay"
+
+    def __init__(self, cassette_path, model, latency=None):
+        super().__init__(model)
+        self.latency = latency
+        self.interactions = {}
+        self.served = {}
+        with open(cassette_path, "r", encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    interaction = json.loads(line)
+                    self.interactions.setdefault(interaction["key"], []).append(interaction)
+        logger.debug(f"Loaded {sum(map(len, self.interactions.values()))} recorded responses from {cassette_path}")
+
+    def _replay(self, method, arguments):
+        key = request_key(method, self.model, **arguments)
+        if key not in self.interactions:
+            raise Exception(f"No recorded response for this {method} request with {self.model}")
+        with self.lock:
+            served = self.served.get(key, 0)
+            self.served[key] = served + 1
+        interaction = self.interactions[key][served % len(self.interactions[key])]
+
+        def send(deadline):
+            # replayed requests take their slot under the shared limits like real ones
+            time.sleep(interaction["latency"] if self.latency is None else self.latency)
+            self.record_usage()
+            return interaction["response"]
+
+        return self.request(send, prompt=arguments.get("prompt_data") or arguments.get("prompt", ""))
+
+    def cluster(self, prompt_data, clusters_n, hunks_n, follow_ups=(), on_commit=None):
+        commits = self._replay("cluster", cluster_arguments(prompt_data, clusters_n, hunks_n, follow_ups))
+        for commit in commits if on_commit else ():
+            on_commit(commit)
+        return commits
+
+    def changelog(self, prompt, max_tokens=None):
+        return self._replay("changelog", {"prompt": prompt})
+
+
+def get_provider(model, record=None, replay=None, replay_latency=None, api_base=None):
+    """
+    Returns the provider of the model (Gemini for gemini models, OpenAI otherwise), replaying
+    from or recording to a cassette if asked to. With `api_base`, every model is sent to that
+    OpenAI-compatible server.
+    """
+    if replay:
+        return ReplayProvider(replay, model, latency=replay_latency)
+    if api_base:
+        provider = OpenAIProvider(model, base_url=api_base)
+    else:
+        provider = GeminiProvider(model) if "gemini" in model else OpenAIProvider(model)
+    if record:
+        return RecordingProvider(provider, record)
+    return provider
@@ -0,0 +1,162 @@
+import dataclasses
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from loguru import logger
+
+from constants import MODEL_TOKEN_LIMITS, PROMPT_CLASSIFICATOR_SYSTEM, PROMPT_SHARD_MERGE
+from tokenizer import count_tokens, count_tokens_batch
+
+# Fraction of the model context window a single prompt may use, the rest is left for the answer
+PROMPT_BUDGET_RATIO = 0.75
+
+
+def get_prompt_budget(model):
+    return int(MODEL_TOKEN_LIMITS.get(model, 127514) * PROMPT_BUDGET_RATIO) - count_tokens(PROMPT_CLASSIFICATOR_SYSTEM, model)
+
+
+def partition_files(diff_model, prepare_prompt_data, model, budget):
+    """
+    Splits the files of the diff into shards whose prompts fit the budget. Files are packed
+    directory by directory, so that a directory only spans several shards if it doesn't fit in one.
+    """
+    diff_files = sorted(diff_model.files, key=lambda diff_file: (os.path.dirname(diff_file.path), diff_file.path))
+    costs = count_tokens_batch([prepare_prompt_data(diff_model.subset([diff_file])[0]) for diff_file in diff_files], model)
+
+    directories = {}
+    for diff_file, cost in zip(diff_files, costs):
+        parts = split_file(diff_model, diff_file, prepare_prompt_data, model, budget) if cost > budget else [(diff_file, cost)]
+        directories.setdefault(os.path.dirname(diff_file.path), []).extend(parts)
+
+    shards, current, current_cost = [], [], 0
+    for entries in directories.values():
+        directory_cost = sum(cost for _, cost in entries)
+        if current and current_cost + directory_cost > budget:
+            shards.append(current)
+            current, current_cost = [], 0
+        for diff_file, cost in entries:
+            if current and current_cost + cost > budget:
+                shards.append(current)
+                current, current_cost = [], 0
+            current.append(diff_file)
+            current_cost += cost
+    if current:
+        shards.append(current)
+    return shards
+
+
+def split_file(diff_model, diff_file, prepare_prompt_data, model, budget):
+    """
+    Splits a file whose prompt doesn't fit the budget into parts of consecutive hunks that do, as
+    (part, cost) pairs. Every part is the file with only some of its hunks, so it's clustered like
+    any other file. A hunk over the budget on its own can't be split and gets a part of its own.
+    """
+    costs = count_tokens_batch([
+        prepare_prompt_data(diff_model.subset([dataclasses.replace(diff_file, hunks=[hunk])])[0]) for hunk in diff_file.hunks
+    ], model)
+    parts, current, current_cost = [], [], 0
+    for hunk, cost in zip(diff_file.hunks, costs):
+        if current and current_cost + cost > budget:
+            parts.append((dataclasses.replace(diff_file, hunks=current), current_cost))
+            current, current_cost = [], 0
+        if cost > budget:
+            logger.warning(f"Hunk {hunk.index} of {diff_file.path} alone needs {cost} tokens, over the {budget} tokens budget.")
+        current.append(hunk)
+        current_cost += cost
+    if current:
+        parts.append((dataclasses.replace(diff_file, hunks=current), current_cost))
+    logger.info(f"{diff_file.path} is over the {budget} tokens budget, split into {len(parts)} parts.")
+    return parts
+
+
+class ShardedClusterer:
+    """
+    Map-reduce clustering for diffs whose prompt doesn't fit the model context window.
+
+    Each shard is clustered concurrently on its own prompt, then a merge pass over the shard-level
+    commit messages combines related commits across shards. Shard results are computed once and
+    reused, so changing the number of commits only repeats the cheap merge pass.
+    """
+    def __init__(self, diff_model, make_clusters_func, prepare_prompt_data, model, budget, jobs=4):
+        self.make_clusters_func = make_clusters_func
+        self.model = model
+        self.budget = budget
+        self.jobs = jobs
+        self.shards = [diff_model.subset(diff_files) for diff_files in partition_files(diff_model, prepare_prompt_data, model, budget)]
+        self.prompts = [prepare_prompt_data(shard_model) for shard_model, _ in self.shards]
+        self.paths = {index: hunk.path for shard_model, indices in self.shards for hunk, index in zip(shard_model.hunks, indices)}
+        self.shard_clusters = None
+        self.lock = threading.Lock()
+        logger.info(f"Split {len(diff_model.hunks)} hunks into {len(self.shards)} shards of at most {budget} tokens.")
+
+    def cluster_shard(self, shard_ix):
+        (shard_model, indices), prompt_data = self.shards[shard_ix], self.prompts[shard_ix]
+        clusters = self.make_clusters_func(len(shard_model.hunks))(prompt_data, clusters_n=None)
+        # translate the shard hunk indices back to the global ones
+        return [{
+            "message": cluster["message"], "hunk_indices": [indices[i - 1] for i in cluster["hunk_indices"]]
+        } for cluster in clusters]
+
+    def merge(self, clusters, clusters_n=None):
+        """
+        Merges commits by sending every commit as a 'hunk' of the merge prompt, and translates the
+        answer back to the global hunk indices.
+        """
+        merge_prompt = PROMPT_SHARD_MERGE + "\n".join(self.merge_entries(clusters))
+        merged = self.make_clusters_func(len(clusters))(merge_prompt, clusters_n=clusters_n)
+        return [{
+            "message": cluster["message"],
+            "hunk_indices": [i for ix in cluster["hunk_indices"] for i in clusters[ix - 1]["hunk_indices"]]
+        } for cluster in merged]
+
+    def merge_entries(self, clusters):
+        return [
+            f"\n### HUNK {ix}\n{cluster['message']}\nfiles: {', '.join(dict.fromkeys(self.paths[i] for i in cluster['hunk_indices']))}"
+            for ix, cluster in enumerate(clusters, start=1)]
+
+    def reduce(self, clusters):
+        """
+        Merges the commits in batches that fit the budget until a single merge prompt fits it.
+        """
+        header = count_tokens(PROMPT_SHARD_MERGE, self.model)
+        while True:
+            costs = count_tokens_batch(self.merge_entries(clusters), self.model)
+            if header + sum(costs) <= self.budget:
+                return clusters
+
+            batches, current, current_cost = [], [], header
+            for cluster, cost in zip(clusters, costs):
+                if current and current_cost + cost > self.budget:
+                    batches.append(current)
+                    current, current_cost = [], header
+                current.append(cluster)
+                current_cost += cost
+            batches.append(current)
+            logger.info(f"Merge prompt of {len(clusters)} commits is over the {self.budget} tokens budget, merging in {len(batches)} batches first.")
+
+            with ThreadPoolExecutor(max_workers=max(self.jobs, 1), thread_name_prefix="merge") as executor:
+                reduced = [cluster for merged in executor.map(lambda batch: self.merge(batch) if len(batch) > 1 else batch, batches) for cluster in merged]
+            if len(reduced) >= len(clusters):
+                logger.warning(f"Batched merges didn't combine any of the {len(clusters)} commits, the merge prompt stays over the budget.")
+                return reduced
+            clusters = reduced
+
+    def __call__(self, prompt_data, clusters_n):
+        with self.lock:
+            if self.shard_clusters is None:
+                with ThreadPoolExecutor(max_workers=max(self.jobs, 1), thread_name_prefix="shard") as executor:
+                    shard_clusters = [
+                        cluster for clusters in executor.map(self.cluster_shard, range(len(self.shards)))
+                        for cluster in clusters
+                    ]
+                self.shard_clusters = self.reduce(shard_clusters)
+
+        if len(self.shards) == 1 and not clusters_n:
+            return self.shard_clusters
+
+        # the merge can only combine commits, never split them
+        if clusters_n and clusters_n > len(self.shard_clusters):
+            logger.warning(f"Asked for {clusters_n} commits, but the shards only make {len(self.shard_clusters)} and merging can't "
+                           f"split them. Making {len(self.shard_clusters)} commits instead.")
+            clusters_n = len(self.shard_clusters)
+        return self.merge(self.shard_clusters, clusters_n)
@@ -0,0 +1,62 @@
+"""
+Incremental parsing of the grouping answers, so that commits can be shown and checked while the
+model is still writing the rest of the answer.
+"""
+import json
+
+
+class StreamAborted(Exception):
+    """
+    Raised while an answer is streamed to stop reading it.
+    """
+
+
+class CommitStreamParser:
+    """
+    Collects the text of a streamed JSON answer like {"commits": [{...}, {...}]} and returns every
+    commit as soon as its object is complete. Any object directly inside an array counts as a
+    commit, so a bare array of commits works too.
+    """
+    def __init__(self):
+        self.text = []
+        self.size = 0
+        self.stack = []
+        self.in_string = False
+        self.escaped = False
+        self.commits = []
+
+    def feed(self, chunk):
+        """
+        Adds the next piece of the answer and returns the commits completed by it.
+        """
+        completed = []
+        offset = self.size
+        self.text.append(chunk)
+        self.size += len(chunk)
+        for i, char in enumerate(chunk, start=offset):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char in "{[":
+                self.stack.append((char, i))
+            elif char in "}]" and self.stack:
+                opening, start = self.stack.pop()
+                if opening == "{" and self.stack and self.stack[-1][0] == "[":
+                    text = "".join(self.text)
+                    self.text = [text]
+                    completed.append(json.loads(text[start:i + 1]))
+        self.commits += completed
+        return completed
+
+    def result(self):
+        """
+        Returns the commits of the whole answer, failing like json.loads if it's invalid.
+        """
+        answer = json.loads("".join(self.text))
+        return answer["commits"] if isinstance(answer, dict) else answer
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+"""
+Tiny local server speaking the OpenAI chat-completions protocol, to load-test cactus without
+network access or API costs:
+
+    python stub_server.py --port 8080 --latency 0.5
+    cactus --api-base http://127.0.0.1:8080/v1/ -m gpt-4o
+
+Clustering requests (the ones with a JSON schema response format) are answered with a valid
+grouping of consecutive hunks, any other request with a short changelog. Latency, jitter, the
+rate of failed requests and the rate of groupings that leave out a hunk (to exercise the
+follow-up questions) are configurable, and the peak number of concurrent requests is reported.
+Streamed requests get the answer in small server-sent events, `--chunk-delay` seconds apart.
+Like OpenAI, the server reports the leading messages it has already seen as cached tokens.
+"""
+import argparse
+import hashlib
+import json
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubState:
+    def __init__(self, latency=0.0, jitter=0.0, fail_rate=0.0, misassign_rate=0.0, chunk_delay=0.0, seed=None):
+        self.latency = latency
+        self.chunk_delay = chunk_delay
+        self.jitter = jitter
+        self.fail_rate = fail_rate
+        self.misassign_rate = misassign_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.active = 0
+        self.peak = 0
+        self.requests = 0
+        self.prefixes = set()
+
+    def cached_tokens(self, messages, tokens):
+        """
+        Returns the tokens of the longest run of leading messages already sent by an earlier request.
+        """
+        keys = [hashlib.sha256(json.dumps(messages[:k]).encode()).hexdigest() for k in range(1, len(messages))]
+        with self.lock:
+            hits = [k for k, key in enumerate(keys, start=1) if key in self.prefixes]
+            self.prefixes.update(keys)
+        return sum(tokens[:max(hits)]) if hits else 0
+
+
+def stub_clusters(content, misassign=False):
+    """
+    Groups the hunks asked for in the prompt into the requested number of commits, leaving out the
+    last hunk if `misassign`. Follow-up questions get the hunks they ask about in the first commit.
+    """
+    follow_up = re.search(r"listing \*\*only\*\* the hunks above \(([\d, ]+)\)", content)
+    if follow_up:
+        indices = [int(index) for index in follow_up.group(1).split(",")]
+        return json.dumps({"commits": [{"message": "chore: update part 1", "hunk_indices": indices}]})
+    hunks_n = int(re.search(r"for all the \*\*(\d+)\*\* hunks", content).group(1))
+    clusters_match = re.search(r"exactly \*\*(\d+)\*\* commits", content)
+    clusters_n = min(int(clusters_match.group(1)) if clusters_match else max(hunks_n // 5, 1), hunks_n)
+    size, extra = divmod(hunks_n, clusters_n)
+    commits, start = [], 1
+    for i in range(clusters_n):
+        end = start + size + (1 if i < extra else 0)
+        commits.append({"message": f"chore: update part {i + 1}", "hunk_indices": list(range(start, end))})
+        start = end
+    if misassign and hunks_n > 1:
+        commits[-1]["hunk_indices"].pop()
+    return json.dumps({"commits": commits})
+
+
+def stub_changelog(content):
+    ids = re.findall(r'<commit id="(\w+)">', content)
+    if ids:
+        return "\n".join(f'<changelog commit="{commit_id}">\n- Improved stability of {commit_id}\n</changelog>' for commit_id in ids)
+    return "<changelog>\n- Improved stability and performance\n</changelog>"
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def send_stream(self, completion, chunk_delay, chunk_size=16):
+        """
+        Sends the completion as chat.completion.chunk server-sent events, ending with the usage.
+        """
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        content = completion["choices"][0]["message"]["content"]
+        base = {key: completion[key] for key in ("id", "created", "model")}
+        try:
+            for start in range(0, len(content), chunk_size):
+                delta = {"content": content[start:start + chunk_size]}
+                if not start:
+                    delta["role"] = "assistant"
+                self.send_event({**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": delta, "finish_reason": None}]})
+                time.sleep(chunk_delay)
+            self.send_event({**base, "object": "chat.completion.chunk", "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]})
+            self.send_event({**base, "object": "chat.completion.chunk", "choices": [], "usage": completion["usage"]})
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            # the client aborted the answer
+            pass
+
+    def send_event(self, body):
+        self.wfile.write(b"data: " + json.dumps(body).encode() + b"\n\n")
+        self.wfile.flush()
+
+    def do_GET(self):
+        if self.path.rstrip("/").endswith("/models"):
+            return self.send_json(200, {"object": "list", "data": [{"id": "stub", "object": "model"}]})
+        self.send_json(404, {"error": {"message": "Not found"}})
+
+    def do_POST(self):
+        state = self.server.state
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"{}")
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            return self.send_json(404, {"error": {"message": "Not found"}})
+
+        with state.lock:
+            state.active += 1
+            state.requests += 1
+            state.peak = max(state.peak, state.active)
+            delay = max(state.latency + state.random.uniform(-state.jitter, state.jitter), 0)
+            failed = state.random.random() < state.fail_rate
+            misassign = state.random.random() < state.misassign_rate
+        try:
+            time.sleep(delay)
+            if failed:
+                status = state.random.choice([429, 500, 503])
+                return self.send_json(status, {"error": {"message": "Simulated failure", "code": status}})
+
+            # only the last message matters, earlier ones are the history of a follow-up
+            content = str((request.get("messages") or [{}])[-1].get("content", ""))
+            is_clustering = request.get("response_format", {}).get("type") == "json_schema"
+            answer = stub_clusters(content, misassign) if is_clustering else stub_changelog(content)
+            messages = request.get("messages", [])
+            tokens = [len(str(message.get("content", "")).split()) for message in messages]
+            prompt_tokens = sum(tokens)
+            completion_tokens = len(answer.split())
+            completion = {
+                "id": f"chatcmpl-{uuid.uuid4().hex}",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "stub"),
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": answer}, "finish_reason": "stop"}],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                    "prompt_tokens_details": {"cached_tokens": state.cached_tokens(messages, tokens)},
+                },
+            }
+            if request.get("stream"):
+                self.send_stream(completion, state.chunk_delay)
+            else:
+                self.send_json(200, completion)
+        finally:
+            with state.lock:
+                state.active -= 1
+
+
+def create_server(host="127.0.0.1", port=8080, **options):
+    """
+    Returns the stub server, not started yet. Port 0 picks a free port (see `server.server_address`).
+    """
+    server = ThreadingHTTPServer((host, port), StubHandler)
+    server.daemon_threads = True
+    server.state = StubState(**options)
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--latency", type=float, default=0.0, help="Seconds before answering every request")
+    parser.add_argument("--jitter", type=float, default=0.0, help="Random variation of the latency, in seconds")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="Fraction of requests answered with a 429 or 5xx error")
+    parser.add_argument("--misassign-rate", type=float, default=0.0, help="Fraction of groupings that leave out a hunk")
+    parser.add_argument("--chunk-delay", type=float, default=0.0, help="Seconds between the events of a streamed answer")
+    parser.add_argument("--seed", type=int)
+    args = parser.parse_args()
+
+    server = create_server(args.host, args.port, latency=args.latency, jitter=args.jitter, fail_rate=args.fail_rate,
+                           misassign_rate=args.misassign_rate, chunk_delay=args.chunk_delay, seed=args.seed)
+    host, port = server.server_address[:2]
+    print(f"Serving the OpenAI chat-completions stub on http://{host}:{port}/v1/")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        state = server.state
+        print(f"\n{state.requests} requests served, at most {state.peak} at the same time")
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
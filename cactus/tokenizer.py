@@ -0,0 +1,73 @@
+"""
+Token counting shared by every stage of the pipeline.
+
+Encoders are loaded once per model, counts are memoized by content hash so the same hunk, file
+or diff line is never encoded twice, and cache misses are encoded in batches across threads.
+Texts only seen once, like the lines of a streamed changelog range, skip the memo (`memo=False`)
+so it doesn't grow with them.
+"""
+import hashlib
+import os
+import threading
+from functools import lru_cache
+
+FALLBACK_MODEL = "gpt-4-0613"
+SHORT_TEXT_LENGTH = 256
+
+_counts = {}
+_counts_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model):
+    """
+    Returns the tiktoken encoding for the model, falling back to the gpt-4 encoding for models
+    tiktoken doesn't know about (e.g. gemini).
+    """
+    import tiktoken
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.encoding_for_model(FALLBACK_MODEL)
+
+
+def _content_key(encoding, text):
+    # short texts (e.g. single diff lines) are cheaper to keep than to hash
+    if len(text) <= SHORT_TEXT_LENGTH:
+        return encoding.name, text
+    return encoding.name, hashlib.blake2b(text.encode('utf-8', errors='replace'), digest_size=16).digest()
+
+
+def count_tokens(text, model, memo=True):
+    """
+    Returns the number of tokens of a single text.
+    """
+    return count_tokens_batch([text], model, memo=memo)[0]
+
+
+def count_tokens_batch(texts, model, num_threads=None, memo=True):
+    """
+    Returns the number of tokens of each text, encoding only the ones not seen before. Without
+    `memo`, every text is encoded and the counts aren't kept.
+    """
+    encoding = get_encoding(model)
+    if not memo:
+        return [len(tokens) for tokens in encoding.encode_batch(list(texts), num_threads=num_threads or os.cpu_count() or 1, disallowed_special=())]
+    keys = [_content_key(encoding, text) for text in texts]
+
+    with _counts_lock:
+        missing = {key: text for key, text in zip(keys, texts) if key not in _counts}
+
+    if missing:
+        encoded = encoding.encode_batch(
+            list(missing.values()), num_threads=num_threads or os.cpu_count() or 1, disallowed_special=())
+        with _counts_lock:
+            _counts.update(zip(missing.keys(), map(len, encoded)))
+
+    with _counts_lock:
+        return [_counts[key] for key in keys]
+
+
+def clear_cache():
+    with _counts_lock:
+        _counts.clear()
@@ -1,4 +1,5 @@
-import subprocess
+import threading
+import time
 from loguru import logger
 
 
@@ -27,18 +28,51 @@ def setup_logging(log_lvl="DEBUG", options={}):
         ]
     )  # type: ignore # yapf: disable
 
-def run(cmd, capture_output=False):
-    try:
-        logger.debug(f"Running command: {cmd}")
-        result = subprocess.run(
-            cmd,
-            shell=True,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE)
-        if capture_output:
-            logger.debug(f"Command output: {result.stdout}")
-            logger.debug(f"Command error: {result.stderr}")
-    except Exception as e:
-        logger.error(f"Failed to run command: {cmd}")
-        return subprocess.CompletedProcess(args=cmd, returncode=1, stdout=b'', stderr=str(e).encode())
-    return result
+class TokenBucket:
+    """
+    Thread-safe token bucket refilled at `per_minute` units per minute, holding at most a minute
+    worth of them. Units are reserved in order, so waiting threads are served first come, first
+    served. A rate of 0 disables it.
+    """
+    def __init__(self, per_minute=0):
+        self.rate = per_minute / 60
+        self.capacity = per_minute
+        self.level = float(per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, amount=1, cancel=None):
+        """
+        Takes `amount` units, waiting until they are available, and returns the seconds waited.
+        Amounts over the capacity are capped, so oversized requests still go through. If the
+        `cancel` event is set while waiting, the units are given back and it returns right away.
+        """
+        if not self.rate:
+            return 0
+        amount = min(amount, self.capacity)
+        with self.lock:
+            now = time.monotonic()
+            self._refill(now)
+            self.level -= amount
+            wait = -self.level / self.rate if self.level < 0 else 0
+        if cancel is None:
+            time.sleep(wait)
+        elif cancel.wait(wait):
+            self.refund(amount)
+            return time.monotonic() - now
+        return wait
+
+    def refund(self, amount):
+        """
+        Gives back units taken in excess (or takes more, if `amount` is negative) once the actual
+        cost of a request is known.
+        """
+        if not self.rate:
+            return
+        with self.lock:
+            self._refill(time.monotonic())
+            self.level = min(self.capacity, self.level + amount)
@@ -0,0 +1,31 @@
+import os
+import re
+import sys
+
+import pytest
+
+# the cactus modules import each other by their bare names, like when cactus.py runs
+CACTUS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.realpath(__file__))), "cactus")
+sys.path.insert(0, CACTUS_DIR)
+
+
+class WordEncoding:
+    """
+    Counts words and punctuation instead of tokens, so the tests don't need the tiktoken encodings.
+    """
+    name = "words"
+
+    def encode(self, text, **kwargs):
+        return re.findall(r"\w+|\S", text)
+
+    def encode_batch(self, texts, num_threads=1, **kwargs):
+        return [self.encode(text) for text in texts]
+
+
+@pytest.fixture
+def word_tokens(monkeypatch):
+    import tokenizer
+    tokenizer.clear_cache()
+    monkeypatch.setattr(tokenizer, "get_encoding", lambda model: WordEncoding())
+    yield
+    tokenizer.clear_cache()
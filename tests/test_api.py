@@ -0,0 +1,57 @@
+import pytest
+
+from api import StreamChecker, apply_repair, check_clusters
+from streaming import StreamAborted
+
+
+def test_check_clusters_reports_missing_and_duplicated_hunks():
+    clusters = [{"message": "a", "hunk_indices": [1, 2, 2]}, {"message": "b", "hunk_indices": [2, 4]}]
+    cleaned, missing, duplicated, invalid = check_clusters(clusters, 4)
+    assert [cluster["hunk_indices"] for cluster in cleaned] == [[1, 2], [2, 4]]
+    assert missing == [3]
+    assert duplicated == {2: [0, 1]}
+    assert invalid == []
+
+
+def test_check_clusters_drops_invalid_indices():
+    clusters = [{"message": "a", "hunk_indices": [1, 0, 5, "2", True, [3], None]}, {"message": "b", "hunk_indices": 2}]
+    cleaned, missing, duplicated, invalid = check_clusters(clusters, 3)
+    assert [cluster["hunk_indices"] for cluster in cleaned] == [[1], [2]]
+    assert missing == [3]
+    assert duplicated == {}
+    assert invalid == [0, 5, "2", True, [3], None]
+
+
+def test_apply_repair_moves_the_repaired_hunks():
+    clusters = [{"message": "Add parser", "hunk_indices": [1, 2]}, {"message": "Fix tests", "hunk_indices": [2, 3]}]
+    repair = [{"message": "fix tests", "hunk_indices": [2, 4, [5]]}, {"message": "Update docs", "hunk_indices": [5]}]
+    assert apply_repair(clusters, repair, {2, 4, 5}) == [
+        {"message": "Add parser", "hunk_indices": [1]},
+        {"message": "Fix tests", "hunk_indices": [2, 3, 4]},
+        {"message": "Update docs", "hunk_indices": [5]},
+    ]
+    # the clusters given are left as they were
+    assert clusters[0]["hunk_indices"] == [1, 2]
+
+
+def test_apply_repair_drops_emptied_commits():
+    clusters = [{"message": "a", "hunk_indices": [1]}, {"message": "b", "hunk_indices": [2]}]
+    assert apply_repair(clusters, [{"message": "b", "hunk_indices": [1]}], {1}) == [{"message": "b", "hunk_indices": [1, 2]}]
+
+
+def test_stream_checker_counts_unhashable_indices_as_errors():
+    checker = StreamChecker(hunks_n=10)
+    checker({"message": "a", "hunk_indices": [1, [2], {"3": 3}]})
+    assert checker.errors == 2
+    assert checker.seen == {1}
+
+
+def test_stream_checker_aborts_broken_answers():
+    checker = StreamChecker(hunks_n=4)
+    with pytest.raises(StreamAborted):
+        checker({"message": "a", "hunk_indices": [1, 1, 1, 9]})
+
+    checker = StreamChecker(hunks_n=4, clusters_n=1)
+    checker({"message": "a", "hunk_indices": [1, 2]})
+    with pytest.raises(StreamAborted):
+        checker({"message": "b", "hunk_indices": [3, 4]})
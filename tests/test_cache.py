@@ -0,0 +1,128 @@
+import os
+import time
+
+from cache import ResponseCache, SummaryStore, with_cache
+
+
+def age(cache, key, seconds):
+    """
+    Moves the mtime of an entry `seconds` into the past.
+    """
+    path = cache._entry_path(key)
+    mtime = time.time() - seconds
+    os.utime(path, (mtime, mtime))
+
+
+def test_get_returns_what_was_put(tmp_path):
+    cache = ResponseCache(tmp_path)
+    key = cache.key("prompt", "gpt-4o", 2)
+    cache.put(key, [{"message": "feat: x", "hunk_indices": [1]}])
+    assert cache.get(key) == [{"message": "feat: x", "hunk_indices": [1]}]
+    assert cache.get(cache.key("prompt", "gpt-4o", 3)) is None
+
+
+def test_key_depends_on_prompt_model_and_count():
+    keys = {ResponseCache.key(*args) for args in [("a", "gpt-4o", 2), ("b", "gpt-4o", 2), ("a", "gemini", 2), ("a", "gpt-4o", 3)]}
+    assert len(keys) == 4
+    # no count and a count of 0 both mean "let the model choose"
+    assert ResponseCache.key("a", "gpt-4o", None) == ResponseCache.key("a", "gpt-4o", 0)
+
+
+def test_expired_entries_are_dropped_on_read(tmp_path):
+    cache = ResponseCache(tmp_path, max_age=60)
+    key = cache.key("prompt", "gpt-4o", 1)
+    cache.put(key, ["old"])
+    age(cache, key, 120)
+    assert cache.get(key) is None
+    assert not os.path.exists(cache._entry_path(key))
+
+
+def test_eviction_drops_the_least_recently_used_over_the_size_limit(tmp_path):
+    cache = ResponseCache(tmp_path, max_bytes=10**6)
+    keys = [cache.key(f"prompt {i}", "gpt-4o", 1) for i in range(3)]
+    for i, key in enumerate(keys):
+        cache.put(key, ["x" * 100])
+        age(cache, key, 300 - i * 100)
+    # reading the oldest entry makes it the most recently used
+    assert cache.get(keys[0]) is not None
+
+    entry_size = os.path.getsize(cache._entry_path(keys[0]))
+    cache.max_bytes = entry_size * 2
+    cache.evict()
+    assert cache.get(keys[1]) is None
+    assert cache.get(keys[0]) is not None
+    assert cache.get(keys[2]) is not None
+
+
+def test_eviction_drops_expired_entries(tmp_path):
+    cache = ResponseCache(tmp_path, max_age=60)
+    old, new = cache.key("old", "gpt-4o", 1), cache.key("new", "gpt-4o", 1)
+    cache.put(old, ["old"])
+    age(cache, old, 120)
+    cache.put(new, ["new"])
+    assert not os.path.exists(cache._entry_path(old))
+    assert os.path.exists(cache._entry_path(new))
+
+
+def test_unreadable_entries_are_ignored(tmp_path):
+    cache = ResponseCache(tmp_path)
+    key = cache.key("prompt", "gpt-4o", 1)
+    cache.put(key, ["ok"])
+    with open(cache._entry_path(key), "w") as f:
+        f.write("{not json")
+    assert cache.get(key) is None
+
+
+def test_with_cache_refresh_and_deferred_store(tmp_path):
+    calls = []
+
+    def get_clusters(prompt_data, clusters_n):
+        calls.append(clusters_n)
+        return [{"message": f"answer {len(calls)}", "hunk_indices": [1]}]
+
+    cached = with_cache(get_clusters, "gpt-4o", ResponseCache(tmp_path))
+    first = cached("prompt", clusters_n=1)
+    assert cached("prompt", clusters_n=1) == first
+    assert len(calls) == 1
+
+    fresh = cached("prompt", clusters_n=1, refresh=True, store=False)
+    assert fresh != first
+    assert cached("prompt", clusters_n=1) == first
+    cached.store("prompt", 1, fresh)
+    assert cached("prompt", clusters_n=1) == fresh
+    assert len(calls) == 2
+
+
+def test_summary_store_keys_summaries_by_model_and_options(tmp_path):
+    store = SummaryStore(tmp_path)
+    store.put_summary("a" * 40, "gpt-4o", "{}", "- Added a")
+    store.put_summary("b" * 40, "gpt-4o", "{}", "")
+    store.put_summary("a" * 40, "gemini", "{}", "- Added a with gemini")
+    assert store.get_summaries(["a" * 40, "b" * 40, "c" * 40], "gpt-4o", "{}") == {"a" * 40: "- Added a", "b" * 40: ""}
+    assert store.get_summaries(["a" * 40], "gpt-4o", '{"context_size": 1}') == {}
+    # another store on the same file sees what was written
+    assert SummaryStore(tmp_path).get_summaries(["a" * 40], "gemini", "{}") == {"a" * 40: "- Added a with gemini"}
+
+
+def test_summary_store_looks_up_more_shas_than_a_query_takes(tmp_path):
+    store = SummaryStore(tmp_path)
+    shas = [f"{i:040x}" for i in range(SummaryStore.BATCH_SIZE * 2 + 1)]
+    for sha in shas:
+        store.put_summary(sha, "gpt-4o", "{}", sha)
+    assert store.get_summaries(shas, "gpt-4o", "{}") == {sha: sha for sha in shas}
+
+
+def test_summary_store_merges(tmp_path):
+    store = SummaryStore(tmp_path)
+    store.put_merge("gpt-4o", ["- a", "- b"], "- a\n- b")
+    assert store.get_merge("gpt-4o", ["- a", "- b"]) == "- a\n- b"
+    assert store.get_merge("gpt-4o", ["- b", "- a"]) is None
+    assert store.get_merge("gemini", ["- a", "- b"]) is None
+
+
+def test_summary_store_ignores_an_unusable_file(tmp_path):
+    (tmp_path / "changelog.sqlite3").write_bytes(b"not a database" * 100)
+    store = SummaryStore(tmp_path)
+    store.put_summary("a" * 40, "gpt-4o", "{}", "- Added a")
+    assert store.get_summaries(["a" * 40], "gpt-4o", "{}") == {}
+    assert store.get_merge("gpt-4o", ["- a"]) is None
@@ -0,0 +1,100 @@
+import argparse
+import re
+import subprocess
+
+import changelog
+from changelog import BATCH_MAX_COMMITS, CHANGELOG_MAX_TOKENS, ChangelogWriter, generate_changelog
+from git_utils import GitSession
+from providers import AnswerTruncated
+
+
+class FakeProvider:
+    """
+    Answers a merge with its bullets, and cuts the answers of merges of more than `fits` partials.
+    """
+    model = "gpt-4o"
+
+    def __init__(self, fits):
+        self.fits = fits
+        self.requests = []
+
+    def changelog(self, prompt, max_tokens=None):
+        self.requests.append(max_tokens)
+        bullets = [line for line in prompt.splitlines() if line.startswith("- ")]
+        if len(bullets) > self.fits:
+            raise AnswerTruncated("\n".join(bullets[:self.fits]))
+        return "<changelog>\n" + "\n".join(bullets) + "\n</changelog>"
+
+
+def test_merge_asks_for_as_many_tokens_as_the_partials(word_tokens):
+    provider = FakeProvider(fits=10)
+    partials = [" ".join(["- word"] * 600), "- other"]
+    assert ChangelogWriter(provider).merge(partials) == "\n".join(partials)
+    assert provider.requests[0] > CHANGELOG_MAX_TOKENS
+
+
+def test_truncated_merge_is_split_in_halves(word_tokens):
+    provider = FakeProvider(fits=2)
+    partials = ["- one", "- two", "- three", "- four"]
+    assert ChangelogWriter(provider).merge(partials) == "- one\n- two\n\n- three\n- four"
+    assert len(provider.requests) == 3
+
+
+def test_truncated_summary_keeps_the_written_part(word_tokens):
+    writer = ChangelogWriter(FakeProvider(fits=1))
+    assert writer.summarize(["subject"], "- one\n- two") == "- one"
+
+
+class BatchProvider:
+    """
+    Summarizes every commit of a batch as its subject, except the ones in `skipped`.
+    """
+    model = "gpt-4o"
+
+    def __init__(self, skipped=()):
+        self.skipped = skipped
+        self.prompts = []
+
+    def changelog(self, prompt, max_tokens=None):
+        self.prompts.append(prompt)
+        commits = re.findall(r'<commit id="(\w+)">\n<message>(.*?)</message>', prompt)
+        if commits:
+            return "\n".join(f'<changelog commit="{commit_id}">\n- {message}\n</changelog>'
+                             for commit_id, message in commits if message not in self.skipped)
+        if "<changelogs>" in prompt:
+            return "<changelog>\n" + "\n".join(line for line in prompt.splitlines() if line.startswith("- ")) + "\n</changelog>"
+        return "<changelog>\n- Summarized alone\n</changelog>"
+
+    def log_usage(self):
+        pass
+
+
+def test_summarize_batch_splits_the_answer_by_commit(word_tokens):
+    writer = ChangelogWriter(BatchProvider(skipped=["Fix b"]))
+    commits = [("a" * 40, "Add a", "+a"), ("b" * 40, "Fix b", "+b")]
+    assert writer.summarize_batch(commits) == {"a" * 40: "- Add a"}
+
+
+def test_small_commits_are_summarized_together(word_tokens, tmp_path, monkeypatch):
+    def git(*args):
+        return subprocess.run(["git", *args], cwd=tmp_path, capture_output=True, check=True).stdout.decode().strip()
+
+    git("init", "-q")
+    git("config", "user.name", "test")
+    git("config", "user.email", "test@example.com")
+    for i in range(BATCH_MAX_COMMITS + 2):
+        (tmp_path / f"file{i}.txt").write_text(f"line {i}\n")
+        git("add", ".")
+        git("commit", "-q", "-m", f"Add file {i}")
+    session = GitSession(repo=str(tmp_path))
+    monkeypatch.setattr(changelog, "get_session", lambda: session)
+
+    provider = BatchProvider(skipped=["Add file 3"])
+    args = argparse.Namespace(sha=None, pathspec=None, context_size=1, jobs=2, headroom=2048)
+    generate_changelog(args, provider)
+
+    batches = [prompt for prompt in provider.prompts if '<commit id="' in prompt]
+    alone = [prompt for prompt in provider.prompts if "<commit_messages>" in prompt]
+    # a full batch, the two commits left, and the commit skipped by the model on its own
+    assert [batch.count('<commit id="') for batch in batches] == [BATCH_MAX_COMMITS, 2]
+    assert len(alone) == 1 and "Add file 3" in alone[0]
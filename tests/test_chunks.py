@@ -0,0 +1,89 @@
+import pytest
+
+from api import diff_sections, get_chunk_budget, iter_chunks, pack_chunks
+
+
+def file_diff(path, hunks, lines_per_hunk):
+    lines = [f"diff --git a/{path} b/{path}", f"--- a/{path}", f"+++ b/{path}"]
+    for hunk in range(hunks):
+        lines.append(f"@@ -{hunk * 100 + 1},{lines_per_hunk} +{hunk * 100 + 1},{lines_per_hunk} @@")
+        lines += [f"+{path} hunk {hunk} line {line}" for line in range(lines_per_hunk)]
+    return lines
+
+
+def pack(lines, max_tokens):
+    return pack_chunks(lines, [1] * len(lines), max_tokens)
+
+
+def body_lines(chunks):
+    """
+    The lines of the chunks that aren't file headers or @@ lines, which can be repeated.
+    """
+    return sorted(line for chunk, _ in chunks for line in chunk.split("\n") if line.startswith("+") and not line.startswith("+++"))
+
+
+def test_diff_sections():
+    lines = file_diff("a.py", 2, 1) + file_diff("b.py", 1, 2)
+    assert diff_sections(lines) == [((0, 3), [(3, 5), (5, 7)]), ((7, 10), [(10, 13)])]
+
+
+def test_small_files_share_a_chunk_in_diff_order():
+    lines = file_diff("a.py", 1, 2) + file_diff("b.py", 1, 5) + file_diff("c.py", 1, 2)
+    chunks = pack(lines, 100)
+    assert chunks == [("\n".join(lines), len(lines))]
+
+
+def test_files_are_packed_biggest_first():
+    big, small = file_diff("big.py", 1, 10), file_diff("small.py", 1, 1)
+    chunks = pack(small + big, 14)
+    assert [tokens for _, tokens in chunks] == [14, 5]
+    assert chunks[0][0] == "\n".join(big)
+
+
+def test_file_over_the_budget_is_split_between_hunks():
+    lines = file_diff("a.py", 3, 4)
+    chunks = pack(lines, 3 + 5 * 2)
+    assert len(chunks) == 2
+    for chunk, tokens in chunks:
+        # every piece repeats the file header
+        assert chunk.split("\n")[:3] == lines[:3]
+        assert tokens <= 13 and tokens == len(chunk.split("\n"))
+    assert body_lines(chunks) == body_lines([("\n".join(lines), 0)])
+
+
+def test_hunk_over_the_budget_is_split_between_lines():
+    lines = file_diff("a.py", 1, 10)
+    chunks = pack(lines, 8)
+    assert len(chunks) == 3
+    for chunk, tokens in chunks:
+        # every piece repeats the header and the @@ line
+        assert chunk.split("\n")[:4] == lines[:4]
+        assert tokens <= 8
+    assert body_lines(chunks) == body_lines([("\n".join(lines), 0)])
+
+
+@pytest.mark.parametrize("window", [1, 2, 8])
+def test_iter_chunks_keeps_every_line(word_tokens, window):
+    records = [file_diff(f"dir/file{i}.py", 1 + i % 3, 5 + i * 3) for i in range(20)]
+    # a budget of about 150 tokens, a few files per chunk
+    headroom = get_chunk_budget("gpt-4o", 0) - 150
+    chunks = list(iter_chunks(iter(records), "gpt-4o", headroom=headroom, window=window))
+
+    assert len(chunks) > 1
+    assert body_lines((chunk, 0) for chunk in chunks) == body_lines([("\n".join(line for record in records for line in record), 0)])
+    for chunk in chunks:
+        assert chunk.startswith("diff --git ")
+
+
+def test_iter_chunks_consumes_records_as_needed(word_tokens):
+    read = []
+
+    def records():
+        for i in range(50):
+            read.append(i)
+            yield file_diff(f"file{i}.py", 1, 20)
+
+    headroom = get_chunk_budget("gpt-4o", 0) - 300
+    chunks = iter_chunks(records(), "gpt-4o", headroom=headroom, window=2)
+    next(chunks)
+    assert len(read) < 50
@@ -0,0 +1,41 @@
+import subprocess
+
+import pytest
+
+from git_utils import GitSession
+
+
+@pytest.fixture
+def repo(tmp_path):
+    def git(*args, input=None):
+        return subprocess.run(["git", *args], cwd=tmp_path, input=input, capture_output=True, check=True).stdout
+
+    git("init", "-q")
+    (tmp_path / "a").mkdir()
+    (tmp_path / "b").mkdir()
+    (tmp_path / "a" / "one.txt").write_text("one\n")
+    (tmp_path / "b" / "two.txt").write_text("two\n")
+    (tmp_path / ".gitattributes").write_text("*.txt -diff\n")
+    git("add", ".")
+    git("-c", "user.name=test", "-c", "user.email=test@example.com", "commit", "-q", "-m", "initial")
+    return tmp_path, git
+
+
+def test_read_files_from_a_subdirectory(repo):
+    path, _ = repo
+    session = GitSession(repo=str(path / "a"))
+    try:
+        files = session.index_reader.read_files(["a/one.txt", "b/two.txt", "b/removed.txt"])
+    finally:
+        session.index_reader.close()
+    assert files == {"a/one.txt": (b"one\n", True), "b/two.txt": (b"two\n", True), "b/removed.txt": (None, False)}
+
+
+def test_apply_cached_from_a_subdirectory(repo):
+    path, git = repo
+    (path / "b" / "two.txt").write_text("two\nthree\n")
+    patch = git("diff", "--text", "b/two.txt")
+    git("checkout", "b/two.txt")
+
+    GitSession(repo=str(path / "a")).apply_cached([patch.rstrip(b"\n")])
+    assert git("diff", "--cached", "--name-only") == b"b/two.txt\n"
@@ -0,0 +1,19 @@
+from diff_model import DiffModel
+from grouper import describe_cluster
+
+DIFF = b"""diff --git a/cactus/IndexReader.py b/cactus/IndexReader.py
+index 1111111..2222222 100644
+--- a/cactus/IndexReader.py
++++ b/cactus/IndexReader.py
+@@ -1,2 +1,3 @@
+ class IndexReader:
+     pass
++    readBlobs = BatchReader
+"""
+
+
+def test_describe_cluster_keeps_the_case_of_names():
+    message = describe_cluster(DiffModel.from_bytes(DIFF), [1])
+    assert message.startswith("feat(cactus): extend ")
+    assert "readBlobs" in message and "BatchReader" in message
+    assert message.endswith("in IndexReader.py")
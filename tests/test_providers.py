@@ -0,0 +1,35 @@
+import threading
+import time
+
+import pytest
+
+from providers import Provider, RequestCancelled, cancellable, configure_limits
+
+
+class EchoProvider(Provider):
+    name = "Echo"
+
+    def cluster(self, prompt_data, clusters_n, hunks_n, follow_ups=(), on_commit=None):
+        return []
+
+    def changelog(self, prompt, max_tokens=None):
+        return self.request(lambda deadline: prompt, prompt=prompt)
+
+
+@pytest.fixture
+def one_request_per_minute():
+    configure_limits(rpm=1)
+    yield
+    configure_limits()
+
+
+def test_cancelled_request_stops_waiting_for_the_rate_limit(one_request_per_minute):
+    provider = EchoProvider("echo")
+    assert provider.changelog("first") == "first"
+
+    cancel = threading.Event()
+    threading.Timer(0.05, cancel.set).start()
+    start = time.monotonic()
+    with cancellable(cancel), pytest.raises(RequestCancelled):
+        provider.changelog("second")
+    assert time.monotonic() - start < 1
@@ -0,0 +1,35 @@
+from conftest import WordEncoding
+from diff_model import DiffModel
+from sharding import partition_files
+
+
+def make_diff(path, hunks_n):
+    hunks = "".join(f"@@ -{i * 10 + 1},1 +{i * 10 + 1},2 @@\n line {i}\n+added line number {i} with some words\n" for i in range(hunks_n))
+    return f"diff --git a/{path} b/{path}\nindex 1111111..2222222 100644\n--- a/{path}\n+++ b/{path}\n{hunks}".encode()
+
+
+def prompt_data(diff_model):
+    return "\n".join(hunk.text for hunk in diff_model.hunks)
+
+
+def test_small_files_share_a_shard(word_tokens):
+    diff_model = DiffModel.from_bytes(make_diff("a/one.py", 1) + make_diff("a/two.py", 1))
+    shards = partition_files(diff_model, prompt_data, "gpt-4o", 1000)
+    assert [[diff_file.path for diff_file in shard] for shard in shards] == [["a/one.py", "a/two.py"]]
+
+
+def test_file_over_budget_is_split_by_hunks(word_tokens):
+    diff_model = DiffModel.from_bytes(make_diff("big.py", 6))
+    hunk_cost = len(WordEncoding().encode(diff_model.hunks[0].text))
+    shards = partition_files(diff_model, prompt_data, "gpt-4o", hunk_cost * 2)
+
+    assert len(shards) == 3
+    assert all(len(shard) == 1 and len(shard[0].hunks) == 2 for shard in shards)
+    indices = [hunk.index for shard in shards for hunk in shard[0].hunks]
+    assert indices == [hunk.index for hunk in diff_model.hunks]
+
+    # every shard maps back to the original hunk indices
+    subset, original = diff_model.subset(shards[1])
+    assert [hunk.index for hunk in subset.hunks] == [1, 2]
+    assert original == indices[2:4]
+
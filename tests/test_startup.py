@@ -0,0 +1,37 @@
+import subprocess
+import sys
+
+from conftest import CACTUS_DIR
+
+# modules that must only be loaded once they are needed, not when the CLI starts
+HEAVY_MODULES = [
+    "openai",
+    "google.generativeai",
+    "tiktoken",
+    "unidiff",
+    "prompt_toolkit",
+    "numpy",
+    "scipy",
+    "sklearn",
+    "thefuzz",
+    "torch",
+]
+
+
+def test_importing_cactus_loads_no_heavy_module():
+    code = f"import sys, cactus; print(','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))"
+    result = subprocess.run([sys.executable, "-c", code], cwd=CACTUS_DIR, capture_output=True, text=True, check=True)
+    assert result.stdout.strip() == ""
+
+
+def test_help_loads_no_heavy_module():
+    code = ("import runpy, sys\n"
+            "sys.argv = ['cactus', '--help']\n"
+            "try:\n"
+            "    runpy.run_path('cactus.py', run_name='__main__')\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            f"print('loaded:' + ','.join(m for m in {HEAVY_MODULES!r} if m in sys.modules))")
+    result = subprocess.run([sys.executable, "-c", code], cwd=CACTUS_DIR, capture_output=True, text=True, check=True)
+    assert "usage:" in result.stdout
+    assert result.stdout.strip().splitlines()[-1] == "loaded:"
@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+from streaming import CommitStreamParser
+
+COMMITS = [
+    {"message": "Fix \"quoted\" {braces} and [brackets]\\", "hunk_indices": [1, 2]},
+    {"message": "Add parser", "hunk_indices": [3], "details": {"scope": "api"}},
+]
+
+
+def feed_all(parser, text, size):
+    completed = []
+    for i in range(0, len(text), size):
+        completed.append(parser.feed(text[i:i + size]))
+    return completed
+
+
+@pytest.mark.parametrize("size", [1, 3, 1000])
+def test_commits_come_out_as_soon_as_they_are_complete(size):
+    text = json.dumps({"commits": COMMITS})
+    parser = CommitStreamParser()
+    completed = feed_all(parser, text, size)
+
+    assert [commit for chunk in completed for commit in chunk] == COMMITS
+    assert parser.commits == COMMITS
+    assert parser.result() == COMMITS
+
+
+def test_first_commit_comes_out_before_the_second_is_read():
+    text = json.dumps({"commits": COMMITS})
+    completed = feed_all(CommitStreamParser(), text, 1)
+    assert next(i for i, chunk in enumerate(completed) if chunk) < text.index("Add parser")
+
+
+def test_bare_array_of_commits():
+    parser = CommitStreamParser()
+    assert parser.feed(json.dumps(COMMITS)) == COMMITS
+    assert parser.result() == COMMITS
+
+
+def test_incomplete_answer():
+    parser = CommitStreamParser()
+    assert parser.feed('{"commits": [{"message": "a", "hunk_indices": [1]}, {"message": "b"') == [{"message": "a", "hunk_indices": [1]}]
+    with pytest.raises(json.JSONDecodeError):
+        parser.result()
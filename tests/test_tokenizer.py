@@ -0,0 +1,18 @@
+import tokenizer
+from tokenizer import count_tokens, count_tokens_batch
+
+
+def test_counts_are_memoized(word_tokens):
+    assert count_tokens_batch(["a b", "c", "a b"], "gpt-4o") == [2, 1, 2]
+    assert len(tokenizer._counts) == 2
+    long_text = "word " * 1000
+    assert count_tokens(long_text, "gpt-4o") == 1000
+    # long texts are kept by their hash, not their content
+    assert len(tokenizer._counts) == 3
+    assert all(len(key[1]) <= tokenizer.SHORT_TEXT_LENGTH for key in tokenizer._counts)
+
+
+def test_counts_without_memo_are_not_kept(word_tokens):
+    assert count_tokens_batch([f"line {i}" for i in range(100)], "gpt-4o", memo=False) == [2] * 100
+    assert count_tokens("one two three", "gpt-4o", memo=False) == 3
+    assert tokenizer._counts == {}
@@ -0,0 +1,48 @@
+import threading
+import time
+
+from utils import TokenBucket
+
+
+def test_disabled_bucket_never_waits():
+    bucket = TokenBucket(0)
+    assert bucket.acquire(10 ** 9) == 0
+
+
+def test_bucket_refills_at_its_rate():
+    bucket = TokenBucket(6000)
+    assert bucket.acquire(6000) == 0
+    # 100 units a second
+    start = time.monotonic()
+    waited = bucket.acquire(10)
+    assert 0.05 < waited <= 0.1
+    assert time.monotonic() - start >= waited * 0.9
+
+
+def test_oversized_amounts_are_capped():
+    bucket = TokenBucket(6000)
+    assert bucket.acquire(10 ** 9) == 0
+    assert bucket.level < 1
+
+
+def test_refund_gives_back_units():
+    bucket = TokenBucket(6000)
+    bucket.acquire(6000)
+    bucket.refund(6000)
+    assert bucket.acquire(5000) == 0
+    # the level never goes over the capacity
+    bucket.refund(10 ** 9)
+    assert bucket.level == 6000
+
+
+def test_cancelled_wait_returns_early_and_gives_back_the_units():
+    bucket = TokenBucket(6000)
+    bucket.acquire(6000)
+    cancel = threading.Event()
+    threading.Timer(0.05, cancel.set).start()
+    start = time.monotonic()
+    waited = bucket.acquire(6000, cancel=cancel)
+    assert time.monotonic() - start < 1
+    assert waited < 1
+    # only the refill of the time waited is left
+    assert 0 <= bucket.level < 100